@@ -0,0 +1,32 @@
+"""retention feature indexes
+
+Revision ID: 0818a28bcccf
+Revises: b0108f396b79
+Create Date: 2026-10-19 16:40:12.518305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0818a28bcccf'
+down_revision = 'b0108f396b79'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_studyrecord_debug_id_card_id_date', 'studyrecord', ['debug_id', 'card_id', 'date'], unique=False)
+    op.create_index('ix_studyrecord_user_id_date', 'studyrecord', ['user_id', 'date'], unique=False)
+    op.create_index('ix_usersnapshotv2_schedule_request_id_id', 'usersnapshotv2', ['schedule_request_id', 'id'], unique=False)
+    op.create_index('ix_cardsnapshotv2_schedule_request_id_card_id_id', 'cardsnapshotv2', ['schedule_request_id', 'card_id', 'id'], unique=False)
+    op.create_index('ix_usercardsnapshotv2_schedule_request_id_card_id_id', 'usercardsnapshotv2', ['schedule_request_id', 'card_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_usercardsnapshotv2_schedule_request_id_card_id_id', table_name='usercardsnapshotv2')
+    op.drop_index('ix_cardsnapshotv2_schedule_request_id_card_id_id', table_name='cardsnapshotv2')
+    op.drop_index('ix_usersnapshotv2_schedule_request_id_id', table_name='usersnapshotv2')
+    op.drop_index('ix_studyrecord_user_id_date', table_name='studyrecord')
+    op.drop_index('ix_studyrecord_debug_id_card_id_date', table_name='studyrecord')
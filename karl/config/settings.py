@@ -10,3 +10,22 @@ MODEL_API_URL = os.environ.get('MODEL_API_URL')
 SQLALCHEMY_DATABASE_URL = os.environ.get('SQLALCHEMY_DATABASE_URL')
 USE_MULTIPROCESSING = os.environ.get('USE_MULTIPROCESSING')
 MP_CONTEXT = os.environ.get('MP_CONTEXT')
+# model server: requests arriving within MODEL_BATCH_WAIT_MS of each other
+# share a forward pass, up to MODEL_MAX_BATCH_SIZE examples
+MODEL_BATCH_WAIT_MS = float(os.environ.get('MODEL_BATCH_WAIT_MS', 5))
+MODEL_MAX_BATCH_SIZE = int(os.environ.get('MODEL_MAX_BATCH_SIZE', 256))
+# model server inference backend
+MODEL_DEVICE = os.environ.get('MODEL_DEVICE', 'cpu')
+MODEL_NUM_THREADS = int(os.environ.get('MODEL_NUM_THREADS', 0))
+MODEL_QUANTIZE = os.environ.get('MODEL_QUANTIZE', 'int8')  # int8 or none
+MODEL_PARITY_TOLERANCE = float(os.environ.get('MODEL_PARITY_TOLERANCE', 0.02))
+MODEL_MAX_BATCH_TOKENS = int(os.environ.get('MODEL_MAX_BATCH_TOKENS', 16384))
+# model server: embeddings (and token ids) of cards missing from the
+# precomputed caches kept in memory, least recently used dropped first
+MODEL_EMBEDDING_CACHE_SIZE = int(os.environ.get('MODEL_EMBEDDING_CACHE_SIZE', 100000))
+# cascaded scoring: old cards the feature-only model scores (served scale) further than this
+# from the recall target window skip the full model
+MODEL_CASCADE_MARGIN = float(os.environ.get('MODEL_CASCADE_MARGIN', 0.1))
+# model server: seconds between checks for new checkpoints, 0 to only reload
+# on request
+MODEL_RELOAD_INTERVAL = float(os.environ.get('MODEL_RELOAD_INTERVAL', 60))
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Retention features, computed column by column over batches of feature vectors.
+
+Training (snapshots saved with each study record), serving (live vectors at
+schedule time) and offline analysis all describe a study as the user, card
+and user-card vectors as they were at some moment plus that moment. They
+all go through `compute_features`, so features are identical wherever they
+are computed, and a batch is computed with a few array operations instead
+of one pydantic object per record.
+
+Input is a frame with one row per (user, card, date):
+
+- `user_{field}`, `card_{field}`, `usercard_{field}`: fields of `VUser`,
+  `VCard` and `VUserCard` (`USER_FIELDS`, `CARD_FIELDS`, `USERCARD_FIELDS`),
+- `user_id`, `card_id`, `card_text`, `date`, and optionally
+  `elapsed_milliseconds` and `card_answer`.
+
+`vectors_frame` builds it from vector objects; the training query selects
+the same columns from snapshot tables.
+
+Point in time: `date` is the moment the features describe, the record date
+in training and the (possibly future) prediction date in serving. Every
+duration is measured from `date`, never from the current time, and the
+vectors must be the ones saved at or before `date`. Rows whose previous
+study is after `date` would leak the future into the features and are
+logged.
+
+Feature sets are versioned: `v1` is the schema of `retention_phase1`, `v2`
+the one of `retention_phase2`. Add a version rather than changing one, since
+trained models depend on the exact columns.
+'''
+
+import json
+import logging
+import operator
+import pandas as pd
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Sequence, Union
+
+logger = logging.getLogger('karl')
+
+USER_FIELDS = [
+    'count_positive',
+    'count_negative',
+    'count',
+    'count_positive_session',
+    'count_negative_session',
+    'count_session',
+    'parameters',
+]
+CARD_FIELDS = [
+    'count_positive',
+    'count_negative',
+    'count',
+]
+USERCARD_FIELDS = [
+    'count_positive',
+    'count_negative',
+    'count',
+    'count_positive_session',
+    'count_negative_session',
+    'count_session',
+    'previous_delta',
+    'previous_study_date',
+    'previous_study_response',
+    'previous_delta_session',
+    'previous_study_date_session',
+    'previous_study_response_session',
+    'correct_on_first_try',
+    'correct_on_first_try_session',
+    'leitner_box',
+    'leitner_scheduled_date',
+    'sm2_efactor',
+    'sm2_interval',
+    'sm2_repetition',
+    'sm2_scheduled_date',
+]
+
+
+class _Vector:
+    '''
+    Mutable record with `__slots__` and no validation, for vectors the
+    scheduler reads from its own tables. Much cheaper to build per candidate
+    card than the pydantic schemas, which stay at the API boundary.
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    @classmethod
+    def of(cls, vector: Any) -> '_Vector':
+        '''Copy of the fields of an ORM row, a pydantic vector or another struct.'''
+        obj = cls.__new__(cls)
+        # ORM rows and pydantic models keep their values in __dict__, which
+        # is much faster to read than through their attribute descriptors
+        values = getattr(vector, '__dict__', None)
+        if values is None:
+            for name in cls.__slots__:
+                setattr(obj, name, getattr(vector, name, None))
+        else:
+            for name in cls.__slots__:
+                setattr(obj, name, values.get(name))
+        return obj
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class UserVector(_Vector):
+    '''Fields of `VUser`.'''
+    __slots__ = (
+        'user_id', 'count_positive', 'count_negative', 'count',
+        'count_positive_session', 'count_negative_session', 'count_session',
+        'previous_delta', 'previous_study_date', 'previous_study_response',
+        'previous_delta_session', 'previous_study_date_session', 'previous_study_response_session',
+        'parameters', 'date', 'schedule_request_id',
+    )
+
+
+class CardVector(_Vector):
+    '''Fields of `VCard`.'''
+    __slots__ = (
+        'card_id', 'count_positive', 'count_negative', 'count',
+        'previous_delta', 'previous_study_date', 'previous_study_response', 'date',
+    )
+
+
+class UserCardVector(_Vector):
+    '''Fields of `VUserCard`.'''
+    __slots__ = (
+        'user_id', 'card_id', 'count_positive', 'count_negative', 'count',
+        'count_positive_session', 'count_negative_session', 'count_session',
+        'previous_delta', 'previous_study_date', 'previous_study_response', 'correct_on_first_try',
+        'previous_delta_session', 'previous_study_date_session', 'previous_study_response_session',
+        'correct_on_first_try_session', 'leitner_box', 'leitner_scheduled_date',
+        'sm2_efactor', 'sm2_interval', 'sm2_repetition', 'sm2_scheduled_date',
+        'date', 'schedule_request_id',
+    )
+
+
+def _columns(vectors: Sequence[Any], fields: List[str], prefix: str) -> Dict[str, list]:
+    if len(vectors) == 0:
+        return {f'{prefix}{field}': [] for field in fields}
+    if isinstance(vectors[0], dict):
+        getter = operator.itemgetter(*fields)
+    else:
+        getter = operator.attrgetter(*fields)
+    values = list(zip(*map(getter, vectors)))
+    return {f'{prefix}{field}': list(column) for field, column in zip(fields, values)}
+
+
+def vectors_frame(
+    v_users: Sequence[Any],
+    v_cards: Sequence[Any],
+    v_usercards: Sequence[Any],
+    dates: Union[datetime, Sequence[datetime]],
+    card_texts: Sequence[str],
+    elapsed_milliseconds: Sequence[int] = None,
+    card_answers: Sequence[str] = None,
+) -> pd.DataFrame:
+    '''
+    Input frame of `compute_features` from vectors (`UserVector`,
+    `CardVector`, `UserCardVector`, the pydantic schemas, their ORM models
+    or dicts), one row per user-card vector.
+    A single user vector or date is used for every row.
+    '''
+    n = len(v_usercards)
+    if not isinstance(v_users, (list, tuple)):
+        v_users = [v_users] * n
+    if isinstance(dates, datetime):
+        dates = [dates] * n
+    columns = {
+        'user_id': [x['user_id'] if isinstance(x, dict) else x.user_id for x in v_usercards],
+        'card_id': [x['card_id'] if isinstance(x, dict) else x.card_id for x in v_usercards],
+        'card_text': list(card_texts),
+        'date': list(dates),
+        'elapsed_milliseconds': [0] * n if elapsed_milliseconds is None else list(elapsed_milliseconds),
+    }
+    if card_answers is not None:
+        columns['card_answer'] = list(card_answers)
+    columns.update(_columns(v_users, USER_FIELDS, 'user_'))
+    columns.update(_columns(v_cards, CARD_FIELDS, 'card_'))
+    columns.update(_columns(v_usercards, USERCARD_FIELDS, 'usercard_'))
+    return pd.DataFrame(columns)
+
+
+def _hours_between(later: pd.Series, earlier: pd.Series) -> pd.Series:
+    return ((later - earlier).dt.total_seconds() // 3600).fillna(0).astype(int)
+
+
+def _seconds_between(later: pd.Series, earlier: pd.Series) -> pd.Series:
+    return (later - earlier).dt.total_seconds().fillna(0).astype(int)
+
+
+def _accuracy(positive: pd.Series, count: pd.Series) -> pd.Series:
+    return (positive / count.where(count > 0)).fillna(0).astype(float)
+
+
+def _int(column: pd.Series) -> pd.Series:
+    return pd.to_numeric(column).fillna(0).astype(int)
+
+
+def _float(column: pd.Series) -> pd.Series:
+    return pd.to_numeric(column).fillna(0).astype(float)
+
+
+def _bool(column: pd.Series) -> pd.Series:
+    return column.map(bool, na_action='ignore').fillna(False).astype(bool)
+
+
+def _repetition_model(parameters: pd.Series) -> pd.Series:
+    def parse(x):
+        if isinstance(x, str):
+            x = json.loads(x)
+        return x['repetition_model']
+    if not all(isinstance(p, str) for p in parameters):
+        return parameters.map(parse)
+    # few distinct parameter sets, so parse each once
+    return parameters.map({p: parse(p) for p in parameters.unique()})
+
+
+def _utc(column: pd.Series) -> pd.Series:
+    return pd.to_datetime(column, utc=True)
+
+
+def _check_point_in_time(date: pd.Series, previous_study_date: pd.Series) -> None:
+    n_leaks = int((previous_study_date > date).sum())
+    if n_leaks > 0:
+        logger.warning(f'{n_leaks} rows have a previous study after the date their features are for')
+
+
+def _features_v1(rows: pd.DataFrame, date: pd.Series) -> Dict[str, pd.Series]:
+    previous_study_date = _utc(rows.usercard_previous_study_date)
+    _check_point_in_time(date, previous_study_date)
+    return {
+        'user_id': rows.user_id,
+        'card_id': rows.card_id,
+        'card_text': rows.card_text,
+        'is_new_fact': rows.usercard_correct_on_first_try.isna(),
+        'user_n_study_positive': _int(rows.user_count_positive),
+        'user_n_study_negative': _int(rows.user_count_negative),
+        'user_n_study_total': _int(rows.user_count),
+        'card_n_study_positive': _int(rows.card_count_positive),
+        'card_n_study_negative': _int(rows.card_count_negative),
+        'card_n_study_total': _int(rows.card_count),
+        'usercard_n_study_positive': _int(rows.usercard_count_positive),
+        'usercard_n_study_negative': _int(rows.usercard_count_negative),
+        'usercard_n_study_total': _int(rows.usercard_count),
+        'acc_user': _accuracy(rows.user_count_positive, rows.user_count),
+        'acc_card': _accuracy(rows.card_count_positive, rows.card_count),
+        'acc_usercard': _accuracy(rows.usercard_count_positive, rows.usercard_count),
+        'usercard_delta': _hours_between(date, previous_study_date),
+        'usercard_delta_previous': _int(rows.usercard_previous_delta),
+        'usercard_previous_study_response': _bool(rows.usercard_previous_study_response),
+        'leitner_box': _int(rows.usercard_leitner_box),
+        'sm2_efactor': _float(rows.usercard_sm2_efactor),
+        'sm2_interval': _float(rows.usercard_sm2_interval),
+        'sm2_repetition': _int(rows.usercard_sm2_repetition),
+        'delta_to_leitner_scheduled_date': _hours_between(_utc(rows.usercard_leitner_scheduled_date), date),
+        'delta_to_sm2_scheduled_date': _hours_between(_utc(rows.usercard_sm2_scheduled_date), date),
+        'repetition_model': _repetition_model(rows.user_parameters),
+        'elapsed_milliseconds': _int(rows.elapsed_milliseconds),
+        'correct_on_first_try': _bool(rows.usercard_correct_on_first_try),
+        'utc_datetime': date,
+        'utc_date': date.dt.date,
+    }
+
+
+def _features_v2(rows: pd.DataFrame, date: pd.Series) -> Dict[str, pd.Series]:
+    previous_study_date = _utc(rows.usercard_previous_study_date)
+    _check_point_in_time(date, previous_study_date)
+    return {
+        'user_id': rows.user_id,
+        'card_id': rows.card_id,
+        'card_text': rows.card_text,
+        'answer': rows.card_answer,
+        'is_new_fact': rows.usercard_correct_on_first_try.isna(),
+        'count_positive_user': _int(rows.user_count_positive),
+        'count_negative_user': _int(rows.user_count_negative),
+        'count_user': _int(rows.user_count),
+        'count_positive_session_user': _int(rows.user_count_positive_session),
+        'count_negative_session_user': _int(rows.user_count_negative_session),
+        'count_session_user': _int(rows.user_count_session),
+        'count_positive_card': _int(rows.card_count_positive),
+        'count_negative_card': _int(rows.card_count_negative),
+        'count_positive_session_card': _int(rows.usercard_count_positive_session),
+        'count_negative_session_card': _int(rows.usercard_count_negative_session),
+        'count_session_card': _int(rows.usercard_count_session),
+        'count_positive_usercard': _int(rows.usercard_count_positive),
+        'count_negative_usercard': _int(rows.usercard_count_negative),
+        'count_usercard': _int(rows.usercard_count),
+        'acc_user': _accuracy(rows.user_count_positive, rows.user_count),
+        'acc_card': _accuracy(rows.card_count_positive, rows.card_count),
+        'acc_usercard': _accuracy(rows.usercard_count_positive, rows.usercard_count),
+        'acc_session_user': _accuracy(rows.user_count_positive_session, rows.user_count_session),
+        'acc_session_card': _accuracy(rows.usercard_count_positive_session, rows.usercard_count_session),
+        'delta': _hours_between(date, previous_study_date),
+        'delta_previous': _int(rows.usercard_previous_delta) // 3600,
+        'usercard_previous_study_response': _bool(rows.usercard_previous_study_response),
+        'usercard_delta_session': _seconds_between(date, _utc(rows.usercard_previous_study_date_session)),
+        'usercard_delta_previous_session': _int(rows.usercard_previous_delta_session),
+        'usercard_previous_study_response_session': _bool(rows.usercard_previous_study_response_session),
+        'leitner_box': _int(rows.usercard_leitner_box),
+        'sm2_efactor': _float(rows.usercard_sm2_efactor),
+        'sm2_interval': _float(rows.usercard_sm2_interval),
+        'sm2_repetition': _int(rows.usercard_sm2_repetition),
+        'delta_to_leitner_scheduled_date': _hours_between(_utc(rows.usercard_leitner_scheduled_date), date),
+        'delta_to_sm2_scheduled_date': _hours_between(_utc(rows.usercard_sm2_scheduled_date), date),
+        'repetition_model': _repetition_model(rows.user_parameters),
+        'elapsed_milliseconds': _int(rows.elapsed_milliseconds),
+        'correct_on_first_try': _bool(rows.usercard_correct_on_first_try),
+        'correct_on_first_try_session': _bool(rows.usercard_correct_on_first_try_session),
+        'utc_datetime': date,
+        'utc_date': date.dt.date,
+    }
+
+
+FEATURE_VERSIONS: Dict[str, Callable[[pd.DataFrame, pd.Series], Dict[str, pd.Series]]] = {
+    'v1': _features_v1,
+    'v2': _features_v2,
+}
+
+
+def compute_features(rows: pd.DataFrame, version: str = 'v1') -> pd.DataFrame:
+    '''Feature columns of `version` for every row of `rows`, in schema order, indexed like `rows`.'''
+    if version not in FEATURE_VERSIONS:
+        raise ValueError(f'unknown feature version {version}, expected one of {list(FEATURE_VERSIONS)}')
+    if 'elapsed_milliseconds' not in rows.columns:
+        rows = rows.assign(elapsed_milliseconds=0)
+    date = _utc(rows.date)
+    return pd.DataFrame(FEATURE_VERSIONS[version](rows, date), index=rows.index)
+
+
+def feature_records(features: pd.DataFrame) -> List[Dict[str, Any]]:
+    '''
+    Rows of `compute_features` as JSON-ready dicts, the payload of the model
+    server's predict endpoints.
+    '''
+    columns = {name: features[name].tolist() for name in features.columns}
+    columns['utc_datetime'] = [str(x) for x in columns['utc_datetime']]
+    columns['utc_date'] = [str(x) for x in columns['utc_date']]
+    names = list(columns.keys())
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
@@ -242,8 +242,7 @@ def get_user_charts(
 
 
 if __name__ == '__main__':
-    # df = get_retention_features_df()
-    df = pd.read_hdf("./retention_features.h5")
+    df = get_retention_features_df()
     print(df.columns)
     df. rename(columns = {'label':'response'}, inplace = True)
     path = f'{settings.CODE_DIR}/figures_stat'
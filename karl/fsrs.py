@@ -1,6 +1,7 @@
 from .fsrs_models import *
 import math
-from typing import Dict
+import numpy as np
+from typing import Dict, Tuple
 
 
 class FSRS:
@@ -106,3 +107,234 @@ class FSRS:
             math.pow(d, -self.p.w[12]) * \
             (math.pow(s + 1, self.p.w[13]) - 1) * \
             math.exp((1 - r) * self.p.w[14])
+
+
+class BatchFSRS:
+    '''
+    Vectorized counterpart of `FSRS` that applies one review to many cards at
+    once. Card state is kept in flat numpy arrays instead of `FSRSCard`
+    objects, so large populations can be stepped without per-card Python.
+    Intervals are in whole days; an interval of 0 means the card is due again
+    later the same day (the minute-level learning steps of `FSRS.repeat`).
+    '''
+    p: Parameters
+
+    def __init__(self, p: Parameters = None) -> None:
+        self.p = Parameters() if p is None else p
+        self.w = np.asarray(self.p.w, dtype=np.float64)
+
+    def repeat(
+        self,
+        state: np.ndarray,
+        stability: np.ndarray,
+        difficulty: np.ndarray,
+        elapsed_days: np.ndarray,
+        rating: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Same transition as `FSRS.repeat(card, now)[rating]`, elementwise.
+
+        :return: new state, stability, difficulty and scheduled interval in days.
+        '''
+        state = np.asarray(state)
+        rating = np.asarray(rating)
+        stability = np.asarray(stability, dtype=np.float64)
+        difficulty = np.asarray(difficulty, dtype=np.float64)
+        elapsed_days = np.asarray(elapsed_days, dtype=np.float64)
+
+        is_new = state == State.New
+        is_learning = (state == State.Learning) | (state == State.Relearning)
+        is_review = state == State.Review
+        is_again = rating == Rating.Again
+        is_hard = rating == Rating.Hard
+        is_easy = rating == Rating.Easy
+
+        new_stability = stability.copy()
+        new_difficulty = difficulty.copy()
+        interval = np.zeros(state.shape, dtype=np.int64)
+
+        # state transitions, see `SchedulingFSRSCards.update_state`
+        new_state = np.where(is_review, State.Review, state)
+        new_state = np.where(is_new, np.where(is_easy, State.Review, State.Learning), new_state)
+        new_state = np.where(is_learning & ~is_again & ~is_hard, State.Review, new_state)
+        new_state = np.where(is_review & is_again, State.Relearning, new_state)
+
+        if is_new.any():
+            r = rating[is_new]
+            new_difficulty[is_new] = self.init_difficulty(r)
+            new_stability[is_new] = self.init_stability(r)
+            easy_interval = self.next_interval(self.init_stability(np.full(r.shape, Rating.Easy)))
+            interval[is_new] = np.where(r == Rating.Easy, easy_interval, 0)
+
+        if is_learning.any():
+            r = rating[is_learning]
+            good_interval = self.next_interval(stability[is_learning])
+            easy_interval = good_interval + 1
+            interval[is_learning] = np.select(
+                [r == Rating.Good, r == Rating.Easy],
+                [good_interval, easy_interval],
+                0,
+            )
+
+        if is_review.any():
+            r = rating[is_review]
+            last_d = difficulty[is_review]
+            last_s = stability[is_review]
+            retrievability = (1 + elapsed_days[is_review] / (9 * last_s)) ** -1
+
+            d = self.next_difficulty(last_d, r)
+            again_s, hard_s, good_s, easy_s = self.next_review_stabilities(last_d, last_s, retrievability)
+
+            hard_interval = self.next_interval(hard_s)
+            good_interval = self.next_interval(good_s)
+            hard_interval = np.minimum(hard_interval, good_interval)
+            good_interval = np.maximum(good_interval, hard_interval + 1)
+            easy_interval = np.maximum(self.next_interval(easy_s), good_interval + 1)
+
+            new_difficulty[is_review] = d
+            new_stability[is_review] = np.select(
+                [r == Rating.Again, r == Rating.Hard, r == Rating.Good],
+                [again_s, hard_s, good_s],
+                easy_s,
+            )
+            interval[is_review] = np.select(
+                [r == Rating.Again, r == Rating.Hard, r == Rating.Good],
+                [0, hard_interval, good_interval],
+                easy_interval,
+            )
+
+        return new_state, new_stability, new_difficulty, interval
+
+    def next_review_stabilities(
+        self,
+        last_d: np.ndarray,
+        last_s: np.ndarray,
+        retrievability: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''Stability after reviewing a card in `State.Review`, for Again, Hard, Good and Easy.'''
+        return (
+            self.next_forget_stability(self.next_difficulty(last_d, Rating.Again), last_s, retrievability),
+            self.next_recall_stability(self.next_difficulty(last_d, Rating.Hard), last_s, retrievability, Rating.Hard),
+            self.next_recall_stability(self.next_difficulty(last_d, Rating.Good), last_s, retrievability, Rating.Good),
+            self.next_recall_stability(self.next_difficulty(last_d, Rating.Easy), last_s, retrievability, Rating.Easy),
+        )
+
+    def retrievability(self, elapsed_days: np.ndarray, stability: np.ndarray) -> np.ndarray:
+        return (1 + np.asarray(elapsed_days) / (9 * np.asarray(stability))) ** -1
+
+    def init_stability(self, r: np.ndarray) -> np.ndarray:
+        return np.maximum(self.w[np.asarray(r) - 1], 0.1)
+
+    def init_difficulty(self, r: np.ndarray) -> np.ndarray:
+        return np.clip(self.w[4] - self.w[5] * (np.asarray(r) - 3), 1, 10)
+
+    def next_interval(self, s: np.ndarray) -> np.ndarray:
+        new_interval = np.asarray(s) * 9 * (1 / self.p.request_retention - 1)
+        return np.clip(np.round(new_interval), 1, self.p.maximum_interval).astype(np.int64)
+
+    def next_difficulty(self, d: np.ndarray, r: np.ndarray) -> np.ndarray:
+        next_d = d - self.w[6] * (np.asarray(r) - 3)
+        return np.clip(self.mean_reversion(self.w[4], next_d), 1, 10)
+
+    def mean_reversion(self, init: float, current: np.ndarray) -> np.ndarray:
+        return self.w[7] * init + (1 - self.w[7]) * current
+
+    def next_recall_stability(self, d: np.ndarray, s: np.ndarray, r: np.ndarray, rating: int) -> np.ndarray:
+        hard_penalty = self.w[15] if rating == Rating.Hard else 1
+        easy_bonus = self.w[16] if rating == Rating.Easy else 1
+        s = np.where(s < 0, self.init_difficulty(rating), s)
+        return s * (1 + np.exp(self.w[8]) *
+                    (11 - d) *
+                    np.power(s, -self.w[9]) *
+                    (np.exp((1 - r) * self.w[10]) - 1) *
+                    hard_penalty *
+                    easy_bonus)
+
+    def next_forget_stability(self, d: np.ndarray, s: np.ndarray, r: np.ndarray) -> np.ndarray:
+        s = np.where(s < 0, self.init_difficulty(Rating.Again), s)
+        return self.w[11] * \
+            np.power(d, -self.w[12]) * \
+            (np.power(s + 1, self.w[13]) - 1) * \
+            np.exp((1 - r) * self.w[14])
+
+
+class FSRSKernel(BatchFSRS):
+    '''
+    `BatchFSRS` specialised to one parameter set.
+
+    `w` and `request_retention` are fixed per parameter set, so the `exp`
+    factors and rating bonuses collapse into per-rating constants computed
+    once here, and the stability/retrievability terms shared by the four
+    possible outcomes of a review are evaluated once instead of per rating.
+    Results match `BatchFSRS` up to floating point rounding.
+    '''
+
+    def __init__(self, p: Parameters = None) -> None:
+        super().__init__(p)
+        w = self.w
+        self.interval_factor = 9 * (1 / self.p.request_retention - 1)
+        self.recall_coef = {
+            Rating.Hard: math.exp(w[8]) * w[15],
+            Rating.Good: math.exp(w[8]),
+            Rating.Easy: math.exp(w[8]) * w[16],
+        }
+        # difficulty after a review only depends on the previous difficulty
+        # through the mean reversion: d' = a * d + b[rating]
+        self.difficulty_slope = 1 - w[7]
+        self.difficulty_offset = {
+            r: w[7] * w[4] - (1 - w[7]) * w[6] * (r - 3)
+            for r in Rating
+        }
+
+    def next_interval(self, s: np.ndarray) -> np.ndarray:
+        new_interval = np.asarray(s) * self.interval_factor
+        return np.clip(np.round(new_interval), 1, self.p.maximum_interval).astype(np.int64)
+
+    def next_review_stabilities(
+        self,
+        last_d: np.ndarray,
+        last_s: np.ndarray,
+        retrievability: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        w = self.w
+        last_s = np.asarray(last_s, dtype=np.float64)
+        one_minus_r = 1 - retrievability
+        scaled_d = self.difficulty_slope * last_d
+
+        # a negative stability is replaced per rating, as in `FSRS`; without
+        # any, the recall term is shared by the three ratings
+        # (11 - d) * s^-w9 * (e^((1-r) * w10) - 1), up to the per-rating d
+        ratings = [Rating.Hard, Rating.Good, Rating.Easy]
+        recall_r = np.expm1(one_minus_r * w[10])
+        unset = last_s < 0
+        if unset.any():
+            stability = {r: np.where(unset, self.init_difficulty(r), last_s) for r in Rating}
+            recall_s = {r: np.power(stability[r], -w[9]) * recall_r for r in ratings}
+        else:
+            stability = dict.fromkeys(Rating, last_s)
+            recall_s = dict.fromkeys(ratings, np.power(last_s, -w[9]) * recall_r)
+
+        stabilities = []
+        for rating in ratings:
+            s = stability[rating]
+            d = np.clip(scaled_d + self.difficulty_offset[rating], 1, 10)
+            stabilities.append(s * (1 + self.recall_coef[rating] * (11 - d) * recall_s[rating]))
+
+        d = np.clip(scaled_d + self.difficulty_offset[Rating.Again], 1, 10)
+        again_s = w[11] * \
+            np.power(d, -w[12]) * \
+            np.expm1(w[13] * np.log1p(stability[Rating.Again])) * \
+            np.exp(one_minus_r * w[14])
+        return (again_s, *stabilities)
+
+
+_kernels: Dict[tuple, FSRSKernel] = {}
+
+
+def get_kernel(p: Parameters = None) -> FSRSKernel:
+    '''One `FSRSKernel` per parameter set, built on first use.'''
+    p = Parameters() if p is None else p
+    key = (p.request_retention, p.maximum_interval, tuple(p.w))
+    if key not in _kernels:
+        _kernels[key] = FSRSKernel(p)
+    return _kernels[key]
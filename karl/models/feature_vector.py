@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, Float, Boolean, String, TIMESTAMP
+from sqlalchemy import Column, ForeignKey, Integer, Float, Boolean, String, TIMESTAMP, Index
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
@@ -97,6 +97,10 @@ class UserCardSnapshotV2(Base):
 
     schedule_request = relationship('ScheduleRequest', back_populates='usercard_snapshots')
 
+    __table_args__ = (
+        Index('ix_usercardsnapshotv2_schedule_request_id_card_id_id', 'schedule_request_id', 'card_id', 'id'),
+    )
+
 
 class UserSnapshotV2(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
@@ -121,6 +125,10 @@ class UserSnapshotV2(Base):
 
     schedule_request = relationship('ScheduleRequest', back_populates='user_snapshots')
 
+    __table_args__ = (
+        Index('ix_usersnapshotv2_schedule_request_id_id', 'schedule_request_id', 'id'),
+    )
+
 
 
 class CardSnapshotV2(Base):
@@ -137,3 +145,7 @@ class CardSnapshotV2(Base):
     previous_study_response = Column(Boolean)
 
     schedule_request = relationship('ScheduleRequest', back_populates='card_snapshots')
+
+    __table_args__ = (
+        Index('ix_cardsnapshotv2_schedule_request_id_card_id_id', 'schedule_request_id', 'card_id', 'id'),
+    )
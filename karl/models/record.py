@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, String, Integer, Float, Boolean, TIMESTAMP, ARRAY, Enum
+from sqlalchemy import Column, ForeignKey, String, Integer, Float, Boolean, TIMESTAMP, ARRAY, Enum, Index
 from sqlalchemy.orm import relationship
 
 from karl.db.base_class import Base
@@ -44,6 +44,12 @@ class StudyRecord(Base):
     card = relationship("Card", back_populates="study_records")
     schedule_request = relationship("ScheduleRequest", back_populates="study_records")
 
+    # used to pair records with their snapshots and to read them in order
+    __table_args__ = (
+        Index('ix_studyrecord_debug_id_card_id_date', 'debug_id', 'card_id', 'date'),
+        Index('ix_studyrecord_user_id_date', 'user_id', 'date'),
+    )
+
 
 class TestRecord(Base):
     id = Column(String, primary_key=True, index=True)  # history_id / front_end_id provided by
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Counterfactual replay of scheduling policies over logged study sessions.
+
+Every logged `ScheduleRequest` is a decision: a candidate list, the card the
+user then studied (the first `StudyRecord` with its `debug_id`) and whether
+it was recalled. Each user's log is replayed in time order, rebuilding the
+user-card vectors from the records in memory exactly as `KARLScheduler`
+updates them, and at each decision every policy ranks the candidates:
+
+- `leitner`, `sm-2`: the most overdue card by their scheduled date,
+- `fsrs`: the earliest FSRS due day, never-studied cards last, as
+  `fsrs_score_recall_batch` with the states of `KARLScheduler.update_fsrs`,
+- `karl`, `karl85`: the card whose predicted recall is closest to the
+  request's recall target (0.85 for `karl85`) within the target window.
+
+Recall of all candidates of a user is predicted in one batch, with the
+shared feature engine and a scorer: the feature-only retention model
+(default) or the model server. Card vectors are the user's own, as in the
+scheduler's test mode, so users are replayed independently and in parallel.
+
+The value of a policy is its expected recall on the card it picks,
+estimated from the logged outcomes with
+
+- `replay`: mean outcome over decisions where the policy picks the logged card,
+- `ips`: inverse propensity scoring,
+- `dm`: direct method, the predicted recall of the picked card,
+- `dr`: doubly robust, `dm` corrected by the `ips` weighted residual.
+
+Logging propensities come from the rank of the logged card under the
+replayed logging policy: P(rank) is estimated per logging policy over all
+decisions. Decisions whose logged card the logging policy would not rank
+(unknown policy, or outside the karl window) use 1 / number of candidates.
+
+    python -m karl.replay --n_workers 16 --output replay.csv
+'''
+
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import requests as http
+
+from karl.config import settings
+from karl.db.session import SessionLocal, engine
+from karl.models import Card, ScheduleRequest, StudyRecord
+from karl.schemas import ParametersSchema
+from karl.fsrs import get_kernel
+from karl.fsrs_models import State, Rating
+from karl.scheduler import KARLScheduler
+from karl.feature_engine import UserVector, UserCardVector, vectors_frame, compute_features, feature_records
+from karl.retention_phase1.backend import served_scores
+
+POLICIES = ['karl', 'karl85', 'fsrs', 'leitner', 'sm-2']
+# due date of never-studied cards in `fsrs_vectors_to_features`
+FSRS_NEVER_DUE = datetime(9999, 12, 31)
+
+_scheduler = KARLScheduler()
+_parameters = json.dumps(ParametersSchema().__dict__)
+
+
+class FeatureScorer:
+    '''
+    Recall predicted by the feature-only retention model, the cheap tier of
+    cascaded scoring, on the served scale like `ServerScorer`.
+    '''
+
+    def __init__(self, model_dir: str = f'{settings.CODE_DIR}/output/retention_features_old_card'):
+        from karl.retention_phase1.model_features import FeatureRetentionModel
+        from karl.retention_phase1.data import feature_fields
+        self.feature_fields = feature_fields
+        self.model = FeatureRetentionModel.from_pretrained(model_dir)
+        self.model.eval()
+        self.mean = np.asarray(torch.load(f'{settings.DATA_DIR}/cached_mean'), dtype=np.float32)
+        self.std = np.asarray(torch.load(f'{settings.DATA_DIR}/cached_std'), dtype=np.float32)
+
+    @torch.inference_mode()
+    def __call__(self, features: pd.DataFrame) -> np.ndarray:
+        x = (features[self.feature_fields].to_numpy(dtype=np.float32) - self.mean) / self.std
+        return served_scores(self.model(torch.from_numpy(x))[0]).numpy()
+
+
+class ServerScorer:
+    '''Recall predicted by the model server, in chunks of `batch_size` cards.'''
+
+    def __init__(self, batch_size: int = 4096):
+        self.batch_size = batch_size
+
+    def __call__(self, features: pd.DataFrame) -> np.ndarray:
+        scores = []
+        for i in range(0, len(features), self.batch_size):
+            response = http.get(
+                f'{settings.MODEL_API_URL}/api/karl/predict',
+                data=json.dumps(feature_records(features.iloc[i: i + self.batch_size])),
+            )
+            response.raise_for_status()
+            scores.extend(json.loads(response.text))
+        return np.asarray(scores, dtype=np.float32)
+
+
+scorers = {
+    'features': FeatureScorer,
+    'server': ServerScorer,
+}
+
+
+def _new_usercard(user_id: str, card_id: str) -> UserCardVector:
+    return UserCardVector(
+        user_id=user_id, card_id=card_id,
+        count_positive=0, count_negative=0, count=0,
+        count_positive_session=0, count_negative_session=0, count_session=0,
+    )
+
+
+def _study(v_user: UserVector, v_usercard: UserCardVector, record) -> None:
+    '''Apply one study record to the in-memory vectors, as `KARLScheduler.update_feature_vectors`.'''
+    date, label = record.date, bool(record.label)
+    delta = None
+    if v_usercard.previous_study_date is not None:
+        delta = (date - v_usercard.previous_study_date).total_seconds()
+    new_session = v_usercard.schedule_request_id is None or v_usercard.schedule_request_id != record.debug_id
+    v_usercard.count_positive += label
+    v_usercard.count_negative += (not label)
+    v_usercard.count += 1
+    v_usercard.previous_delta = delta
+    v_usercard.previous_study_date = date
+    v_usercard.previous_study_response = label
+    if v_usercard.correct_on_first_try is None:
+        v_usercard.correct_on_first_try = label
+    if new_session:
+        v_usercard.count_positive_session = int(label)
+        v_usercard.count_negative_session = int(not label)
+        v_usercard.count_session = 1
+        v_usercard.previous_delta_session = None
+        v_usercard.correct_on_first_try_session = label
+    else:
+        v_usercard.count_positive_session += label
+        v_usercard.count_negative_session += (not label)
+        v_usercard.count_session += 1
+        v_usercard.previous_delta_session = delta
+        if v_usercard.correct_on_first_try_session is None:
+            v_usercard.correct_on_first_try_session = label
+    v_usercard.previous_study_date_session = date
+    v_usercard.previous_study_response_session = label
+    v_usercard.schedule_request_id = record.debug_id
+    _scheduler.update_leitner(v_usercard, label, date)
+    _scheduler.update_sm2(v_usercard, label, date)
+
+    delta = None
+    if v_user.previous_study_date is not None:
+        delta = (date - v_user.previous_study_date).total_seconds()
+    v_user.count_positive += label
+    v_user.count_negative += (not label)
+    v_user.count += 1
+    v_user.previous_delta = delta
+    v_user.previous_study_date = date
+    v_user.previous_study_response = label
+    if v_user.schedule_request_id is None or v_user.schedule_request_id != record.debug_id:
+        v_user.count_positive_session = int(label)
+        v_user.count_negative_session = int(not label)
+        v_user.count_session = 1
+        v_user.previous_delta_session = None
+    else:
+        v_user.count_positive_session += label
+        v_user.count_negative_session += (not label)
+        v_user.count_session += 1
+        v_user.previous_delta_session = delta
+    v_user.previous_study_date_session = date
+    v_user.previous_study_response_session = label
+    v_user.schedule_request_id = record.debug_id
+
+
+def _fsrs_due(study_records: List) -> List[datetime]:
+    '''
+    FSRS due date of the card after each record. A card's state depends only
+    on its own reviews, so the k-th review of every card is one kernel call.
+
+    Stability, difficulty and due date follow the FSRS transition, and the
+    next state is `Review` after a recall and `Learning` after a lapse, as
+    `KARLScheduler.update_fsrs` stores it.
+    '''
+    reviews = {}
+    for i, record in enumerate(study_records):
+        reviews.setdefault(record.card_id, []).append(i)
+    reviews = list(reviews.values())
+    n = len(reviews)
+    state = np.full(n, State.New)
+    stability, difficulty = np.zeros(n), np.zeros(n)
+    last_review = [None] * n
+    due = [None] * len(study_records)
+    for k in range(max(map(len, reviews), default=0)):
+        cards = np.array([j for j in range(n) if len(reviews[j]) > k])
+        records = [study_records[reviews[j][k]] for j in cards]
+        elapsed_days = np.array([
+            0 if last_review[j] is None else (record.date - last_review[j]).days
+            for j, record in zip(cards, records)
+        ])
+        rating = np.array([Rating.Good if record.label else Rating.Again for record in records])
+        _, stability[cards], difficulty[cards], interval = get_kernel().repeat(
+            state[cards], stability[cards], difficulty[cards], elapsed_days, rating)
+        state[cards] = np.where(rating == Rating.Good, State.Review, State.Learning)
+        for j, record, days in zip(cards, records, interval.tolist()):
+            last_review[j] = record.date
+            due[reviews[j][k]] = record.date + timedelta(days=int(days))
+    return due
+
+
+def _days_until(dates: List[datetime], date: datetime) -> np.ndarray:
+    '''Days from `date` to each scheduled date, 0 for cards never scheduled.'''
+    return np.array([0 if x is None else (x - date).total_seconds() / 86400 for x in dates], dtype=np.float64)
+
+
+def _top(keys: np.ndarray) -> int:
+    '''Index of the smallest key, the first one among ties, as a stable sort would put first.'''
+    return int(np.argmin(keys)) if len(keys) > 0 else -1
+
+
+def _rank(keys: np.ndarray, i: int) -> int:
+    '''Position of candidate `i` in a stable ascending sort of `keys`.'''
+    return int((keys < keys[i]).sum() + (keys[:i] == keys[i]).sum())
+
+
+def _karl_keys(recall: np.ndarray, target: float, lowest: float, highest: float) -> np.ndarray:
+    '''Sort keys of the karl policies: distance to the target, inf outside the window.'''
+    keys = np.abs(recall - target)
+    keys[(recall < lowest) | (recall > highest)] = np.inf
+    return keys
+
+
+def replay_user(
+    user_id: str,
+    schedule_requests: List,
+    study_records: List,
+    card_texts: Dict[str, str],
+    scorer: Callable[[pd.DataFrame], np.ndarray],
+    policies: List[str] = POLICIES,
+) -> pd.DataFrame:
+    '''
+    One row per decision of `user_id` with a logged outcome.
+
+    `schedule_requests` and `study_records` are in date order, with the
+    fields of `ScheduleRequest` and `StudyRecord` used here.
+    '''
+    # the outcome of a request is the first card studied from it
+    outcomes = {}
+    for record in study_records:
+        if record.debug_id is not None and record.debug_id not in outcomes:
+            outcomes[record.debug_id] = record
+
+    v_user = UserVector(
+        user_id=user_id, count_positive=0, count_negative=0, count=0,
+        count_positive_session=0, count_negative_session=0, count_session=0,
+        parameters=_parameters,
+    )
+    fsrs_due = _fsrs_due(study_records)
+    usercards, fsrs_cards = {}, {}
+    decisions, v_users, v_usercards, dates, texts = [], [], [], [], []
+    i_record = 0
+    for request in schedule_requests:
+        # everything studied before the request is visible to the policies
+        while i_record < len(study_records) and study_records[i_record].date < request.date:
+            record = study_records[i_record]
+            if record.card_id not in usercards:
+                usercards[record.card_id] = _new_usercard(user_id, record.card_id)
+            _study(v_user, usercards[record.card_id], record)
+            fsrs_cards[record.card_id] = fsrs_due[i_record]
+            i_record += 1
+
+        outcome = outcomes.get(request.id)
+        candidates = list(request.card_ids or [])
+        if outcome is None or outcome.card_id not in candidates:
+            continue
+
+        vectors = [usercards.get(card_id) or _new_usercard(user_id, card_id) for card_id in candidates]
+        decisions.append({
+            'request': request,
+            'outcome': outcome,
+            'logged': candidates.index(outcome.card_id),
+            'offset': len(v_usercards),
+            'leitner': _days_until([v.leitner_scheduled_date for v in vectors], request.date),
+            'sm-2': _days_until([v.sm2_scheduled_date for v in vectors], request.date),
+            'fsrs': np.array([
+                fsrs_cards.get(card_id, FSRS_NEVER_DUE).date().toordinal() for card_id in candidates
+            ], dtype=np.float64),
+        })
+        # copies, the vectors keep changing as the replay goes on
+        v_users.extend([UserVector.of(v_user)] * len(candidates))
+        v_usercards.extend(UserCardVector.of(v) for v in vectors)
+        dates.extend([request.date] * len(candidates))
+        texts.extend(card_texts.get(card_id, '') for card_id in candidates)
+
+    if len(decisions) == 0:
+        return pd.DataFrame()
+
+    # recall of every candidate of every decision in one batch
+    features = compute_features(vectors_frame(v_users, v_usercards, v_usercards, dates, texts))
+    recall = np.asarray(scorer(features), dtype=np.float64)
+
+    rows = []
+    for decision in decisions:
+        request, outcome, logged = decision['request'], decision['outcome'], decision['logged']
+        n_candidates = len(decision['leitner'])
+        r_hat = recall[decision['offset']: decision['offset'] + n_candidates]
+        target = request.recall_target if request.recall_target is not None else 0.85
+        lowest = request.recall_target_lowest if request.recall_target_lowest is not None else 0
+        highest = request.recall_target_highest if request.recall_target_highest is not None else 1
+        keys = {
+            'karl': _karl_keys(r_hat, target, lowest, highest),
+            'karl85': _karl_keys(r_hat, 0.85, lowest, highest),
+            'fsrs': decision['fsrs'],
+            'leitner': decision['leitner'],
+            'sm-2': decision['sm-2'],
+        }
+        logging_policy = getattr(request.repetition_model, 'value', request.repetition_model)
+        logged_rank = np.nan
+        if logging_policy in keys and np.isfinite(keys[logging_policy][logged]):
+            logged_rank = _rank(keys[logging_policy], logged)
+        row = {
+            'user_id': user_id,
+            'request_id': request.id,
+            'date': request.date,
+            'logging_policy': logging_policy,
+            'n_candidates': n_candidates,
+            'card_id': outcome.card_id,
+            'reward': float(bool(outcome.label)),
+            'logged_rank': logged_rank,
+            'logged_recall': r_hat[logged],
+        }
+        for policy in policies:
+            top = _top(keys[policy])
+            acts = top >= 0 and np.isfinite(keys[policy][top])
+            row[f'{policy}_match'] = acts and top == logged
+            row[f'{policy}_recall'] = r_hat[top] if acts else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def load_user_log(session, user_id: str):
+    '''Schedule requests, study records and card texts of one user, in date order.'''
+    schedule_requests = session.query(
+        ScheduleRequest.id,
+        ScheduleRequest.card_ids,
+        ScheduleRequest.date,
+        ScheduleRequest.repetition_model,
+        ScheduleRequest.recall_target,
+        ScheduleRequest.recall_target_lowest,
+        ScheduleRequest.recall_target_highest,
+    ).filter(
+        ScheduleRequest.user_id == user_id,
+        ScheduleRequest.test_mode.is_(None),
+    ).order_by(ScheduleRequest.date).all()
+    study_records = session.query(
+        StudyRecord.debug_id,
+        StudyRecord.card_id,
+        StudyRecord.label,
+        StudyRecord.date,
+    ).filter(
+        StudyRecord.user_id == user_id,
+        StudyRecord.label.isnot(None),
+    ).order_by(StudyRecord.date).all()
+    card_ids = list({card_id for x in schedule_requests for card_id in (x.card_ids or [])})
+    card_texts = {}
+    for i in range(0, len(card_ids), 10000):
+        card_texts.update(session.query(Card.id, Card.text).filter(Card.id.in_(card_ids[i: i + 10000])).all())
+    return schedule_requests, study_records, card_texts
+
+
+_worker_scorer = None
+
+
+def _init_worker(scorer: str):
+    global _worker_scorer
+    # connections of the parent must not be shared with the workers
+    engine.dispose()
+    _worker_scorer = scorers[scorer]()
+
+
+def _replay_chunk(user_ids: List[str], policies: List[str]) -> pd.DataFrame:
+    '''helper for multiprocessing'''
+    session = SessionLocal()
+    decisions = []
+    for user_id in user_ids:
+        schedule_requests, study_records, card_texts = load_user_log(session, user_id)
+        decisions.append(replay_user(user_id, schedule_requests, study_records, card_texts, _worker_scorer, policies))
+    session.close()
+    return pd.concat(decisions, ignore_index=True) if decisions else pd.DataFrame()
+
+
+def propensities(decisions: pd.DataFrame) -> np.ndarray:
+    '''
+    Probability that the logging policy showed the logged card: the share of
+    its decisions whose logged card had the same rank under the replayed
+    policy, or 1 / n_candidates where the rank is unknown.
+    '''
+    ranked = decisions.logged_rank.notna()
+    counts = decisions[ranked].groupby(['logging_policy', 'logged_rank']).size()
+    p_rank = counts / counts.groupby(level=0).transform('sum')
+    keys = pd.MultiIndex.from_arrays([decisions.logging_policy, decisions.logged_rank])
+    p = p_rank.reindex(keys).to_numpy()
+    return np.where(ranked, p, 1 / decisions.n_candidates.to_numpy())
+
+
+def estimate(decisions: pd.DataFrame, policies: List[str] = POLICIES) -> pd.DataFrame:
+    '''Value of each policy under each estimator, over the decisions where the policy picks a card.'''
+    propensity = propensities(decisions)
+    rows = []
+    for policy in policies:
+        acts = decisions[f'{policy}_recall'].notna().to_numpy()
+        match = decisions[f'{policy}_match'].to_numpy(dtype=bool)[acts]
+        reward = decisions.reward.to_numpy()[acts]
+        r_hat = decisions[f'{policy}_recall'].to_numpy()[acts]
+        weight = match / propensity[acts]
+        rows.append({
+            'policy': policy,
+            'n_decisions': int(acts.sum()),
+            'coverage': acts.mean(),
+            'match_rate': match.mean(),
+            'replay': reward[match].mean() if match.any() else np.nan,
+            'ips': (weight * reward).mean(),
+            'dm': r_hat.mean(),
+            'dr': (r_hat + weight * (reward - decisions.logged_recall.to_numpy()[acts])).mean(),
+        })
+    return pd.DataFrame(rows).set_index('policy')
+
+
+def replay(
+    user_ids: List[str] = None,
+    policies: List[str] = POLICIES,
+    scorer: str = 'features',
+    chunk_size: int = 50,
+    n_workers: int = None,
+) -> pd.DataFrame:
+    '''
+    Replay the logs of `user_ids` (all users with schedule requests if None)
+    in chunks of users, in parallel.
+
+    :return: one row per decision; see `estimate` for policy values.
+    '''
+    if user_ids is None:
+        session = SessionLocal()
+        user_ids = [x for x, in session.query(ScheduleRequest.user_id).distinct() if x is not None]
+        session.close()
+    chunks = [user_ids[i: i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+
+    if n_workers == 1 or len(chunks) <= 1:
+        _init_worker(scorer)
+        results = [_replay_chunk(chunk, policies) for chunk in chunks]
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context(settings.MP_CONTEXT),
+            initializer=_init_worker,
+            initargs=(scorer,),
+        )
+        futures = [executor.submit(_replay_chunk, chunk, policies) for chunk in chunks]
+        results = [x.result() for x in futures]
+        executor.shutdown()
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--user_ids', nargs='+')
+    parser.add_argument('--policies', nargs='+', choices=POLICIES, default=POLICIES)
+    parser.add_argument('--scorer', choices=list(scorers.keys()), default='features')
+    parser.add_argument('--chunk_size', type=int, default=50)
+    parser.add_argument('--n_workers', type=int)
+    parser.add_argument('--output', help='csv file for the per-decision replay')
+    args = parser.parse_args()
+
+    t0 = datetime.now()
+    decisions = replay(args.user_ids, args.policies, args.scorer, args.chunk_size, args.n_workers)
+    print(f'{len(decisions)} decisions of {decisions.user_id.nunique() if len(decisions) else 0} users',
+          f'in {(datetime.now() - t0).total_seconds():.1f}s')
+    if len(decisions) > 0:
+        print(estimate(decisions, args.policies).to_string(float_format='%.4f'))
+    if args.output is not None:
+        decisions.to_csv(args.output, index=False)
@@ -3,5 +3,5 @@ from .data import feature_fields
 from .data import get_retention_features_df
 from .data import RetentionFeaturesSchema
 from .data import RetentionInput
-from .model_distilbert import DistilBertRetentionModel
+from .model_distilbert import DistilBertRetentionModel, DistilBertSharedEncoderRetentionModel
 from .model_bert import BertRetentionModel
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+import hashlib
+import logging
+import argparse
+import numpy as np
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+
+from karl.config import settings
+
+logger = logging.getLogger('retention')
+
+
+def model_version(model_dir: str) -> str:
+    '''
+    Short id of the checkpoint in `model_dir`, derived from the size and
+    modification time of its config and weight files.
+    '''
+    h = hashlib.sha1()
+    for name in sorted(os.listdir(model_dir)):
+        if name not in ['config.json', 'pytorch_model.bin', 'model.safetensors']:
+            continue
+        stat = os.stat(f'{model_dir}/{name}')
+        h.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return h.hexdigest()[:12]
+
+
+def get_device(device: str = None) -> torch.device:
+    '''CPU unless `MODEL_DEVICE` asks for something else.'''
+    device = device or settings.MODEL_DEVICE
+    if device.startswith('cuda') and not torch.cuda.is_available():
+        logger.warning(f'{device} requested but not available, falling back to cpu')
+        device = 'cpu'
+    return torch.device(device)
+
+
+def served_scores(probabilities: torch.Tensor) -> torch.Tensor:
+    '''
+    Scores as the model server returns them. The server has always applied a
+    sigmoid on top of the recall probability the models output, so recall
+    targets and windows are set on this scale; it stays until they are
+    recalibrated together.
+    '''
+    return torch.sigmoid(probabilities)
+
+
+def configure_threads(num_threads: int = None) -> None:
+    '''
+    Set the intra-op thread pool size. 0 or None keeps the torch default
+    (one thread per physical core).
+    '''
+    num_threads = num_threads or settings.MODEL_NUM_THREADS
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def quantize(model: nn.Module) -> nn.Module:
+    '''Dynamic int8 quantization of all linear layers. Returns a copy.'''
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def synthetic_batch(
+    batch_size: int,
+    seq_len: int,
+    retention_feature_size: int,
+    vocab_size: int = 30522,
+    seed: int = 1,
+) -> Dict[str, torch.Tensor]:
+    '''Random but well-formed model inputs, for warm-up, parity checks and benchmarks.'''
+    generator = torch.Generator().manual_seed(seed)
+    batch = {
+        'input_ids': torch.randint(vocab_size // 10, vocab_size, (batch_size, seq_len), generator=generator),
+        'attention_mask': torch.ones((batch_size, seq_len), dtype=torch.long),
+    }
+    if retention_feature_size > 0:
+        batch['retention_features'] = torch.randn((batch_size, retention_feature_size), generator=generator)
+    return batch
+
+
+def encoder_precision(model: nn.Module) -> str:
+    '''`int8` for a model returned by `quantize`, `fp32` otherwise.'''
+    quantized = any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in model.modules())
+    return 'int8' if quantized else 'fp32'
+
+
+@torch.inference_mode()
+def check_parity(reference: nn.Module, candidate: nn.Module, batches: List[Dict[str, torch.Tensor]]) -> float:
+    '''Max absolute difference in predicted recall probability.'''
+    diff = 0
+    for xs in batches:
+        y0 = reference(**xs)[0]
+        y1 = candidate(**xs)[0]
+        diff = max(diff, (y0 - y1).abs().max().item())
+    return diff
+
+
+def prepare_for_inference(model: nn.Module, device: torch.device = None, quantization: str = None) -> nn.Module:
+    '''
+    Freeze `model` for serving on `device`. On CPU, `quantization='int8'`
+    swaps in a dynamically quantized copy, provided its predictions stay
+    within `MODEL_PARITY_TOLERANCE` of the fp32 model on a synthetic batch;
+    otherwise the fp32 model is kept.
+    '''
+    device = device or get_device()
+    quantization = quantization or settings.MODEL_QUANTIZE
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
+
+    if quantization == 'int8' and device.type == 'cpu':
+        quantized = quantize(model)
+        quantized.eval()
+        batch = synthetic_batch(16, 64, model.config.retention_feature_size, model.config.vocab_size)
+        diff = check_parity(model, quantized, [batch])
+        if diff <= settings.MODEL_PARITY_TOLERANCE:
+            logger.info(f'using int8 model, max diff from fp32 {diff:.4f}')
+            model = quantized
+        else:
+            logger.warning(f'int8 model off by {diff:.4f} from fp32, keeping fp32')
+
+    return model.to(device)
+
+
+def benchmark(n_cards: int = 1000, seq_len: int = 64, n_runs: int = 5, target_ms: float = None):
+    '''Latency of `RetentionModel`'s old-card model on `n_cards` synthetic cards, fp32 vs int8.'''
+    from karl.retention_phase1.model_distilbert import DistilBertRetentionModel
+
+    configure_threads()
+    model_dir = f'{settings.CODE_DIR}/output/retention_hf_distilbert_old_card'
+    fp32 = prepare_for_inference(DistilBertRetentionModel.from_pretrained(model_dir), quantization='none')
+    int8 = quantize(fp32)
+    batch_size = settings.MODEL_MAX_BATCH_SIZE
+    batches = [
+        synthetic_batch(min(batch_size, n_cards - i), seq_len, fp32.config.retention_feature_size, fp32.config.vocab_size, seed=i)
+        for i in range(0, n_cards, batch_size)
+    ]
+
+    print('max diff int8 vs fp32', '%.4f' % check_parity(fp32, int8, batches))
+    for name, model in [('fp32', fp32), ('int8', int8)]:
+        latencies = []
+        with torch.inference_mode():
+            for _ in range(n_runs):
+                t0 = time.perf_counter()
+                for xs in batches:
+                    model(**xs)
+                latencies.append((time.perf_counter() - t0) * 1000)
+        latency = np.median(latencies)
+        status = '' if target_ms is None else (' OK' if latency <= target_ms else ' over target')
+        print(f'{name} {n_cards} cards x {seq_len} tokens: {latency:.1f} ms{status}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_cards', type=int, default=1000)
+    parser.add_argument('--seq_len', type=int, default=64)
+    parser.add_argument('--n_runs', type=int, default=5)
+    parser.add_argument('--target_ms', type=float)
+    args = parser.parse_args()
+    benchmark(args.n_cards, args.seq_len, args.n_runs, args.target_ms)
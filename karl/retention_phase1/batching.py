@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Tuple
+
+
+@dataclass
+class _PendingRequest:
+    items: List[Any]
+    future: Future = field(default_factory=Future)
+
+
+class MicroBatcher:
+    '''
+    Merges predictions from concurrent requests into shared forward passes.
+
+    Each call to `predict` enqueues its items and blocks. A single worker
+    thread takes the first pending request, keeps collecting until either
+    `max_wait_ms` has passed or `max_batch_size` items are queued, runs
+    `predict_fn` once on the concatenation and scatters the outputs back to
+    the callers in order.
+
+    The worker thread is started lazily in the process that first submits, so
+    a batcher created before the server forks its workers is safe to use.
+    '''
+
+    def __init__(
+        self,
+        predict_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 256,
+        max_wait_ms: float = 5,
+    ):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+
+    def submit(self, items: List[Any]) -> Future:
+        self._ensure_worker()
+        request = _PendingRequest(list(items))
+        if len(request.items) == 0:
+            request.future.set_result([])
+        else:
+            self._queue.put(request)
+        return request.future
+
+    def predict(self, items: List[Any]) -> List[Any]:
+        return self.submit(items).result()
+
+    def _collect(self, requests: queue.Queue) -> List[_PendingRequest]:
+        batch = [requests.get()]
+        size = len(batch[0].items)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.items)
+        return batch
+
+    def _run(self, requests: queue.Queue):
+        while True:
+            batch = self._collect(requests)
+            items = [x for request in batch for x in request.items]
+            try:
+                outputs = self.predict_fn(items)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            offset = 0
+            for request in batch:
+                request.future.set_result(outputs[offset: offset + len(request.items)])
+                offset += len(request.items)
+
+
+def length_bucketed_batches(lengths: List[int], batch_size: int, max_tokens: int = None) -> List[List[int]]:
+    '''
+    Group example indices into batches of similar length, so that padding
+    each batch to its own longest example wastes little compute.
+
+    Indices are sorted by length and cut into consecutive batches of at most
+    `batch_size` examples and, if given, at most `max_tokens` padded tokens.
+    Callers scatter results back by index to restore the original order.
+    '''
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for i in order:
+        # lengths are non-decreasing, so the current one is the batch max
+        if len(batch) > 0 and (
+            len(batch) == batch_size
+            or (max_tokens is not None and (len(batch) + 1) * lengths[i] > max_tokens)
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def pad_to_longest(sequences: List[List[int]], pad_token_id: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    '''Right-pad token id sequences to the longest one. Returns (input_ids, attention_mask).'''
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    attention_mask = np.arange(lengths.max()) < lengths[:, None]
+    input_ids = np.full(attention_mask.shape, pad_token_id, dtype=np.int64)
+    # row-major boolean assignment fills each row's prefix in order
+    input_ids[attention_mask] = np.concatenate(sequences)
+    return input_ids, attention_mask.astype(np.int64)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Model tables, datasets and metrics shared by the training and evaluation
+scripts (`main`, `train_frozen`, `distributed`, `online`, `evaluate`).
+'''
+
+import random
+import numpy as np
+from typing import Dict
+
+import torch
+from transformers import DistilBertTokenizerFast, BertTokenizerFast, EvalPrediction
+from sklearn.metrics import roc_auc_score, accuracy_score
+from sklearn.calibration import calibration_curve
+
+from karl.config import settings
+from .data import RetentionDataset, SharedEncoderRetentionDataset, retention_data_collator
+from .model_distilbert import DistilBertRetentionModelConfig, DistilBertRetentionModel, DistilBertSharedEncoderRetentionModel
+from .model_bert import BertRetentionModelConfig, BertRetentionModel
+
+model_cls = {
+    'distilbert': DistilBertRetentionModel,
+    'distilbert_shared': DistilBertSharedEncoderRetentionModel,
+    'bert': BertRetentionModel,
+}
+config_cls = {
+    'distilbert': DistilBertRetentionModelConfig,
+    'distilbert_shared': DistilBertRetentionModelConfig,
+    'bert': BertRetentionModelConfig,
+}
+tokenizer_cls = {
+    'distilbert': DistilBertTokenizerFast,
+    'distilbert_shared': DistilBertTokenizerFast,
+    'bert': BertTokenizerFast,
+}
+full_name = {
+    'distilbert': 'distilbert-base-uncased',
+    'distilbert_shared': 'distilbert-base-uncased',
+    'bert': 'bert-base-uncased',
+}
+
+
+def set_seed(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    # ^^ safe to call this function even if cuda is not available
+
+
+def compute_metrics(p: EvalPrediction) -> Dict:
+    predicted_labels = p.predictions > 0.5
+    acc = accuracy_score(p.label_ids, predicted_labels)
+    auc = roc_auc_score(p.label_ids, p.predictions)
+    prob_true, prob_pred = calibration_curve(p.label_ids, p.predictions, n_bins=10)
+    ece = np.mean(np.absolute(prob_true - prob_pred))
+    return {
+        "acc": acc,
+        "auc": auc,
+        "ece": ece,
+    }
+
+
+def get_datasets(fold, tokenizer):
+    '''
+    Train and test datasets plus their collator. Fold `all` holds both new
+    and old cards, for models with a shared encoder.
+    '''
+    if fold == 'all':
+        train_dataset = SharedEncoderRetentionDataset(settings.DATA_DIR, 'train', tokenizer)
+        test_dataset = SharedEncoderRetentionDataset(settings.DATA_DIR, 'test', tokenizer)
+        return train_dataset, test_dataset, retention_data_collator
+    train_dataset = RetentionDataset(settings.DATA_DIR, f'train_{fold}', tokenizer)
+    test_dataset = RetentionDataset(settings.DATA_DIR, f'test_{fold}', tokenizer)
+    return train_dataset, test_dataset, retention_data_collator
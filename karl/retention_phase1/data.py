@@ -3,25 +3,31 @@
 
 import os
 import json
-import pytz
+import hashlib
+import argparse
+import operator
+import itertools
 import dataclasses
-import multiprocessing
 import pandas as pd
 import numpy as np
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from pydantic import BaseModel
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 from dataclasses import dataclass
-from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func, and_
 from sqlalchemy.orm import Session
 
 import torch
 from transformers import DistilBertTokenizerFast
 
-from karl.db.session import SessionLocal, engine
+from karl.db.session import SessionLocal
 from karl.config import settings
-from karl.models import User, Card, UserCardSnapshotV2, UserSnapshotV2, CardSnapshotV2, UserCardFeatureVector
+from karl.models import Card, StudyRecord, UserCardSnapshotV2, UserSnapshotV2, CardSnapshotV2, UserCardFeatureVector
 from karl.schemas import VUserCard, VUser, VCard
+from karl.feature_engine import vectors_frame, compute_features, feature_records
+from karl.retention_phase1.batching import pad_to_longest
+from karl.retention_phase1 import feature_store
+from karl.retention_phase1.token_cache import TokenCache
 
 
 class RetentionFeaturesSchema(BaseModel):
@@ -62,12 +68,33 @@ class RetentionFeaturesSchema(BaseModel):
 class FSRSFeaturesSchema(BaseModel):
     fsrs_scheduled_date: datetime
 
+# `feature_engine` version this schema corresponds to
+FEATURE_VERSION = 'v1'
+
 feature_fields = [
     field_name for field_name, field_info in RetentionFeaturesSchema.__fields__.items()
     if field_info.type_ in [int, float, bool]
     and field_name != 'is_new_fact'
 ]
 
+
+def feature_matrix(
+    feature_vectors: List[RetentionFeaturesSchema],
+    fields: List[str] = feature_fields,
+) -> np.ndarray:
+    '''
+    (len(feature_vectors), len(fields)) float32 matrix of `fields`, read in one
+    pass with no intermediate per-row lists.
+    '''
+    getter = operator.attrgetter(*fields)
+    if len(fields) == 1:
+        values = map(getter, feature_vectors)
+    else:
+        values = itertools.chain.from_iterable(map(getter, feature_vectors))
+    matrix = np.fromiter(values, dtype=np.float32, count=len(feature_vectors) * len(fields))
+    return matrix.reshape(len(feature_vectors), len(fields))
+
+
 def fsrs_vectors_to_features(
     v_usercard: UserCardFeatureVector,
 ) -> FSRSFeaturesSchema:
@@ -86,137 +113,416 @@ def vectors_to_features(
     card_text: str,
     elapsed_milliseconds: int = 0,
 ) -> RetentionFeaturesSchema:
-    if v_usercard.previous_study_date is not None:
-        usercard_delta = (date - v_usercard.previous_study_date).total_seconds() // 3600
-    else:
-        usercard_delta = 0
-    if v_usercard.leitner_scheduled_date is not None:
-        delta_to_leitner_scheduled_date = (v_usercard.leitner_scheduled_date - date).total_seconds() // 3600
-    else:
-        delta_to_leitner_scheduled_date = 0
-    if v_usercard.sm2_scheduled_date is not None:
-        delta_to_sm2_scheduled_date = (v_usercard.sm2_scheduled_date - date).total_seconds() // 3600
-    else:
-        delta_to_sm2_scheduled_date = 0
-    return RetentionFeaturesSchema(
-        user_id=v_usercard.user_id,
-        card_id=v_usercard.card_id,
-        card_text=card_text,
-        is_new_fact=(v_usercard.correct_on_first_try is None),
-        user_n_study_positive=v_user.count_positive,
-        user_n_study_negative=v_user.count_negative,
-        user_n_study_total=v_user.count,
-        card_n_study_positive=v_card.count_positive,
-        card_n_study_negative=v_card.count_negative,
-        card_n_study_total=v_card.count,
-        usercard_n_study_positive=v_usercard.count_positive,
-        usercard_n_study_negative=v_usercard.count_negative,
-        usercard_n_study_total=v_usercard.count,
-        acc_user=0 if v_user.count == 0 else v_user.count_positive / v_user.count,
-        acc_card=0 if v_card.count == 0 else v_card.count_positive / v_card.count,
-        acc_usercard=0 if v_usercard.count == 0 else v_usercard.count_positive / v_usercard.count,
-        usercard_delta=usercard_delta or 0,
-        usercard_delta_previous=v_usercard.previous_delta or 0,
-        usercard_previous_study_response=v_usercard.previous_study_response or False,
-        leitner_box=v_usercard.leitner_box or 0,
-        sm2_efactor=v_usercard.sm2_efactor or 0,
-        sm2_interval=v_usercard.sm2_interval or 0,
-        sm2_repetition=v_usercard.sm2_repetition or 0,
-        delta_to_leitner_scheduled_date=delta_to_leitner_scheduled_date,
-        delta_to_sm2_scheduled_date=delta_to_sm2_scheduled_date,
-        repetition_model=json.loads(v_user.parameters)['repetition_model'],
-        correct_on_first_try=v_usercard.correct_on_first_try or False,
-        elapsed_milliseconds=elapsed_milliseconds,
-        utc_datetime=date.astimezone(pytz.utc),
-        utc_date=date.astimezone(pytz.utc).date(),
+    rows = vectors_frame([v_user], [v_card], [v_usercard], [date], [card_text], [elapsed_milliseconds])
+    return RetentionFeaturesSchema(**compute_features(rows, FEATURE_VERSION).iloc[0].to_dict())
+
+
+def vectors_to_feature_records(
+    v_user: VUser,
+    v_cards: List[VCard],
+    v_usercards: List[VUserCard],
+    date: datetime,
+    card_texts: List[str],
+) -> List[dict]:
+    '''
+    `vectors_to_features` of one user and many cards at once, as the JSON-ready
+    dicts the model server takes.
+    '''
+    rows = vectors_frame(v_user, v_cards, v_usercards, date, card_texts)
+    return feature_records(compute_features(rows, FEATURE_VERSION))
+
+
+def _retention_features_query(session: Session, since: datetime = None):
+    '''
+    Study records joined to the snapshots saved with them, one row per record.
+
+    Every update saves one user, card and user-card snapshot under the
+    record's schedule request. So the k-th record of a schedule request pairs
+    with its k-th user snapshot, and the k-th record of a card within the
+    request with the k-th card and user-card snapshots of that card, in
+    insertion order. Snapshots only carry the request's date, so there is no
+    key to pair them on: where a request (or a card within it) has a
+    different number of records and snapshots, e.g. a snapshot failed to
+    save, ranks do not line up and its records are dropped.
+
+    With `since`, only records after it are returned. Ranks are still taken
+    over whole schedule requests, so only requests with such records are
+    scanned.
+    '''
+    if since is not None:
+        schedule_request_ids = session.query(StudyRecord.debug_id).filter(StudyRecord.date > since)
+
+    def within_requests(query, column):
+        if since is None:
+            return query
+        return query.filter(column.in_(schedule_request_ids))
+
+    records = session.query(
+        StudyRecord.id.label('record_id'),
+        StudyRecord.debug_id,
+        StudyRecord.user_id,
+        StudyRecord.card_id,
+        StudyRecord.label,
+        StudyRecord.date,
+        StudyRecord.elapsed_milliseconds_text,
+        StudyRecord.elapsed_milliseconds_answer,
+        func.row_number().over(
+            partition_by=StudyRecord.debug_id,
+            order_by=(StudyRecord.date, StudyRecord.id),
+        ).label('user_rank'),
+        func.row_number().over(
+            partition_by=(StudyRecord.debug_id, StudyRecord.card_id),
+            order_by=(StudyRecord.date, StudyRecord.id),
+        ).label('card_rank'),
+        func.count().over(partition_by=StudyRecord.debug_id).label('user_n'),
+        func.count().over(partition_by=(StudyRecord.debug_id, StudyRecord.card_id)).label('card_n'),
+    ).filter(
+        StudyRecord.user_id.regexp_match('^[0-9]+$'),
+    )
+    records = within_requests(records, StudyRecord.debug_id).subquery()
+
+    def ranked(model, partition_by, columns):
+        query = session.query(
+            model.schedule_request_id,
+            *[c.label(f'{prefix}{c.key}') for prefix, c in columns],
+            func.row_number().over(partition_by=partition_by, order_by=model.id).label('rank'),
+            func.count().over(partition_by=partition_by).label('n'),
+        )
+        return within_requests(query, model.schedule_request_id).subquery()
+
+    user_snapshots = ranked(UserSnapshotV2, UserSnapshotV2.schedule_request_id, [
+        ('user_', c) for c in [
+            UserSnapshotV2.count_positive,
+            UserSnapshotV2.count_negative,
+            UserSnapshotV2.count,
+            UserSnapshotV2.parameters,
+        ]
+    ])
+    card_snapshots = ranked(CardSnapshotV2, (CardSnapshotV2.schedule_request_id, CardSnapshotV2.card_id), [
+        ('', CardSnapshotV2.card_id),
+    ] + [
+        ('card_', c) for c in [
+            CardSnapshotV2.count_positive,
+            CardSnapshotV2.count_negative,
+            CardSnapshotV2.count,
+        ]
+    ])
+    usercard_snapshots = ranked(
+        UserCardSnapshotV2, (UserCardSnapshotV2.schedule_request_id, UserCardSnapshotV2.card_id), [
+            ('', UserCardSnapshotV2.card_id),
+        ] + [
+            ('usercard_', c) for c in [
+                UserCardSnapshotV2.count_positive,
+                UserCardSnapshotV2.count_negative,
+                UserCardSnapshotV2.count,
+                UserCardSnapshotV2.previous_delta,
+                UserCardSnapshotV2.previous_study_date,
+                UserCardSnapshotV2.previous_study_response,
+                UserCardSnapshotV2.leitner_box,
+                UserCardSnapshotV2.leitner_scheduled_date,
+                UserCardSnapshotV2.sm2_efactor,
+                UserCardSnapshotV2.sm2_interval,
+                UserCardSnapshotV2.sm2_repetition,
+                UserCardSnapshotV2.sm2_scheduled_date,
+                UserCardSnapshotV2.correct_on_first_try,
+            ]
+        ])
+
+    query = session.query(
+        records,
+        *[c for c in user_snapshots.c if c.key.startswith('user_')],
+        *[c for c in card_snapshots.c if c.key.startswith('card_') and c.key != 'card_id'],
+        *[c for c in usercard_snapshots.c if c.key.startswith('usercard_')],
+        Card.text.label('card_text'),
+        Card.deck_id,
+        Card.deck_name,
+    ).join(
+        user_snapshots, and_(
+            user_snapshots.c.schedule_request_id == records.c.debug_id,
+            user_snapshots.c.rank == records.c.user_rank,
+            user_snapshots.c.n == records.c.user_n,
+        )
+    ).join(
+        card_snapshots, and_(
+            card_snapshots.c.schedule_request_id == records.c.debug_id,
+            card_snapshots.c.card_id == records.c.card_id,
+            card_snapshots.c.rank == records.c.card_rank,
+            card_snapshots.c.n == records.c.card_n,
+        )
+    ).join(
+        usercard_snapshots, and_(
+            usercard_snapshots.c.schedule_request_id == records.c.debug_id,
+            usercard_snapshots.c.card_id == records.c.card_id,
+            usercard_snapshots.c.rank == records.c.card_rank,
+            usercard_snapshots.c.n == records.c.card_n,
+        )
+    ).join(
+        Card, Card.id == records.c.card_id
+    ).filter(
+        # unlabeled records still have snapshots, so they are dropped only
+        # after pairing
+        records.c.label.isnot(None)
+    )
+    if since is not None:
+        query = query.filter(records.c.date > since)
+    return query.order_by(
+        records.c.user_id, records.c.date, records.c.record_id
     )
 
 
-def _get_user_features(
-    user_id: str,
-    session: Session = SessionLocal()
-):
-    user = session.query(User).get(user_id)
-    record_ids, features, labels = [], [], []
-    for record in user.records:
-        if record.response is None:
-            continue
-        v_user = session.query(UserSnapshotV2).get(record.id)
-        v_card = session.query(CardSnapshotV2).get(record.id)
-        v_usercard = session.query(UserCardSnapshotV2).get(record.id)
-        if v_user is None or v_card is None or v_usercard is None:
-            continue
-        v_user = VUser(**v_user.__dict__)
-        v_card = VCard(**v_card.__dict__)
-        v_usercard = VUserCard(**v_usercard.__dict__)
-        elapsed_milliseconds = record.elapsed_milliseconds_text + record.elapsed_milliseconds_answer
-        features.append(vectors_to_features(v_usercard, v_user, v_card, record.date, record.card.text, elapsed_milliseconds))
-        labels.append(record.response)
-        record_ids.append(record.id)
+def _snapshots_to_features(rows: pd.DataFrame) -> pd.DataFrame:
+    '''Features of a frame of `_retention_features_query` rows, plus the response and record columns.'''
+    rows = rows.assign(
+        elapsed_milliseconds=rows.elapsed_milliseconds_text.fillna(0) + rows.elapsed_milliseconds_answer.fillna(0),
+    )
+    df = compute_features(rows, FEATURE_VERSION)
+    df['response'] = rows.label.astype(bool)
+    df['record_id'] = rows.record_id
+    df['deck_id'] = rows.deck_id
+    df['deck_name'] = rows.deck_name
+    return df
+
+
+def _read_retention_features(since: datetime = None, chunk_size: int = 100000) -> pd.DataFrame:
+    '''Features of the records after `since` (all if None) in (user, date) order, without `n_minutes_spent`.'''
+    # one set-based query, streamed with a server-side cursor and converted
+    # chunk by chunk
+    session = SessionLocal()
+    result = session.execute(
+        _retention_features_query(session, since).statement,
+        execution_options={'stream_results': True},
+    )
+    columns = list(result.keys())
+    chunks = [
+        _snapshots_to_features(pd.DataFrame.from_records(rows, columns=columns))
+        for rows in result.partitions(chunk_size)
+    ]
     session.close()
-    return record_ids, features, labels
+    if len(chunks) == 0:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
 
 
-def get_retention_features_df(overwrite: bool = False):
-    df_path = f'{settings.DATA_DIR}/retention_features.h5'
-    if not overwrite and os.path.exists(df_path):
-        df = pd.read_hdf(df_path, 'df')
-    else:
-        session = SessionLocal()
-        # gather features
-        futures = []
-        executor = ProcessPoolExecutor(
-            mp_context=multiprocessing.get_context(settings.MP_CONTEXT),
-            initializer=engine.dispose,
-        )
-        for user in session.query(User):
-            if not user.id.isdigit() or len(user.records) == 0:
-                continue
-            futures.append(executor.submit(_get_user_features, user.id))
-
-        record_ids, features, labels = [], [], []
-        for future in futures:
-            f0, f1, f2 = future.result()
-            record_ids.extend(f0)
-            features.extend(f1)
-            labels.extend(f2)
-
-        card_to_deck_id = {}
-        card_to_deck_name = {}
-        for card in session.query(Card):
-            card_to_deck_id[card.id] = card.deck_id
-            card_to_deck_name[card.id] = card.deck_name
-
-        df = []
-        for record_id, feature, label in zip(record_ids, features, labels):
-            row = feature.__dict__
-            row['response'] = label
-            row['record_id'] = record_id
-            row['deck_id'] = card_to_deck_id.get(row['card_id'], None)
-            row['deck_name'] = card_to_deck_name.get(row['card_id'], None)
-            df.append(row)
-
-        df = pd.DataFrame(df)
+def _add_minutes_spent(df: pd.DataFrame, user_ids=None) -> pd.DataFrame:
+    '''(Re)compute the per-user running total `n_minutes_spent`, for `user_ids` only if given.'''
+    if user_ids is None:
         df['n_minutes_spent'] = df.groupby('user_id')['elapsed_milliseconds'].cumsum() // 60000
-        df.to_hdf(df_path, key='df', mode='w')
-        session.close()
-
+    else:
+        rows = df.user_id.isin(user_ids)
+        df.loc[rows, 'n_minutes_spent'] = df[rows].groupby('user_id')['elapsed_milliseconds'].cumsum() // 60000
+        df['n_minutes_spent'] = df.n_minutes_spent.astype('int64')
     return df
 
 
+def _refresh_retention_features(since: datetime, chunk_size: int) -> datetime:
+    '''
+    Add the records after `since` to the feature store, rewriting only the
+    partitions whose rows change.
+
+    :return: date of the newest record added, None if there was none.
+    '''
+    df_new = _read_retention_features(since, chunk_size)
+    if len(df_new) > 0:
+        seen = feature_store.load_features(columns=['record_id'], date_start=since)
+        df_new = df_new[~df_new.record_id.isin(seen.record_id)]
+    print(f'{len(df_new)} new records since {since}')
+    if len(df_new) == 0:
+        return None
+
+    # full history of the users with new records, to redo their running totals
+    user_ids = df_new.user_id.unique()
+    df_users = pd.concat([feature_store.load_features(user_ids=user_ids), df_new], ignore_index=True)
+    df_users = df_users.sort_values(['user_id', 'utc_datetime', 'record_id'], kind='mergesort', ignore_index=True)
+    df_users = _add_minutes_spent(df_users)
+
+    # only rows at or after the earliest new record can change
+    first_new = df_new.groupby('user_id').utc_datetime.min()
+    changed = df_users[df_users.utc_datetime >= df_users.user_id.map(first_new)]
+    partitions = feature_store.partitions_of(changed)
+    df_partitions = feature_store.load_partitions(partitions)
+    if len(df_partitions) > 0:
+        df_partitions = df_partitions[~df_partitions.user_id.isin(user_ids)]
+    feature_store.write_features(pd.concat([df_partitions, df_users], ignore_index=True), partitions=partitions)
+    return df_new.utc_datetime.max()
+
+
+def get_retention_features_df(
+    overwrite: bool = False,
+    refresh: bool = False,
+    chunk_size: int = 100000,
+    lookback: timedelta = timedelta(hours=1),
+    **kwargs,
+):
+    '''
+    Features of all labeled study records, cached in the partitioned
+    `feature_store`. Extra arguments go to `feature_store.load_features`, so
+    callers can read only some columns, users or dates.
+
+    :param overwrite: recompute everything.
+    :param refresh: add the records that arrived since the last run. The
+        date of the newest record seen is kept in
+        `retention_features_watermark.json`; records up to `lookback` older
+        than that are re-read in case they were committed late, and
+        `n_minutes_spent` is recomputed for the users that got new records.
+    '''
+    watermark_path = f'{settings.DATA_DIR}/retention_features_watermark.json'
+    legacy_path = f'{settings.DATA_DIR}/retention_features.h5'
+    if not overwrite and not feature_store.exists() and os.path.exists(legacy_path):
+        # one-off conversion of the old single-file cache
+        feature_store.write_features(pd.read_hdf(legacy_path, 'df'))
+
+    watermark = None
+    if feature_store.exists() and not overwrite:
+        if not refresh:
+            return feature_store.load_features(**kwargs)
+        if os.path.exists(watermark_path):
+            with open(watermark_path) as f:
+                watermark = datetime.fromisoformat(json.load(f)['date'])
+
+    if watermark is not None:
+        newest = _refresh_retention_features(watermark - lookback, chunk_size)
+        watermark = max(watermark, newest) if newest is not None else watermark
+    else:
+        df = _add_minutes_spent(_read_retention_features(chunk_size=chunk_size))
+        feature_store.write_features(df)
+        watermark = df.utc_datetime.max() if len(df) > 0 else None
+
+    if watermark is not None:
+        with open(watermark_path, 'w') as f:
+            json.dump({'date': watermark.isoformat()}, f)
+    return feature_store.load_features(**kwargs)
+
+
 @dataclass(frozen=True)
 class RetentionInput:
     input_ids: List[int]
     attention_mask: Optional[List[int]] = None
     retention_features: Optional[List[float]] = None
     label: Optional[int] = None
+    is_new_card: Optional[int] = None
 
     def to_json_string(self):
         """Serializes this instance to a JSON string."""
         return json.dumps(dataclasses.asdict(self)) + "\n"
 
 
+folds = ['train_new_card', 'train_old_card', 'test_new_card', 'test_old_card']
+
+
+def _user_positions(df: pd.DataFrame) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    `df` ordered by user (stable, so each user's records keep their
+    chronological order), with masks of new and old cards, and for every
+    record its position among the user's new or old cards and the number of
+    those.
+    '''
+    df = df.sort_values('user_id', kind='mergesort', ignore_index=True)
+    is_new_card = (df.is_new_fact == True).to_numpy()  # noqa: E712
+    is_old_card = (df.is_new_fact == False).to_numpy()  # noqa: E712
+    groups = df.groupby([is_new_card, df.user_id.to_numpy()], sort=False)
+    rank = groups.cumcount().to_numpy()
+    size = groups.user_id.transform('size').to_numpy()
+    return df, is_new_card, is_old_card, rank, size
+
+
+def _folds_of(df, is_new_card, is_old_card, is_train, is_test) -> Dict[str, pd.DataFrame]:
+    return {
+        'train_new_card': df[is_train & is_new_card].reset_index(drop=True),
+        'train_old_card': df[is_train & is_old_card].reset_index(drop=True),
+        'test_new_card': df[is_test & is_new_card].reset_index(drop=True),
+        'test_old_card': df[is_test & is_old_card].reset_index(drop=True),
+    }
+
+
+def split_folds(df: pd.DataFrame, train_fraction: float = 0.75) -> Dict[str, pd.DataFrame]:
+    '''
+    The four `folds` of the retention features DataFrame, in one pass.
+
+    New and old cards are split separately: for each user, the first
+    `train_fraction` of their records (rounded down) go to train and the
+    rest to test. Each fold is ordered by user, then chronologically.
+    '''
+    df, is_new_card, is_old_card, rank, size = _user_positions(df)
+    is_train = rank < np.floor(size * train_fraction)
+    return _folds_of(df, is_new_card, is_old_card, is_train, ~is_train)
+
+
+def time_series_folds(df: pd.DataFrame, n_splits: int = 3) -> List[Dict[str, pd.DataFrame]]:
+    '''
+    Expanding-window k-fold by time. Each user's new and old cards are cut
+    into `n_splits + 1` chronological blocks of (nearly) equal size; split
+    `k` trains on blocks `0..k` and tests on block `k + 1`.
+    '''
+    df, is_new_card, is_old_card, rank, size = _user_positions(df)
+    block = rank * (n_splits + 1) // size
+    return [
+        _folds_of(df, is_new_card, is_old_card, block <= k, block == k + 1)
+        for k in range(n_splits)
+    ]
+
+
+def _fold_dir(data_dir: str, fold: str) -> str:
+    return f'{data_dir}/cached_{fold}_mmap'
+
+
+def features_version(df: pd.DataFrame) -> str:
+    '''Short id of a retention features DataFrame, from its number of rows and newest record.'''
+    newest = df.utc_datetime.max().isoformat() if len(df) > 0 else None
+    return hashlib.sha1(f'{len(df)}:{newest}'.encode()).hexdigest()[:12]
+
+
+def _save_fold(
+    fold_dir: str,
+    input_ids: np.ndarray,
+    offsets: np.ndarray,
+    labels: np.ndarray,
+    retention_features: np.ndarray = None,
+    pad_token_id: int = 0,
+    card_ids: List[str] = None,
+    record_ids: List[str] = None,
+    data_version: str = None,
+) -> None:
+    '''
+    Write one fold as flat arrays: token ids of all examples back to back
+    with their offsets, labels, and retention features if any. With
+    `card_ids`, the card of each example is stored as an index into the
+    fold's unique card ids, and with `record_ids`, the study record of each
+    example. `meta.json` goes last, with the `features_version` the fold was
+    built from, and marks the fold as complete.
+    '''
+    os.makedirs(fold_dir, exist_ok=True)
+    lengths = np.diff(offsets)
+    np.save(f'{fold_dir}/input_ids.npy', input_ids.astype(np.int32))
+    np.save(f'{fold_dir}/offsets.npy', offsets.astype(np.int64))
+    np.save(f'{fold_dir}/labels.npy', labels.astype(np.int8))
+    if retention_features is not None:
+        np.save(f'{fold_dir}/retention_features.npy', retention_features.astype(np.float32))
+    if card_ids is not None:
+        card_index, unique_card_ids = pd.factorize(pd.Series(card_ids, dtype=object))
+        np.save(f'{fold_dir}/card_index.npy', card_index.astype(np.int64))
+        with open(f'{fold_dir}/card_ids.json', 'w') as f:
+            json.dump(unique_card_ids.tolist(), f)
+    if record_ids is not None:
+        with open(f'{fold_dir}/record_ids.json', 'w') as f:
+            json.dump(list(record_ids), f)
+    with open(f'{fold_dir}/meta.json', 'w') as f:
+        json.dump({
+            'n_examples': len(lengths),
+            'max_length': int(lengths.max()) if len(lengths) > 0 else 0,
+            'pad_token_id': pad_token_id,
+            'data_version': data_version,
+        }, f)
+
+
 class RetentionDataset(torch.utils.data.Dataset):
+    '''
+    One fold of study records, memory-mapped from the flat arrays written by
+    `_save_fold`. Nothing is loaded up front; each example is a slice of the
+    token buffer, unpadded, and `retention_data_collator` pads each batch to
+    its own longest example. `lengths` lets a sampler group examples of
+    similar length into the same batch, `card_index` maps each example
+    to its card in `card_ids`, and `record_ids` gives its study record.
+    '''
 
     def __init__(
         self,
@@ -226,88 +532,146 @@ class RetentionDataset(torch.utils.data.Dataset):
         overwrite_cached_data: bool = False,
         overwrite_retention_features_df: bool = False,
     ):
-        if (
-            os.path.exists(f'{data_dir}/cached_train_new_card')
-            and os.path.exists(f'{data_dir}/cached_train_old_card')
-            and os.path.exists(f'{data_dir}/cached_test_new_card')
-            and os.path.exists(f'{data_dir}/cached_test_old_card')
-        ) and not overwrite_cached_data:
-            inputs = {
-                'train_new_card': torch.load(f'{data_dir}/cached_train_new_card'),
-                'train_old_card': torch.load(f'{data_dir}/cached_train_old_card'),
-                'test_new_card': torch.load(f'{data_dir}/cached_test_new_card'),
-                'test_old_card': torch.load(f'{data_dir}/cached_test_old_card'),
-            }
-        else:
-            # gather features
-            print('gather features')
-            df_all = get_retention_features_df(overwrite_retention_features_df)
-
-            # separate new and old cards
-            df_new_card = df_all[df_all.is_new_fact == True]  # noqa: E712
-            df_old_card = df_all[df_all.is_new_fact == False]  # noqa: E712
-
-            # within each fold, take the first 75% as training data and the rest as test data
-            df_by_fold = {
-                'train_new_card': df_new_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[:int(x.user_id.size * 0.75)]),
-                'test_new_card': df_new_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[int(x.user_id.size * 0.75):]),
-                'train_old_card': df_old_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[:int(x.user_id.size * 0.75)]),
-                'test_old_card': df_old_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[int(x.user_id.size * 0.75):]),
-            }
-
-            # create token encodings
-            print('token encodings')
-            encodings_by_fold = {
-                fold: tokenizer(df.card_text.tolist(), truncation=True, padding=True)
-                for fold, df in df_by_fold.items()
-            }
-
-            # collect manually crafted features
-            print('normalize')
-            ndarray_by_fold = {
-                fold: df[feature_fields].to_numpy(dtype=np.float64)
-                for fold, df in df_by_fold.items()
-                if fold in ['train_old_card', 'test_old_card']
-            }
-
-            # normalize manually crafted features
-            mean = np.mean(ndarray_by_fold['train_old_card'], axis=0)
-            std = np.std(ndarray_by_fold['train_old_card'], axis=0)
-            torch.save(mean, f'{data_dir}/cached_mean')
-            torch.save(std, f'{data_dir}/cached_std')
-            ndarray_by_fold['train_old_card'] = (ndarray_by_fold['train_old_card'] - mean) / std
-            ndarray_by_fold['test_old_card'] = (ndarray_by_fold['test_old_card'] - mean) / std
-            for i, field in enumerate(feature_fields):
-                print(field, '%.2f' % mean[i], '%.2f' % std[i])
-
-            # put everything together and save in cache
-            inputs = {}
-            for foold, df in df_by_fold.items():
-                inputs[foold] = []
-                for i, row in enumerate(df.itertuples(index=False)):
-                    example = {k: v[i] for k, v in encodings_by_fold[foold].items()}
-                    example['label'] = int(row.response)
-                    if foold in ndarray_by_fold:
-                        example['retention_features'] = ndarray_by_fold[foold][i]
-                    inputs[foold].append(RetentionInput(**example))
-                cached_inputs_file = f'{data_dir}/cached_{foold}'
-                print(f"Saving features into cached file {cached_inputs_file}")
-                torch.save(inputs[foold], cached_inputs_file)
-
-        self.inputs = inputs[fold]
+        if overwrite_cached_data or not all(
+            os.path.exists(f'{_fold_dir(data_dir, x)}/meta.json')
+            and os.path.exists(f'{_fold_dir(data_dir, x)}/card_index.npy')
+            and os.path.exists(f'{_fold_dir(data_dir, x)}/record_ids.json')
+            for x in folds
+        ):
+            self.build(data_dir, tokenizer, overwrite_retention_features_df)
+
+        fold_dir = _fold_dir(data_dir, fold)
+        with open(f'{fold_dir}/meta.json') as f:
+            meta = json.load(f)
+        self.fold_dir = fold_dir
+        self.max_length = meta['max_length']
+        self.pad_token_id = meta['pad_token_id']
+        self.data_version = meta['data_version']
+        self.input_ids = np.load(f'{fold_dir}/input_ids.npy', mmap_mode='r')
+        self.offsets = np.load(f'{fold_dir}/offsets.npy', mmap_mode='r')
+        self.labels = np.load(f'{fold_dir}/labels.npy', mmap_mode='r')
+        self.retention_features = None
+        if os.path.exists(f'{fold_dir}/retention_features.npy'):
+            self.retention_features = np.load(f'{fold_dir}/retention_features.npy', mmap_mode='r')
+        self.lengths = np.diff(self.offsets)
+        self.card_index = np.load(f'{fold_dir}/card_index.npy', mmap_mode='r')
+        with open(f'{fold_dir}/card_ids.json') as f:
+            self.card_ids = json.load(f)
+
+    @property
+    def record_ids(self) -> List[str]:
+        '''Study record id of each example, read on demand.'''
+        with open(f'{self.fold_dir}/record_ids.json') as f:
+            return json.load(f)
+
+    @staticmethod
+    def build(data_dir: str, tokenizer, overwrite_retention_features_df: bool = False) -> None:
+        # gather features
+        print('gather features')
+        df_all = get_retention_features_df(overwrite_retention_features_df)
+
+        # separate new and old cards, and within each user take the first 75%
+        # as training data and the rest as test data
+        df_by_fold = split_folds(df_all)
+
+        # collect manually crafted features
+        print('normalize')
+        ndarray_by_fold = {
+            fold: df[feature_fields].to_numpy(dtype=np.float64)
+            for fold, df in df_by_fold.items()
+            if fold in ['train_old_card', 'test_old_card']
+        }
+
+        # normalize manually crafted features
+        mean = np.mean(ndarray_by_fold['train_old_card'], axis=0)
+        std = np.std(ndarray_by_fold['train_old_card'], axis=0)
+        torch.save(mean, f'{data_dir}/cached_mean')
+        torch.save(std, f'{data_dir}/cached_std')
+        ndarray_by_fold['train_old_card'] = (ndarray_by_fold['train_old_card'] - mean) / std
+        ndarray_by_fold['test_old_card'] = (ndarray_by_fold['test_old_card'] - mean) / std
+        for i, field in enumerate(feature_fields):
+            print(field, '%.2f' % mean[i], '%.2f' % std[i])
+
+        # token encodings, unpadded, once per unique card
+        print('token encodings')
+        token_cache = TokenCache(tokenizer)
+        cards = df_all.drop_duplicates('card_id')
+        token_cache.build(cards.card_id.tolist(), cards.card_text.tolist())
+
+        # put everything together and save in cache
+        for fold, df in df_by_fold.items():
+            input_ids, offsets = token_cache.gather(df.card_id.tolist())
+            fold_dir = _fold_dir(data_dir, fold)
+            print(f"Saving features into cached directory {fold_dir}")
+            _save_fold(
+                fold_dir,
+                input_ids,
+                offsets,
+                df.response.to_numpy(dtype=np.int8),
+                ndarray_by_fold.get(fold),
+                tokenizer.pad_token_id,
+                df.card_id.tolist(),
+                df.record_id.tolist(),
+                features_version(df_all),
+            )
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx) -> RetentionInput:
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        return RetentionInput(
+            input_ids=self.input_ids[self.offsets[idx]: self.offsets[idx + 1]],
+            retention_features=None if self.retention_features is None else self.retention_features[idx],
+            label=int(self.labels[idx]),
+        )
+
+
+class SharedEncoderRetentionDataset(torch.utils.data.Dataset):
+    '''
+    New-card and old-card examples of one split (`train` or `test`) for
+    `DistilBertSharedEncoderRetentionModel`. New-card examples get all-zero
+    retention features.
+    '''
+
+    def __init__(self, data_dir: str, split: str, tokenizer, **kwargs):
+        self.new_card = RetentionDataset(data_dir, f'{split}_new_card', tokenizer, **kwargs)
+        self.old_card = RetentionDataset(data_dir, f'{split}_old_card', tokenizer)
+        self.no_retention_features = np.zeros(len(feature_fields), dtype=np.float32)
+        self.lengths = np.concatenate([self.new_card.lengths, self.old_card.lengths])
 
     def __len__(self):
-        return len(self.inputs)
+        return len(self.new_card) + len(self.old_card)
 
     def __getitem__(self, idx) -> RetentionInput:
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        return self.inputs[idx]
+        if idx < len(self.new_card):
+            x = self.new_card[idx]
+            is_new_card = 1
+            retention_features = self.no_retention_features
+        else:
+            x = self.old_card[idx - len(self.new_card)]
+            is_new_card = 0
+            retention_features = x.retention_features
+        return RetentionInput(
+            input_ids=x.input_ids,
+            retention_features=retention_features,
+            label=x.label,
+            is_new_card=is_new_card,
+        )
 
 
 def retention_data_collator(
-    inputs: List[RetentionInput]
+    inputs: List[RetentionInput],
+    pad_token_id: int = 0,
 ) -> Dict[str, torch.Tensor]:
+    '''
+    Batch tensors from `RetentionInput`s. Token ids of different lengths are
+    padded to the longest in the batch, not to a global maximum, and every
+    field is assembled into one array before becoming a tensor.
+    '''
     # In this method we'll make the assumption that all `inputs` in the batch
     # have the same attributes.
     # So we will look at the first element as a proxy for what attributes exist
@@ -316,22 +680,28 @@ def retention_data_collator(
     first = inputs[0]
 
     if hasattr(first, 'label') and first.label is not None:
-        labels = torch.tensor([f.label for f in inputs], dtype=torch.float)
-        batch['labels'] = labels
+        labels = np.fromiter((f.label for f in inputs), dtype=np.float32, count=len(inputs))
+        batch['labels'] = torch.from_numpy(labels)
+
+    if first.input_ids is not None and first.attention_mask is None:
+        input_ids, attention_mask = pad_to_longest([f.input_ids for f in inputs], pad_token_id)
+        batch['input_ids'] = torch.from_numpy(input_ids)
+        batch['attention_mask'] = torch.from_numpy(attention_mask)
 
     if hasattr(first, 'retention_features') and first.retention_features is not None:
-        retention_features = torch.tensor([f.retention_features for f in inputs], dtype=torch.float)
-        batch['retention_features'] = retention_features
+        retention_features = np.asarray([f.retention_features for f in inputs], dtype=np.float32)
+        batch['retention_features'] = torch.from_numpy(retention_features)
 
     # Handling of all other possible attributes.
     # Again, we will use the first element to figure out which key/values are not None for this model.
     for k, v in vars(first).items():
         if (
             k not in ('label', 'retention_features')
+            and k not in batch
             and v is not None
             and not isinstance(v, str)
         ):
-            batch[k] = torch.tensor([getattr(f, k) for f in inputs], dtype=torch.long)
+            batch[k] = torch.from_numpy(np.asarray([getattr(f, k) for f in inputs], dtype=np.int64))
 
     return batch
 
@@ -344,4 +714,8 @@ if __name__ == '__main__':
     #     tokenizer=tokenizer
     # )
     # print(len(train_dataset))
-    df = get_retention_features_df()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--overwrite', type=bool, default=False)
+    parser.add_argument('--refresh', type=bool, default=False)
+    args = parser.parse_args()
+    df = get_retention_features_df(overwrite=args.overwrite, refresh=args.refresh)
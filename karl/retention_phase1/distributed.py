@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Data-parallel training of the retention models over CPU processes and
+nodes, with torch.distributed and the gloo backend.
+
+Every process holds a replica of the model and trains on its own shard of
+the `RetentionDataset` batches; DistributedDataParallel averages gradients,
+so all replicas take the same steps. Evaluation is sharded the same way and
+predictions are gathered, so every rank reports metrics of the whole fold.
+The first process of each node builds the cached folds the node is missing,
+rank 0 first, and the other processes wait for it at a barrier; rank 0
+writes checkpoints.
+
+Locally with 4 processes:
+
+    python -m karl.retention_phase1.distributed --model_name distilbert --fold old_card --nproc_per_node 4
+
+On two nodes, run on each node with its own `--node_rank`:
+
+    python -m karl.retention_phase1.distributed ... --nnodes 2 --node_rank 0 --master_addr 10.0.0.1
+
+When launched by `torchrun`, its environment is used instead.
+'''
+
+import os
+import argparse
+import numpy as np
+from typing import List
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from transformers import EvalPrediction, get_linear_schedule_with_warmup
+
+from karl.config import settings
+from karl.retention_phase1.data import feature_fields
+from karl.retention_phase1.batching import length_bucketed_batches
+from karl.retention_phase1.common import (
+    model_cls,
+    config_cls,
+    tokenizer_cls,
+    full_name,
+    get_datasets,
+    compute_metrics,
+    set_seed,
+)
+
+
+def shard_batches(
+    lengths: np.ndarray,
+    batch_size: int,
+    rank: int,
+    world_size: int,
+    seed: int = 0,
+) -> List[List[int]]:
+    '''
+    Training batches of one epoch for `rank`. Examples are shuffled with
+    `seed`, sorted by length within megabatches of 50 batches like
+    `LengthGroupedSampler` does, and the shuffled batches are dealt out
+    round-robin. Every rank gets the same number of batches, so DDP steps
+    stay in lockstep; the last few batches of the epoch are dropped.
+    '''
+    lengths = np.asarray(lengths)
+    generator = np.random.default_rng(seed)
+    order = generator.permutation(len(lengths))
+    megabatch_size = 50 * batch_size
+    batches = []
+    for i in range(0, len(order), megabatch_size):
+        megabatch = order[i: i + megabatch_size]
+        megabatch = megabatch[np.argsort(-lengths[megabatch], kind='stable')]
+        batches.extend(megabatch[j: j + batch_size] for j in range(0, len(megabatch), batch_size))
+    generator.shuffle(batches)
+    n_batches = len(batches) // world_size * world_size
+    return [batch.tolist() for batch in batches[rank: n_batches: world_size]]
+
+
+def shard_eval_batches(lengths: np.ndarray, batch_size: int, rank: int, world_size: int) -> List[List[int]]:
+    '''Evaluation batches of `rank`: every `world_size`-th example, none dropped, grouped by length.'''
+    shard = np.arange(rank, len(lengths), world_size)
+    batches = length_bucketed_batches(np.asarray(lengths)[shard].tolist(), batch_size)
+    return [shard[batch].tolist() for batch in batches]
+
+
+@torch.inference_mode()
+def evaluate(model, dataset, data_collator, batch_size: int = 64) -> dict:
+    '''Metrics of the whole `dataset`, computed on every rank from the gathered shards.'''
+    model.eval()
+    predictions, labels = [], []
+    for batch in shard_eval_batches(dataset.lengths, batch_size, dist.get_rank(), dist.get_world_size()):
+        inputs = data_collator([dataset[i] for i in batch])
+        labels.append(inputs.pop('labels').numpy())
+        predictions.append(model(**inputs)[0].numpy())
+    shard = (
+        np.concatenate(predictions) if predictions else np.zeros(0, dtype=np.float32),
+        np.concatenate(labels) if labels else np.zeros(0, dtype=np.float32),
+    )
+    shards = [None] * dist.get_world_size()
+    dist.all_gather_object(shards, shard)
+    return compute_metrics(EvalPrediction(
+        predictions=np.concatenate([x for x, _ in shards]),
+        label_ids=np.concatenate([x for _, x in shards]),
+    ))
+
+
+def save_checkpoint(model, optimizer, scheduler, step: int, checkpoint_dir: str) -> None:
+    '''Written by rank 0; all ranks return once it is complete.'''
+    if dist.get_rank() == 0:
+        model.save_pretrained(checkpoint_dir)
+        torch.save({
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'step': step,
+        }, f'{checkpoint_dir}/training_state.pt')
+    dist.barrier()
+
+
+def train(
+    model_name: str,
+    output_dir: str = f'{settings.CODE_DIR}/output',
+    fold: str = 'new_card',
+    resume: str = None,
+    seed: int = 1,
+    num_train_epochs: int = 10,
+    per_device_train_batch_size: int = 8,
+    per_device_eval_batch_size: int = 64,
+    learning_rate: float = 2e-05,
+    save_steps: int = 2000,
+) -> dict:
+    '''
+    Distributed counterpart of `main.train`, run by every process of an
+    initialized gloo process group. Returns the final test metrics.
+    '''
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    set_seed(seed)
+    model_dir = f'{output_dir}/retention_hf_{model_name}_{fold}_{seed}'
+    tokenizer = tokenizer_cls[model_name].from_pretrained(full_name[model_name])
+
+    # rank 0 builds missing cached folds, then the first process of every
+    # other node, which finds them already built if `DATA_DIR` is shared;
+    # the other processes only read them
+    if rank == 0:
+        datasets = get_datasets(fold, tokenizer)
+    dist.barrier()
+    if local_rank == 0 and rank != 0:
+        datasets = get_datasets(fold, tokenizer)
+    dist.barrier()
+    if local_rank != 0:
+        datasets = get_datasets(fold, tokenizer)
+    train_dataset, test_dataset, data_collator = datasets
+
+    if resume is None:
+        retention_feature_size = 0 if fold == 'new_card' else len(feature_fields)
+        model = model_cls[model_name](config=config_cls[model_name](retention_feature_size=retention_feature_size))
+    else:
+        model = model_cls[model_name].from_pretrained(resume)
+    # DDP broadcasts the parameters of rank 0, so replicas start identical;
+    # with a shared encoder a batch may leave one of the two heads unused
+    ddp_model = DistributedDataParallel(model, find_unused_parameters=(fold == 'all'))
+
+    steps_per_epoch = len(shard_batches(train_dataset.lengths, per_device_train_batch_size, rank, world_size))
+    if steps_per_epoch == 0:
+        raise ValueError(f'{len(train_dataset)} examples are too few for {world_size} processes')
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=0.0)
+    scheduler = get_linear_schedule_with_warmup(optimizer, 0, steps_per_epoch * num_train_epochs)
+    step = 0
+    if resume is not None:
+        state = torch.load(f'{resume}/training_state.pt')
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        step = state['step']
+
+    for epoch in range(step // steps_per_epoch, num_train_epochs):
+        ddp_model.train()
+        loss = torch.tensor(float('nan'))
+        # same seed on every rank, so the shards of an epoch are disjoint
+        batches = shard_batches(train_dataset.lengths, per_device_train_batch_size, rank, world_size, seed + epoch)
+        for batch in batches[step - epoch * steps_per_epoch:]:
+            loss = ddp_model(**data_collator([train_dataset[i] for i in batch]))[0]
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            step += 1
+            if step % save_steps == 0:
+                save_checkpoint(model, optimizer, scheduler, step, f'{model_dir}/checkpoint-{step}')
+        result = evaluate(model, test_dataset, data_collator, per_device_eval_batch_size)
+        if rank == 0:
+            print(f'epoch {epoch} step {step} loss {loss.item():.4f}', result)
+
+    save_checkpoint(model, optimizer, scheduler, step, model_dir)
+    result = evaluate(model, test_dataset, data_collator, per_device_eval_batch_size)
+    if rank == 0:
+        print(f"***** Eval {model_name} {fold} {seed} ({world_size} processes) *****")
+        for key, value in result.items():
+            print(f'  {key} = {value}')
+    return result
+
+
+def _worker(local_rank: int, args: argparse.Namespace) -> None:
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['RANK'] = str(args.node_rank * args.nproc_per_node + local_rank)
+    os.environ['WORLD_SIZE'] = str(args.nnodes * args.nproc_per_node)
+    os.environ['MASTER_ADDR'] = args.master_addr
+    os.environ['MASTER_PORT'] = str(args.master_port)
+    run(args)
+
+
+def run(args: argparse.Namespace) -> None:
+    '''Join the process group described by the environment and train.'''
+    # split the cores of a node between its processes
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', args.nproc_per_node))
+    num_threads = args.num_threads or max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(num_threads)
+    dist.init_process_group('gloo', init_method='env://')
+    try:
+        train(
+            model_name=args.model_name,
+            output_dir=args.output_dir,
+            fold=args.fold,
+            resume=args.resume,
+            seed=args.seed,
+            num_train_epochs=args.num_train_epochs,
+            per_device_train_batch_size=args.per_device_train_batch_size,
+            learning_rate=args.learning_rate,
+            save_steps=args.save_steps,
+        )
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(args: argparse.Namespace) -> None:
+    '''Start `nproc_per_node` processes on this node, unless already started by torchrun.'''
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        run(args)
+    else:
+        mp.spawn(_worker, args=(args,), nprocs=args.nproc_per_node, join=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', choices=list(model_cls.keys()))
+    parser.add_argument('--fold', choices=['new_card', 'old_card', 'all'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--resume')
+    parser.add_argument('--output_dir', default=f'{settings.CODE_DIR}/output')
+    parser.add_argument('--num_train_epochs', type=int, default=10)
+    parser.add_argument('--per_device_train_batch_size', type=int, default=8)
+    parser.add_argument('--learning_rate', type=float, default=2e-05)
+    parser.add_argument('--save_steps', type=int, default=2000)
+    parser.add_argument('--nproc_per_node', type=int, default=1)
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node_rank', type=int, default=0)
+    parser.add_argument('--master_addr', default='127.0.0.1')
+    parser.add_argument('--master_port', type=int, default=29500)
+    parser.add_argument('--num_threads', type=int, default=0, help='per process, 0 to split the cores evenly')
+    args = parser.parse_args()
+    launch(args)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import logging
+import argparse
+import numpy as np
+from typing import Callable, List, Tuple
+from collections import OrderedDict
+
+import torch
+from transformers import DistilBertTokenizerFast
+
+from karl.config import settings
+from karl.retention_phase1.model_distilbert import DistilBertRetentionModel
+from karl.retention_phase1.backend import model_version, get_device, prepare_for_inference, encoder_precision
+from karl.retention_phase1.batching import length_bucketed_batches, pad_to_longest
+from karl.retention_phase1.token_cache import TokenCache
+
+logger = logging.getLogger('retention')
+
+
+class CardEmbeddingCache:
+    '''
+    card_id -> `encode` output of one model checkpoint.
+
+    Card text never changes, so the encoder only has to run once per card and
+    model version. Embeddings precomputed by `build_card_embeddings` are
+    memory-mapped from `card_embeddings.npy` in the model directory; cards
+    first seen at serving time are kept in memory, the `max_extra` most
+    recently used ones. A cache written for a different version of the
+    checkpoint, or by an encoder of another `precision` than the one that
+    encodes the misses, is ignored, so a card scores the same whether it is
+    cached or not.
+    '''
+
+    def __init__(self, model_dir: str, dim: int, precision: str = 'fp32', max_extra: int = None):
+        self.dim = dim
+        self.version = model_version(model_dir)
+        self.precision = precision
+        self.max_extra = settings.MODEL_EMBEDDING_CACHE_SIZE if max_extra is None else max_extra
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.index = {}
+        self.extra = OrderedDict()
+
+        matrix_path = f'{model_dir}/card_embeddings.npy'
+        index_path = f'{model_dir}/card_embeddings.json'
+        if os.path.exists(matrix_path) and os.path.exists(index_path):
+            with open(index_path) as f:
+                meta = json.load(f)
+            if meta['model_version'] != self.version:
+                logger.warning(f'ignoring card embeddings in {model_dir} built for another version')
+            elif meta.get('precision', 'fp32') != precision:
+                logger.warning(f'ignoring {meta.get("precision", "fp32")} card embeddings in {model_dir}, encoding with {precision}')
+            else:
+                self.matrix = np.load(matrix_path, mmap_mode='r')
+                self.index = {card_id: i for i, card_id in enumerate(meta['card_ids'])}
+
+    def __len__(self):
+        return len(self.index) + len(self.extra)
+
+    def lookup(self, card_ids: List[str]) -> Tuple[np.ndarray, List[int]]:
+        '''
+        :return: (len(card_ids), dim) embeddings, and positions of the cards
+            not in the cache, whose rows are left as zeros.
+        '''
+        embeddings = np.zeros((len(card_ids), self.dim), dtype=np.float32)
+        positions, rows, missing = [], [], []
+        for i, card_id in enumerate(card_ids):
+            row = self.index.get(card_id)
+            if row is not None:
+                positions.append(i)
+                rows.append(row)
+            elif card_id in self.extra:
+                embeddings[i] = self.extra[card_id]
+                self.extra.move_to_end(card_id)
+            else:
+                missing.append(i)
+        if len(rows) > 0:
+            embeddings[positions] = self.matrix[rows]
+        return embeddings, missing
+
+    def add(self, card_ids: List[str], embeddings: np.ndarray) -> None:
+        for card_id, embedding in zip(card_ids, embeddings):
+            self.extra[card_id] = embedding
+            self.extra.move_to_end(card_id)
+        while len(self.extra) > self.max_extra:
+            self.extra.popitem(last=False)
+
+    def lookup_or_encode(self, card_ids: List[str], encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        '''
+        (len(card_ids), dim) embeddings, calling `encode` once on the unique
+        card ids not in the cache. Misses are filled from what `encode`
+        returns, not read back from the cache, which may already have
+        evicted some of them.
+        '''
+        embeddings, missing = self.lookup(card_ids)
+        if len(missing) > 0:
+            missing_ids = list(dict.fromkeys(card_ids[i] for i in missing))
+            missing_embeddings = encode(missing_ids)
+            rows = {card_id: j for j, card_id in enumerate(missing_ids)}
+            embeddings[missing] = missing_embeddings[[rows[card_ids[i]] for i in missing]]
+            self.add(missing_ids, missing_embeddings)
+        return embeddings
+
+
+@torch.inference_mode()
+def encode_token_ids(
+    model: DistilBertRetentionModel,
+    input_ids: List[np.ndarray],
+    pad_token_id: int = 0,
+    batch_size: int = 64,
+    device: torch.device = None,
+) -> np.ndarray:
+    '''
+    `encode` output for each token id sequence, in order. Sequences are
+    batched by length and each batch is padded only to its own longest one.
+    '''
+    device = device or next(model.parameters()).device
+    embeddings = np.zeros((len(input_ids), model.config.dim), dtype=np.float32)
+    if len(input_ids) == 0:
+        return embeddings
+    lengths = [len(x) for x in input_ids]
+    for batch in length_bucketed_batches(lengths, batch_size, settings.MODEL_MAX_BATCH_TOKENS):
+        batch_input_ids, attention_mask = pad_to_longest([input_ids[i] for i in batch], pad_token_id)
+        embeddings[batch] = model.encode(
+            input_ids=torch.from_numpy(batch_input_ids).to(device),
+            attention_mask=torch.from_numpy(attention_mask).to(device),
+        ).float().cpu().numpy()
+    return embeddings
+
+
+def save_card_embeddings(model_dir: str, card_ids: List[str], embeddings: np.ndarray, precision: str = 'fp32') -> None:
+    '''Write `CardEmbeddingCache` files for the checkpoint saved in `model_dir`, encoded at `precision`.'''
+    np.save(f'{model_dir}/card_embeddings.npy', embeddings.astype(np.float32))
+    with open(f'{model_dir}/card_embeddings.json', 'w') as f:
+        json.dump({'model_version': model_version(model_dir), 'card_ids': list(card_ids), 'precision': precision}, f)
+
+
+def build_card_embeddings(model_dir: str, card_ids: List[str], card_texts: List[str], batch_size: int = 64) -> None:
+    '''
+    Precompute `encode` for all cards with the checkpoint in `model_dir`,
+    prepared for inference as the model server prepares it.
+    '''
+    device = get_device()
+    model = prepare_for_inference(DistilBertRetentionModel.from_pretrained(model_dir), device)
+    tokenizer = DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased')
+    token_cache = TokenCache(tokenizer)
+    token_cache.build(card_ids, card_texts)
+    input_ids = token_cache.lookup(card_ids, card_texts)
+    embeddings = encode_token_ids(model, input_ids, tokenizer.pad_token_id, batch_size, device)
+    save_card_embeddings(model_dir, card_ids, embeddings, encoder_precision(model))
+    print(f'saved {len(card_ids)} {encoder_precision(model)} card embeddings to {model_dir}')
+
+
+if __name__ == '__main__':
+    from karl.db.session import SessionLocal
+    from karl.models import Card
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    cards = session.query(Card.id, Card.text).all()
+    session.close()
+    for fold in ['new_card', 'old_card']:
+        build_card_embeddings(
+            f'{settings.CODE_DIR}/output/retention_hf_distilbert_{fold}',
+            [card_id for card_id, _ in cards],
+            [text for _, text in cards],
+            args.batch_size,
+        )
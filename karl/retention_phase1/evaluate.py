@@ -1,104 +1,226 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+'''
+Offline evaluation of the retention models.
+
+Predictions of each model on each fold are cached in a Parquet file per
+checkpoint version and version of the cached folds, so evaluating again only
+reads them back, and a retrained checkpoint or rebuilt folds are predicted
+again:
+
+    {output_dir}/retention_hf_{model_name}_predictions/{version}/{data_version}/{fold}.parquet
+
+Each file has the study record id of every prediction, and predictions are
+joined to the features on it.
+
+Folds without cached predictions are predicted in parallel processes.
+Accuracy, AUC and ECE are computed for every (model, fold), and per user and
+per deck on the test folds, with grouped operations over one long frame of
+predictions. Breakdowns are written next to the predictions.
+
+    python -m karl.retention_phase1.evaluate --model_names distilbert --figures True
+'''
+
 import os
-import json
-import altair as alt
+import argparse
+import multiprocessing
+import numpy as np
 import pandas as pd
-from pathlib import Path
+from typing import Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
 
-from transformers import TrainingArguments, Trainer
+import torch
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from karl.retention_hf.data import (  # noqa: F401
-    RetentionInput,
+from karl.config import settings
+from karl.retention_phase1.data import (
     RetentionDataset,
     get_retention_features_df,
     retention_data_collator,
+    split_folds,
+    folds,
 )
+from karl.retention_phase1.backend import model_version
+from karl.retention_phase1.batching import length_bucketed_batches
+from karl.retention_phase1.common import model_cls, tokenizer_cls, full_name
+
+N_CALIBRATION_BINS = 10
+
+
+def _model_dir(output_dir: str, model_name: str, fold: str) -> str:
+    # `train_old_card` and `test_old_card` are predicted by the `old_card` model
+    return f'{output_dir}/retention_hf_{model_name}_{fold.split("_", 1)[1]}'
+
+
+def prediction_path(output_dir: str, model_name: str, fold: str, data_version: str) -> str:
+    version = model_version(_model_dir(output_dir, model_name, fold))
+    return f'{output_dir}/retention_hf_{model_name}_predictions/{version}/{data_version}/{fold}.parquet'
+
+
+@torch.inference_mode()
+def predict(model, dataset: RetentionDataset, batch_size: int = 64) -> np.ndarray:
+    '''Predicted recall probability of every example, in dataset order, batched by length.'''
+    predictions = np.zeros(len(dataset), dtype=np.float32)
+    batches = length_bucketed_batches(dataset.lengths.tolist(), batch_size, settings.MODEL_MAX_BATCH_TOKENS)
+    for batch in batches:
+        inputs = retention_data_collator([dataset[i] for i in batch], dataset.pad_token_id)
+        inputs.pop('labels', None)
+        predictions[batch] = model(**inputs)[0].numpy()
+    return predictions
+
+
+def _predict_fold(model_name: str, fold: str, model_dir: str, path: str, num_threads: int) -> str:
+    torch.set_num_threads(num_threads)
+    tokenizer = tokenizer_cls[model_name].from_pretrained(full_name[model_name])
+    dataset = RetentionDataset(settings.DATA_DIR, fold, tokenizer)
+    model = model_cls[model_name].from_pretrained(model_dir)
+    model.eval()
+    predictions = predict(model, dataset)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a complete file or none, even if the process is killed
+    pq.write_table(pa.table({'record_id': dataset.record_ids, 'prediction': predictions}), f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+    print(f'predicted {model_name} {fold}')
+    return path
+
+
+def load_predictions(
+    model_names: List[str],
+    output_dir: str = f'{settings.CODE_DIR}/output',
+    n_workers: int = None,
+) -> Dict[Tuple[str, str], pd.DataFrame]:
+    '''
+    (model_name, fold) -> `record_id` and `prediction` of every example,
+    computing the ones not cached for the current checkpoints and folds.
+    '''
+    # build the cached folds once, before workers read them
+    tokenizer = tokenizer_cls[model_names[0]].from_pretrained(full_name[model_names[0]])
+    data_version = RetentionDataset(settings.DATA_DIR, folds[0], tokenizer).data_version
 
-from karl.config import settings
-from karl.figures import figure_forgetting_curve, figure_recall_rate
-from karl.retention_hf.main import compute_metrics, model_cls, tokenizer_cls, full_name
-
-alt.data_transformers.disable_max_rows()
-alt.renderers.enable('mimetype')
-
+    paths, tasks = {}, []
+    for model_name in model_names:
+        for fold in folds:
+            paths[model_name, fold] = prediction_path(output_dir, model_name, fold, data_version)
+            if not os.path.exists(paths[model_name, fold]):
+                tasks.append((model_name, fold, _model_dir(output_dir, model_name, fold), paths[model_name, fold]))
+
+    if len(tasks) > 0:
+        n_workers = min(n_workers or os.cpu_count() or 1, len(tasks))
+        # split the cores between the workers instead of oversubscribing them
+        num_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        if n_workers == 1:
+            for task in tasks:
+                _predict_fold(*task, num_threads)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context(settings.MP_CONTEXT),
+            ) as executor:
+                for future in [executor.submit(_predict_fold, *task, num_threads) for task in tasks]:
+                    future.result()
+
+    return {key: pq.read_table(path).to_pandas() for key, path in paths.items()}
+
+
+def with_predictions(df: pd.DataFrame, predictions: pd.DataFrame) -> pd.DataFrame:
+    '''Rows of `df` with a prediction, joined on `record_id`.'''
+    return df.merge(predictions, on='record_id', how='inner', validate='one_to_one')
+
+
+def breakdown(df: pd.DataFrame, by: List[str], prediction: str = 'prediction', label: str = 'response') -> pd.DataFrame:
+    '''
+    Accuracy, AUC and ECE of each group of `by`, all groups at once.
 
-def evaluate(model_names=['distilbert', 'bert'], output_dir=f'{settings.CODE_DIR}/output'):
+    Metrics are defined as in `main.compute_metrics`: accuracy at 0.5, AUC
+    from prediction ranks (ties averaged), and ECE as the mean gap between
+    recall rate and mean prediction over non-empty uniform bins. AUC is NaN
+    for groups with a single label.
     '''
-    This evaluation focuses on *old* cards.
-    1. compare the empirical forgetting curve and the predicted one.
-    1. compare the empirical recall rate and the predicted one.
+    x = df[by].copy()
+    x['y'] = df[label].to_numpy(dtype=np.float64)
+    x['p'] = df[prediction].to_numpy(dtype=np.float64)
+    x['correct'] = (x.p > 0.5) == (x.y > 0.5)
+    x['rank'] = x.groupby(by).p.rank()
+    x['rank_positive'] = x['rank'] * x.y
+    # bin edges and inclusive sides as in sklearn's calibration_curve
+    x['bin'] = np.searchsorted(np.linspace(0, 1, N_CALIBRATION_BINS + 1)[1:-1], x.p)
+
+    groups = x.groupby(by)
+    n = groups.size()
+    n_positive = groups.y.sum()
+    n_negative = n - n_positive
+    auc = (groups.rank_positive.sum() - n_positive * (n_positive + 1) / 2) / (n_positive * n_negative)
+    bins = x.groupby(by + ['bin']).agg(y=('y', 'mean'), p=('p', 'mean'))
+    ece = (bins.y - bins.p).abs().groupby(level=list(range(len(by)))).mean()
+    return pd.DataFrame({
+        'n': n,
+        'acc': groups.correct.mean(),
+        'auc': auc.where((n_positive > 0) & (n_negative > 0)),
+        'ece': ece,
+        'recall_rate': groups.y.mean(),
+        'mean_prediction': groups.p.mean(),
+    })
+
+
+def evaluate(
+    model_names: List[str] = ['distilbert', 'bert'],
+    output_dir: str = f'{settings.CODE_DIR}/output',
+    n_workers: int = None,
+    figures: bool = False,
+) -> Dict[str, pd.DataFrame]:
     '''
-    # figures_dir = f'{settings.CODE_DIR}/figures_eval_all'
+    Metrics of each model per fold, and per user and per deck on the test
+    folds. With `figures`, also compare the empirical forgetting curve and
+    recall rate of old cards with the predicted ones.
+    '''
+    predictions = load_predictions(model_names, output_dir, n_workers)
+
+    # the same folds as the ones the models were trained and tested on
+    df_by_fold = split_folds(get_retention_features_df())
+    columns = ['record_id', 'user_id', 'deck_id', 'response']
+    results = pd.concat([
+        with_predictions(df_by_fold[fold][columns], predictions[model_name, fold]).assign(model=model_name, fold=fold)
+        for model_name in model_names
+        for fold in folds
+    ], ignore_index=True)
+    test_results = results[results.fold.str.startswith('test_')]
+
+    report = {
+        'fold': breakdown(results, ['model', 'fold']),
+        'user': breakdown(test_results, ['model', 'fold', 'user_id']),
+        'deck': breakdown(test_results, ['model', 'fold', 'deck_id']),
+    }
+    print(report['fold'].to_string(float_format='%.4f'))
+    report_dir = f'{output_dir}/retention_evaluation'
+    os.makedirs(report_dir, exist_ok=True)
+    for name, df in report.items():
+        df.reset_index().to_csv(f'{report_dir}/metrics_by_{name}.csv', index=False)
+
+    if figures:
+        plot(df_by_fold, predictions, model_names)
+    return report
+
+
+def plot(df_by_fold: Dict[str, pd.DataFrame], predictions: Dict[Tuple[str, str], pd.DataFrame], model_names: List[str]):
+    import altair as alt
+    from karl.figures import figure_forgetting_curve, figure_recall_rate
+
+    alt.data_transformers.disable_max_rows()
+    alt.renderers.enable('mimetype')
     figures_dir = ''
 
-    prediction_by_model = {}
-    for model_name in model_names:
-        prediction_root_dir = f'{output_dir}/retention_hf_{model_name}_predictions'
-        Path(prediction_root_dir).mkdir(parents=True, exist_ok=True)
-        Path(figures_dir).mkdir(parents=True, exist_ok=True)
-
-        prediction_by_model[model_name] = {}
-        for fold in ['train_new_card', 'train_old_card', 'test_new_card', 'test_old_card']:
-            foold = '_'.join(fold.split('_')[1:])
-            model_output_dir = f'{output_dir}/retention_hf_{model_name}_{foold}'
-            prediction_dir = f'{prediction_root_dir}/predictions_{fold}.json'
-            if os.path.exists(prediction_dir):
-                prediction_by_model[model_name][fold] = json.load(open(prediction_dir))
-            else:
-                tokenizer = tokenizer_cls[model_name].from_pretrained(full_name[model_name])
-                test_dataset = RetentionDataset(settings.DATA_DIR, fold, tokenizer)
-
-                training_args = TrainingArguments(
-                    output_dir=model_output_dir,
-                    num_train_epochs=10,
-                    per_device_train_batch_size=16,
-                    per_device_eval_batch_size=64,
-                    learning_rate=2e-05,
-                )
-                model = model_cls[model_name].from_pretrained(training_args.output_dir)
-                model.eval()
-
-                trainer = Trainer(
-                    model=model,
-                    args=training_args,
-                    train_dataset=test_dataset,
-                    eval_dataset=test_dataset,
-                    data_collator=retention_data_collator,
-                    compute_metrics=compute_metrics,
-                )
-                p = trainer.predict(test_dataset)
-                print(fold, 'accuracy', compute_metrics(p))
-                with open(prediction_dir, 'w') as f:
-                    json.dump(p.predictions.tolist(), f)
-                prediction_by_model[model_name][fold] = p.predictions.tolist()
-
-    df_all = get_retention_features_df()
-    df_new_card = df_all[df_all.is_new_fact == True]  # noqa: E712
-    df_old_card = df_all[df_all.is_new_fact == False]  # noqa: E712
-    df_by_fold = {
-        'train_new_card': df_new_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[:int(x.user_id.size * 0.75)]).reset_index(),
-        'test_new_card': df_new_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[int(x.user_id.size * 0.75):]).reset_index(),
-        'train_old_card': df_old_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[:int(x.user_id.size * 0.75)]).reset_index(),
-        'test_old_card': df_old_card.groupby('user_id', as_index=False).apply(lambda x: x.iloc[int(x.user_id.size * 0.75):]).reset_index(),
-    }
-    for fold in ['train_new_card', 'train_old_card']:
-        df_by_fold[fold] = df_by_fold[fold].rename(columns={'response': 'train_response'})
-        value_vars = ['train_response']
-        id_vars = [x for x in df_by_fold[fold].columns if x not in value_vars]
-        df_by_fold[fold] = df_by_fold[fold].melt(id_vars=id_vars, value_vars=value_vars, var_name='type', value_name='value')
-
-    for fold in ['test_new_card', 'test_old_card']:
-        df_by_fold[fold] = df_by_fold[fold].rename(columns={'response': 'test_response'})
-        value_vars = ['test_response']
-        for model_name in model_names:
-            df_by_fold[fold][model_name] = prediction_by_model[model_name][fold]
-            value_vars.append(model_name)
-        id_vars = [x for x in df_by_fold[fold].columns if x not in value_vars]
-        df_by_fold[fold] = df_by_fold[fold].melt(id_vars=id_vars, value_vars=value_vars, var_name='type', value_name='value')
-
-    df_concat = pd.concat(list(df_by_fold.values()))
+    df_by_type = []
+    for fold, df in df_by_fold.items():
+        split = fold.split('_')[0]
+        df = df.drop(columns=['response']).assign(type=f'{split}_response', value=df.response)
+        df_by_type.append(df)
+        if split == 'test':
+            for model_name in model_names:
+                df_model = with_predictions(df.drop(columns=['value']), predictions[model_name, fold])
+                df_by_type.append(df_model.rename(columns={'prediction': 'value'}).assign(type=model_name))
+    df_concat = pd.concat(df_by_type, ignore_index=True)
     figure_forgetting_curve(df_concat, figures_dir, max_repetition=2)
     figure_recall_rate(df_concat, figures_dir)
     figure_recall_rate(df_concat, user_id='463', path=figures_dir)
@@ -106,4 +228,10 @@ def evaluate(model_names=['distilbert', 'bert'], output_dir=f'{settings.CODE_DIR
 
 
 if __name__ == '__main__':
-    evaluate()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_names', nargs='+', default=['distilbert', 'bert'])
+    parser.add_argument('--output_dir', default=f'{settings.CODE_DIR}/output')
+    parser.add_argument('--n_workers', type=int, default=None)
+    parser.add_argument('--figures', type=bool, default=False)
+    args = parser.parse_args()
+    evaluate(args.model_names, args.output_dir, args.n_workers, args.figures)
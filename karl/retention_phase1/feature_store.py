@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Partitioned Parquet store for the retention features DataFrame.
+
+Rows are partitioned by month of `utc_datetime` and by a hash bucket of
+`user_id`, and sorted by (user, date) within each file:
+
+    {DATA_DIR}/retention_features/month=2023-01/user_bucket=7/part-0.parquet
+
+`load_features` reads only the requested columns, and pushes user and date
+filters down to the partitions and to row-group statistics, so reading a
+few users or a date range touches a fraction of the files. Files are
+memory-mapped.
+'''
+
+import os
+import zlib
+import shutil
+import argparse
+import pandas as pd
+from datetime import datetime
+from typing import List, Iterable, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.fs
+import pyarrow.dataset as ds
+
+from karl.config import settings
+
+STORE_DIR = f'{settings.DATA_DIR}/retention_features'
+N_USER_BUCKETS = 16
+PARTITIONING = ds.partitioning(
+    pa.schema([('month', pa.string()), ('user_bucket', pa.int32())]),
+    flavor='hive',
+)
+
+
+def user_bucket(user_id: str) -> int:
+    '''Stable across processes and runs, unlike `hash`.'''
+    return zlib.crc32(str(user_id).encode()) % N_USER_BUCKETS
+
+
+def _with_partition_columns(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    df['month'] = pd.to_datetime(df.utc_datetime, utc=True).dt.strftime('%Y-%m')
+    buckets = {user_id: user_bucket(user_id) for user_id in df.user_id.unique()}
+    df['user_bucket'] = df.user_id.map(buckets).astype('int32')
+    return df
+
+
+def partitions_of(df: pd.DataFrame) -> Set[Tuple[str, int]]:
+    '''(month, user_bucket) partitions holding the rows of `df`.'''
+    df = _with_partition_columns(df[['user_id', 'utc_datetime']])
+    return set(zip(df.month, df.user_bucket))
+
+
+def write_features(df: pd.DataFrame, store_dir: str = STORE_DIR, partitions: Iterable[Tuple[str, int]] = None) -> None:
+    '''
+    Write `df` to the store. Without `partitions` the store is replaced;
+    otherwise only the given (month, user_bucket) partitions are rewritten
+    from the rows of `df` that fall in them.
+    '''
+    df = _with_partition_columns(df)
+    if partitions is None:
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+    else:
+        partitions = set(partitions)
+        in_partitions = [p in partitions for p in zip(df.month, df.user_bucket)]
+        df = df[in_partitions]
+        # partitions that became empty would otherwise keep stale files
+        for month, bucket in partitions:
+            shutil.rmtree(f'{store_dir}/month={month}/user_bucket={bucket}', ignore_errors=True)
+    if len(df) == 0:
+        return
+    df = df.sort_values(['user_id', 'utc_datetime', 'record_id'], kind='mergesort')
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        store_dir,
+        format='parquet',
+        partitioning=PARTITIONING,
+        existing_data_behavior='delete_matching',
+        max_rows_per_group=64 * 1024,
+    )
+
+
+def dataset(store_dir: str = STORE_DIR) -> ds.Dataset:
+    return ds.dataset(
+        store_dir,
+        format='parquet',
+        partitioning=PARTITIONING,
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def exists(store_dir: str = STORE_DIR) -> bool:
+    return os.path.isdir(store_dir)
+
+
+def load_partitions(partitions: Iterable[Tuple[str, int]], store_dir: str = STORE_DIR) -> pd.DataFrame:
+    '''All rows of the given (month, user_bucket) partitions.'''
+    expression = None
+    for month, bucket in partitions:
+        e = (ds.field('month') == month) & (ds.field('user_bucket') == bucket)
+        expression = e if expression is None else expression | e
+    if expression is None or not exists(store_dir):
+        return pd.DataFrame()
+    return _to_pandas(dataset(store_dir).to_table(filter=expression))
+
+
+def _to_pandas(table: pa.Table) -> pd.DataFrame:
+    df = table.to_pandas()
+    df = df.drop(columns=[c for c in ['month', 'user_bucket'] if c in df.columns])
+    if 'utc_date' in df.columns:
+        # arrow date32 comes back as datetime.date objects, as it was written
+        df['utc_date'] = df.utc_date.astype(object)
+    return df.sort_values(['user_id', 'utc_datetime', 'record_id'], kind='mergesort', ignore_index=True)
+
+
+def load_features(
+    columns: List[str] = None,
+    user_ids: List[str] = None,
+    date_start: datetime = None,
+    date_end: datetime = None,
+    store_dir: str = STORE_DIR,
+) -> pd.DataFrame:
+    '''
+    Features of `user_ids` (all users if None) studied in
+    [`date_start`, `date_end`), restricted to `columns` (all if None), in
+    (user, date) order.
+    '''
+    expression = None
+
+    def conjoin(e):
+        return e if expression is None else expression & e
+
+    if user_ids is not None:
+        user_ids = [str(x) for x in user_ids]
+        buckets = sorted({user_bucket(x) for x in user_ids})
+        expression = conjoin(ds.field('user_bucket').isin(buckets) & ds.field('user_id').isin(user_ids))
+    if date_start is not None:
+        date_start = pd.Timestamp(date_start, tz='UTC') if date_start.tzinfo is None else pd.Timestamp(date_start)
+        expression = conjoin(
+            (ds.field('month') >= date_start.strftime('%Y-%m'))
+            & (ds.field('utc_datetime') >= pa.scalar(date_start, pa.timestamp('ns', 'UTC')))
+        )
+    if date_end is not None:
+        date_end = pd.Timestamp(date_end, tz='UTC') if date_end.tzinfo is None else pd.Timestamp(date_end)
+        expression = conjoin(
+            (ds.field('month') <= date_end.strftime('%Y-%m'))
+            & (ds.field('utc_datetime') < pa.scalar(date_end, pa.timestamp('ns', 'UTC')))
+        )
+
+    read_columns = None
+    if columns is not None:
+        # needed to restore (user, date) order across partitions
+        read_columns = list(dict.fromkeys(list(columns) + ['user_id', 'utc_datetime', 'record_id']))
+    if not exists(store_dir):
+        return pd.DataFrame(columns=columns)
+    df = _to_pandas(dataset(store_dir).to_table(columns=read_columns, filter=expression))
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--from_hdf', help='convert an existing retention_features.h5 into the store')
+    args = parser.parse_args()
+    if args.from_hdf is not None:
+        df = pd.read_hdf(args.from_hdf, 'df')
+        write_features(df)
+        print(f'wrote {len(df)} rows to {STORE_DIR}')
@@ -2,77 +2,65 @@
 # coding: utf-8
 
 import argparse
-import random
-import numpy as np
 from collections import Counter
-from typing import Dict
 
-import torch
 import transformers
-from transformers import (
-    DistilBertTokenizerFast,
-    BertTokenizerFast,
-    Trainer,
-    TrainingArguments,
-    EvalPrediction,
-)
-from sklearn.metrics import roc_auc_score, accuracy_score
-from sklearn.calibration import calibration_curve
+from torch.utils.data import SequentialSampler
+from transformers import DistilBertTokenizerFast, Trainer, TrainingArguments
+from transformers.trainer_pt_utils import LengthGroupedSampler
 
 from karl.config import settings
 from .data import (  # noqa: F401
     RetentionInput,
     RetentionDataset,
+    SharedEncoderRetentionDataset,
     retention_data_collator,
     feature_fields,
 )
-from .model_distilbert import DistilBertRetentionModelConfig, DistilBertRetentionModel
-from .model_bert import BertRetentionModelConfig, BertRetentionModel
-from .model_norep import NorepRetentionModelConfig, NorepRetentionModel
+from .common import (  # noqa: F401
+    model_cls,
+    config_cls,
+    tokenizer_cls,
+    full_name,
+    set_seed,
+    compute_metrics,
+    get_datasets,
+)
+
+try:
+    from .model_norep import NorepRetentionModelConfig, NorepRetentionModel
+    model_cls['norep'] = NorepRetentionModel
+    config_cls['norep'] = NorepRetentionModelConfig
+    tokenizer_cls['norep'] = DistilBertTokenizerFast
+    full_name['norep'] = 'distilbert-base-uncased'
+except ImportError:
+    # the no-representation baseline is not part of every checkout
+    pass
 
 transformers.logging.set_verbosity_info()
 
-model_cls = {
-    'distilbert': DistilBertRetentionModel,
-    'bert': BertRetentionModel,
-    'norep': NorepRetentionModel,
-}
-config_cls = {
-    'distilbert': DistilBertRetentionModelConfig,
-    'bert': BertRetentionModelConfig,
-    'norep': NorepRetentionModelConfig,
-}
-tokenizer_cls = {
-    'distilbert': DistilBertTokenizerFast,
-    'bert': BertTokenizerFast,
-    'norep': DistilBertTokenizerFast,
-}
-full_name = {
-    'distilbert': 'distilbert-base-uncased',
-    'bert': 'bert-base-uncased',
-    'norep': 'distilbert-base-uncased',
-}
-
-
-def set_seed(seed: int):
-    random.seed(seed)
-    np.random.seed(seed)
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
-    # ^^ safe to call this function even if cuda is not available
-
-
-def compute_metrics(p: EvalPrediction) -> Dict:
-    predicted_labels = p.predictions > 0.5
-    acc = accuracy_score(p.label_ids, predicted_labels)
-    auc = roc_auc_score(p.label_ids, p.predictions)
-    prob_true, prob_pred = calibration_curve(p.label_ids, p.predictions, n_bins=10)
-    ece = np.mean(np.absolute(prob_true - prob_pred))
-    return {
-        "acc": acc,
-        "auc": auc,
-        "ece": ece,
-    }
+
+class RetentionTrainer(Trainer):
+    '''
+    `Trainer` that, with `group_by_length`, takes example lengths from the
+    dataset's `lengths` array instead of indexing every example to measure
+    it, so batches of similar length are cheap to form. Evaluation keeps
+    the dataset order, so `predict` outputs line up with the examples.
+    '''
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.args.group_by_length and hasattr(self.train_dataset, 'lengths'):
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=self.train_dataset.lengths.tolist(),
+            )
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def _get_eval_sampler(self, eval_dataset, *args, **kwargs):
+        # `Trainer` would group evaluation by length too, shuffling the predictions
+        if self.args.group_by_length and eval_dataset is not None:
+            return SequentialSampler(eval_dataset) if self.args.world_size <= 1 else None
+        return super()._get_eval_sampler(eval_dataset, *args, **kwargs)
 
 
 def train(
@@ -87,8 +75,7 @@ def train(
     config = config_cls[model_name](retention_feature_size=retention_feature_size)
     model = model_cls[model_name](config=config)
     tokenizer = tokenizer_cls[model_name].from_pretrained(full_name[model_name])
-    train_dataset = RetentionDataset(settings.DATA_DIR, f'train_{fold}', tokenizer)
-    test_dataset = RetentionDataset(settings.DATA_DIR, f'test_{fold}', tokenizer)
+    train_dataset, test_dataset, data_collator = get_datasets(fold, tokenizer)
     training_args = TrainingArguments(
         output_dir=f'{output_dir}/retention_hf_{model_name}_{fold}_{seed}',
         num_train_epochs=10,
@@ -96,13 +83,14 @@ def train(
         per_device_eval_batch_size=64,
         learning_rate=2e-05,
         save_steps=2000,
+        group_by_length=True,
     )
-    trainer = Trainer(
+    trainer = RetentionTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
-        data_collator=retention_data_collator,
+        data_collator=data_collator,
         compute_metrics=compute_metrics,
     )
     trainer.train(resume)
@@ -111,8 +99,7 @@ def train(
 
 def test(model_name, output_dir=f'{settings.CODE_DIR}/output', fold='new_card', seed=1):
     tokenizer = tokenizer_cls[model_name].from_pretrained(full_name[model_name])
-    train_dataset = RetentionDataset(settings.DATA_DIR, f'train_{fold}', tokenizer)
-    test_dataset = RetentionDataset(settings.DATA_DIR, f'test_{fold}', tokenizer)
+    train_dataset, test_dataset, data_collator = get_datasets(fold, tokenizer)
 
     training_args = TrainingArguments(
         output_dir=f'{output_dir}/retention_hf_{model_name}_{fold}_{seed}',
@@ -129,7 +116,7 @@ def test(model_name, output_dir=f'{settings.CODE_DIR}/output', fold='new_card',
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
-        data_collator=retention_data_collator,
+        data_collator=data_collator,
         compute_metrics=compute_metrics,
     )
 
@@ -143,15 +130,14 @@ def test_majority_baseline(fold='new_card'):
     tokenizer = DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased')
     train_dataset = RetentionDataset(settings.DATA_DIR, f'train_{fold}', tokenizer)
     test_dataset = RetentionDataset(settings.DATA_DIR, f'test_{fold}', tokenizer)
-    labels = [x.label for x in train_dataset]
-    label_majority = Counter(labels).most_common()[0][0]
-    print(sum([x.label == label_majority for x in test_dataset]) / len(test_dataset))
+    label_majority = Counter(train_dataset.labels.tolist()).most_common()[0][0]
+    print((test_dataset.labels == label_majority).mean())
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--model_name', choices=['distilbert', 'bert', 'norep'])
-    parser.add_argument('--fold', choices=['new_card', 'old_card'])
+    parser.add_argument('--model_name', choices=list(model_cls))
+    parser.add_argument('--fold', choices=['new_card', 'old_card', 'all'])
     parser.add_argument('--seed', type=int)
     parser.add_argument('--train', type=bool, default=False)
     parser.add_argument('--resume')
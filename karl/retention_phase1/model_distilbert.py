@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import copy
+import functools
 import torch
 import torch.nn as nn
 
@@ -10,6 +12,9 @@ from transformers import (
     DistilBertPreTrainedModel,
 )
 
+from karl.config import settings
+from .backend import synthetic_batch, check_parity
+
 
 class DistilBertRetentionModelConfig(PretrainedConfig):
 
@@ -63,6 +68,17 @@ class DistilBertRetentionModelConfig(PretrainedConfig):
         return self.n_layers
 
 
+def retention_classifier(hidden_dim, dropout):
+    return nn.Sequential(
+        nn.Dropout(dropout),
+        nn.Linear(hidden_dim, hidden_dim),
+        nn.GELU(),
+        nn.LayerNorm(hidden_dim),
+        nn.Dropout(dropout),
+        nn.Linear(hidden_dim, 1),
+    )
+
+
 class DistilBertRetentionModel(DistilBertPreTrainedModel):
 
     def __init__(self, config, **kwargs):
@@ -70,17 +86,35 @@ class DistilBertRetentionModel(DistilBertPreTrainedModel):
         self.retention_feature_size = config.retention_feature_size
         self.distilbert = DistilBertModel(config)
         hidden_dim = config.dim + config.retention_feature_size
-        self.classifier = nn.Sequential(
-            nn.Dropout(config.seq_classif_dropout),
-            nn.Linear(hidden_dim, hidden_dim),
-            nn.GELU(),
-            nn.LayerNorm(hidden_dim),
-            nn.Dropout(config.seq_classif_dropout),
-            nn.Linear(hidden_dim, 1),
-        )
+        self.classifier = retention_classifier(hidden_dim, config.seq_classif_dropout)
         self.loss_fn = nn.BCELoss()
         self.init_weights()
 
+    def encode(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        head_mask=None,
+        inputs_embeds=None,
+    ):
+        """Card text embedding fed to the classifier, i.e. the [CLS] hidden state. (bs, dim)"""
+        bert_output = self.distilbert(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+        )
+        return bert_output[0][:, 0]
+
+    def forward_head(self, card_embedding, retention_features=None):
+        """Recall probability from a precomputed `encode` output, without running the encoder. (bs,)"""
+        x = card_embedding
+        if self.retention_feature_size > 0:
+            x = torch.cat((x, retention_features), axis=1)
+
+        x = self.classifier(x)
+        return torch.sigmoid(x)[:, 0]
+
     def forward(
         self,
         input_ids=None,
@@ -99,12 +133,122 @@ class DistilBertRetentionModel(DistilBertPreTrainedModel):
             output_attentions=output_attentions,
         )
         hidden_state = bert_output[0]  # (bs, seq_len, dim)
-        x = hidden_state[:, 0]  # (bs, dim)
-        if self.retention_feature_size > 0:
-            x = torch.cat((x, retention_features), axis=1)
+        x = self.forward_head(hidden_state[:, 0], retention_features)
 
-        x = self.classifier(x)
-        x = torch.sigmoid(x)[:, 0]
+        outputs = (x,) + bert_output[1:]
+
+        if labels is not None:
+            loss = self.loss_fn(x, labels)
+            outputs = (loss,) + outputs
+
+        return outputs  # (loss), logits, (hidden_states), (attentions)
+
+
+class DistilBertSharedEncoderRetentionModel(DistilBertPreTrainedModel):
+    """
+    One encoder shared by two classifier heads: `classifier_new_card` on the
+    card embedding alone and `classifier_old_card` on the card embedding plus
+    `retention_features`. `is_new_card` routes each example to its head, so
+    new and old cards go through the same batched encoder pass.
+    """
+
+    def __init__(self, config, **kwargs):
+        super().__init__(config)
+        self.retention_feature_size = config.retention_feature_size
+        self.distilbert = DistilBertModel(config)
+        self.classifier_new_card = retention_classifier(config.dim, config.seq_classif_dropout)
+        self.classifier_old_card = retention_classifier(
+            config.dim + config.retention_feature_size, config.seq_classif_dropout)
+        self.loss_fn = nn.BCELoss()
+        self.init_weights()
+
+    @classmethod
+    def from_pair(cls, model_new_card, model_old_card, encoder='old_card', tolerance=None):
+        """
+        Combine the heads of two `DistilBertRetentionModel`s, keeping the encoder of one of them.
+
+        The other head was trained on another encoder, so the combined model
+        must predict within `tolerance` (`MODEL_PARITY_TOLERANCE` by default)
+        of both models on synthetic batches, or it is refused with a
+        `ValueError`; train with fold `all` instead.
+        """
+        config = copy.deepcopy(model_old_card.config)
+        model = cls(config)
+        source = model_old_card if encoder == 'old_card' else model_new_card
+        model.distilbert.load_state_dict(source.distilbert.state_dict())
+        model.classifier_new_card.load_state_dict(model_new_card.classifier.state_dict())
+        model.classifier_old_card.load_state_dict(model_old_card.classifier.state_dict())
+
+        tolerance = settings.MODEL_PARITY_TOLERANCE if tolerance is None else tolerance
+        model.eval()
+        batch = synthetic_batch(16, 64, config.retention_feature_size, config.vocab_size)
+        is_new_card = torch.ones(16, dtype=torch.bool)
+        diffs = {
+            'new_card': check_parity(
+                model_new_card.eval(),
+                functools.partial(model, is_new_card=is_new_card),
+                [{k: v for k, v in batch.items() if k != 'retention_features'}],
+            ),
+            'old_card': check_parity(
+                model_old_card.eval(),
+                functools.partial(model, is_new_card=~is_new_card),
+                [batch],
+            ),
+        }
+        for fold, diff in diffs.items():
+            if diff > tolerance:
+                raise ValueError(f'{fold} head on the {encoder} encoder is off by {diff:.4f} from its own model')
+        return model
+
+    def encode(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        head_mask=None,
+        inputs_embeds=None,
+    ):
+        bert_output = self.distilbert(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+        )
+        return bert_output[0][:, 0]
+
+    def forward_head(self, card_embedding, retention_features=None, is_new_card=None):
+        if is_new_card is None:
+            # without routing, examples with retention features are old cards
+            is_new_card = torch.full(
+                (card_embedding.shape[0],), retention_features is None, device=card_embedding.device)
+        is_new_card = is_new_card.bool()
+        x = torch.zeros(card_embedding.shape[0], device=card_embedding.device, dtype=card_embedding.dtype)
+        if is_new_card.any():
+            x[is_new_card] = self.classifier_new_card(card_embedding[is_new_card])[:, 0]
+        if (~is_new_card).any():
+            old = torch.cat((card_embedding[~is_new_card], retention_features[~is_new_card]), axis=1)
+            x[~is_new_card] = self.classifier_old_card(old)[:, 0]
+        return torch.sigmoid(x)
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        head_mask=None,
+        inputs_embeds=None,
+        retention_features=None,
+        is_new_card=None,
+        output_attentions=None,
+        labels=None,
+    ):
+        bert_output = self.distilbert(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            output_attentions=output_attentions,
+        )
+        hidden_state = bert_output[0]  # (bs, seq_len, dim)
+        x = self.forward_head(hidden_state[:, 0], retention_features, is_new_card)
 
         outputs = (x,) + bert_output[1:]
 
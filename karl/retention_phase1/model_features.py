@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Feature-only retention model, the cheap first tier of cascaded scoring.
+
+A logistic regression over the normalized `feature_fields` of old cards,
+trained on the same `RetentionDataset` folds as the DistilBERT models. At
+serving time it scores every old-card candidate, and only candidates whose
+served score lies within `margin` of the recall target window are re-scored
+by the DistilBERT model. `margin` is calibrated on the test fold as a high
+quantile of the gap between the served scores of the two models, so cards
+DistilBERT would put in the window are rarely dropped.
+
+    python -m karl.retention_phase1.model_features --calibrate
+'''
+
+import os
+import json
+import argparse
+import numpy as np
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+from transformers import DistilBertTokenizerFast
+
+from karl.config import settings
+from karl.retention_phase1.data import RetentionDataset, retention_data_collator, feature_fields
+from karl.retention_phase1.backend import served_scores
+
+
+class FeatureRetentionModel(nn.Module):
+
+    def __init__(self, retention_feature_size: int = len(feature_fields), margin: float = None):
+        super().__init__()
+        self.retention_feature_size = retention_feature_size
+        self.margin = settings.MODEL_CASCADE_MARGIN if margin is None else margin
+        self.linear = nn.Linear(retention_feature_size, 1)
+        self.loss_fn = nn.BCELoss()
+
+    def forward(self, retention_features, labels=None):
+        x = torch.sigmoid(self.linear(retention_features)[:, 0])
+        outputs = (x,)
+        if labels is not None:
+            outputs = (self.loss_fn(x, labels),) + outputs
+        return outputs  # (loss), logits
+
+    def near_window(self, scores: torch.Tensor, lowest: float, highest: float) -> torch.Tensor:
+        '''
+        Mask of the served `scores` that could be inside [lowest, highest]
+        according to the full model.
+        '''
+        return (scores >= lowest - self.margin) & (scores <= highest + self.margin)
+
+    def save_pretrained(self, model_dir: str) -> None:
+        os.makedirs(model_dir, exist_ok=True)
+        torch.save(self.state_dict(), f'{model_dir}/model.pt')
+        with open(f'{model_dir}/config.json', 'w') as f:
+            json.dump({'retention_feature_size': self.retention_feature_size, 'margin': self.margin}, f)
+
+    @classmethod
+    def from_pretrained(cls, model_dir: str) -> 'FeatureRetentionModel':
+        with open(f'{model_dir}/config.json') as f:
+            config = json.load(f)
+        model = cls(**config)
+        model.load_state_dict(torch.load(f'{model_dir}/model.pt'))
+        return model
+
+
+def load_fold(fold: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''Normalized retention features and labels of an old-card fold.'''
+    tokenizer = DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased')
+    dataset = RetentionDataset(settings.DATA_DIR, fold, tokenizer)
+    retention_features = torch.tensor(dataset.retention_features, dtype=torch.float)
+    labels = torch.tensor(dataset.labels, dtype=torch.float)
+    return retention_features, labels
+
+
+def train(max_iter: int = 100, weight_decay: float = 1e-4) -> FeatureRetentionModel:
+    '''Full-batch L-BFGS on `train_old_card`.'''
+    retention_features, labels = load_fold('train_old_card')
+    model = FeatureRetentionModel(retention_features.shape[1])
+    optimizer = torch.optim.LBFGS(model.parameters(), max_iter=max_iter, line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = model(retention_features, labels)[0] + weight_decay * model.linear.weight.pow(2).sum()
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    model.eval()
+    return model
+
+
+@torch.inference_mode()
+def calibrate(model: FeatureRetentionModel, model_dir: str, quantile: float = 0.99, batch_size: int = 256) -> float:
+    '''
+    Set `model.margin` to the `quantile` of |feature model - DistilBERT|
+    on `test_old_card`, using the DistilBERT checkpoint in `model_dir`. The
+    gap is taken between served scores, the scale of the target window.
+    '''
+    from karl.retention_phase1.model_distilbert import DistilBertRetentionModel
+
+    tokenizer = DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased')
+    dataset = RetentionDataset(settings.DATA_DIR, 'test_old_card', tokenizer)
+    full_model = DistilBertRetentionModel.from_pretrained(model_dir)
+    full_model.eval()
+
+    gaps = []
+    for i in range(0, len(dataset), batch_size):
+        batch = retention_data_collator([dataset[j] for j in range(i, min(i + batch_size, len(dataset)))])
+        batch.pop('labels')
+        y_full = served_scores(full_model(**batch)[0])
+        y_cheap = served_scores(model(batch['retention_features'])[0])
+        gaps.append((y_full - y_cheap).abs().numpy())
+    model.margin = float(np.quantile(np.concatenate(gaps), quantile))
+    return model.margin
+
+
+@torch.inference_mode()
+def test(model: FeatureRetentionModel) -> float:
+    retention_features, labels = load_fold('test_old_card')
+    y = model(retention_features)[0]
+    return ((y > 0.5).float() == labels).float().mean().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', default=f'{settings.CODE_DIR}/output/retention_features_old_card')
+    parser.add_argument('--calibrate', type=bool, default=False)
+    parser.add_argument('--quantile', type=float, default=0.99)
+    args = parser.parse_args()
+
+    model = train()
+    print('test accuracy', '%.4f' % test(model))
+    if args.calibrate:
+        margin = calibrate(model, f'{settings.CODE_DIR}/output/retention_hf_distilbert_old_card', args.quantile)
+        print('margin', '%.4f' % margin)
+    model.save_pretrained(args.output_dir)
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Online fine-tuning of the retention heads from fresh study records.
+
+A background learner for each of the `new_card` and `old_card` DistilBERT
+checkpoints the model server loads. Every round it refreshes the feature
+store with the records that arrived since the last round (see
+`get_retention_features_df`), and trains the classifier head on them in
+mini-batches on CPU, the encoder staying frozen as in `train_frozen`. Card
+embeddings come from the checkpoint's `CardEmbeddingCache`, so only cards
+created since it was built are encoded.
+
+Before publishing, the newest `validation_fraction` of a round's records is
+held out, and the update is kept only if its log loss on them is at most
+`tolerance` worse than that of the head before the update; otherwise the
+head and optimizer are rolled back. The learner's `Cursor` advances past
+the records trained on only, so held-out records are read again and
+trained on in the next round, after a restart too. A kept update is saved as a new version under
+
+    {output_dir}/retention_online/{fold}/{version}
+
+with its card embeddings and metrics, and copied over the served
+checkpoint, file by file, which the model server picks up with its
+registry watcher or the `/api/karl/reload` call made after publishing.
+
+    python -m karl.retention_phase1.online --interval 600
+'''
+
+import os
+import copy
+import json
+import time
+import shutil
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import pytz
+import torch
+import requests
+from transformers import DistilBertTokenizerFast, EvalPrediction
+
+from karl.config import settings
+from karl.retention_phase1 import feature_store
+from karl.retention_phase1.data import get_retention_features_df, feature_fields
+from karl.retention_phase1.model_distilbert import DistilBertRetentionModel
+from karl.retention_phase1.backend import model_version, get_device, configure_threads
+from karl.retention_phase1.embedding_cache import CardEmbeddingCache, encode_token_ids, save_card_embeddings
+from karl.retention_phase1.token_cache import TokenCache
+from karl.retention_phase1.common import compute_metrics
+
+logger = logging.getLogger('retention')
+
+WEIGHT_FILES = ['pytorch_model.bin', 'model.safetensors']
+COLUMNS = ['record_id', 'user_id', 'card_id', 'card_text', 'is_new_fact', 'response', 'utc_datetime'] + feature_fields
+
+
+class OnlineLearner:
+    '''
+    Incremental trainer of the head of one served checkpoint. The optimizer
+    state carries over from round to round, like one long training run.
+    '''
+
+    def __init__(
+        self,
+        fold: str,
+        output_dir: str = f'{settings.CODE_DIR}/output',
+        learning_rate: float = 1e-4,
+        batch_size: int = 256,
+        num_epochs: int = 1,
+        validation_fraction: float = 0.2,
+        tolerance: float = 0.0,
+        device: str = None,
+    ):
+        self.fold = fold
+        self.output_dir = output_dir
+        self.model_dir = f'{output_dir}/retention_hf_distilbert_{fold}'
+        self.versions_dir = f'{output_dir}/retention_online/{fold}'
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.validation_fraction = validation_fraction
+        self.tolerance = tolerance
+        self.device = get_device(device)
+
+        self.model = DistilBertRetentionModel.from_pretrained(self.model_dir).to(self.device)
+        self.model.eval()
+        self.model.distilbert.requires_grad_(False)
+        self.optimizer = torch.optim.AdamW(self.model.classifier.parameters(), lr=learning_rate)
+        self.cache = CardEmbeddingCache(self.model_dir, self.model.config.dim)
+        self.token_cache = None
+        self.mean = self.std = None
+        if self.model.retention_feature_size > 0:
+            self.mean = np.asarray(torch.load(f'{settings.DATA_DIR}/cached_mean'), dtype=np.float32)
+            self.std = np.asarray(torch.load(f'{settings.DATA_DIR}/cached_std'), dtype=np.float32)
+
+    def embed(self, card_ids: List[str], card_texts: List[str]) -> np.ndarray:
+        '''Card embeddings, from the cache or encoded once with the frozen encoder.'''
+        texts = dict(zip(card_ids, card_texts))
+        return self.cache.lookup_or_encode(card_ids, lambda missing_ids: self.encode(
+            missing_ids, [texts[card_id] for card_id in missing_ids]))
+
+    def encode(self, card_ids: List[str], card_texts: List[str]) -> np.ndarray:
+        '''Run the frozen encoder on cards, tokenizing them at most once.'''
+        if self.token_cache is None:
+            self.token_cache = TokenCache(DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased'))
+        input_ids = self.token_cache.lookup(card_ids, card_texts)
+        return encode_token_ids(self.model, input_ids, self.token_cache.tokenizer.pad_token_id, device=self.device)
+
+    def tensors(self, df: pd.DataFrame):
+        embeddings = torch.from_numpy(self.embed(df.card_id.tolist(), df.card_text.tolist())).to(self.device)
+        retention_features = None
+        if self.model.retention_feature_size > 0:
+            x = (df[feature_fields].to_numpy(dtype=np.float32) - self.mean) / self.std
+            retention_features = torch.from_numpy(x.astype(np.float32)).to(self.device)
+        labels = torch.from_numpy(df.response.to_numpy(dtype=np.float32)).to(self.device)
+        return embeddings, retention_features, labels
+
+    @torch.inference_mode()
+    def predict(self, embeddings, retention_features) -> torch.Tensor:
+        self.model.classifier.eval()
+        return torch.cat([
+            self.model.forward_head(
+                embeddings[i: i + 4096],
+                None if retention_features is None else retention_features[i: i + 4096],
+            )
+            for i in range(0, len(embeddings), 4096)
+        ])
+
+    def fit(self, embeddings, retention_features, labels) -> float:
+        '''Mini-batch passes over the examples; returns the mean loss of the last one.'''
+        self.model.classifier.train()
+        for _ in range(self.num_epochs):
+            order = torch.randperm(len(labels))
+            total_loss = 0
+            for i in range(0, len(order), self.batch_size):
+                batch = order[i: i + self.batch_size]
+                x = self.model.forward_head(
+                    embeddings[batch],
+                    None if retention_features is None else retention_features[batch],
+                )
+                loss = self.model.loss_fn(x, labels[batch])
+                self.optimizer.zero_grad()
+                loss.backward()
+                self.optimizer.step()
+                total_loss += loss.item() * len(batch)
+        self.model.classifier.eval()
+        return total_loss / max(len(order), 1)
+
+    def split(self, df: pd.DataFrame):
+        '''The records of `df` to train on, and the newest `validation_fraction` of them held out.'''
+        df = df.sort_values('utc_datetime', kind='mergesort', ignore_index=True)
+        n_validation = int(len(df) * self.validation_fraction)
+        if n_validation == 0 or n_validation == len(df):
+            raise ValueError(f'{len(df)} records are too few to hold out {self.validation_fraction} of them')
+        return df.iloc[:len(df) - n_validation], df.iloc[len(df) - n_validation:]
+
+    def step(self, df: pd.DataFrame) -> Dict:
+        '''
+        Train on the records of `df` but the held-out ones, keeping the update
+        only if it passes the validation guard.
+
+        :return: metrics of the round, with `accepted`.
+        '''
+        df_train, df_validation = self.split(df)
+
+        x_validation = self.tensors(df_validation)
+        labels = x_validation[2]
+        before = self.predict(*x_validation[:2])
+        state = copy.deepcopy((self.model.classifier.state_dict(), self.optimizer.state_dict()))
+        train_loss = self.fit(*self.tensors(df_train))
+        after = self.predict(*x_validation[:2])
+
+        loss_before = self.model.loss_fn(before, labels).item()
+        loss_after = self.model.loss_fn(after, labels).item()
+        accepted = loss_after <= loss_before + self.tolerance
+        if not accepted:
+            self.model.classifier.load_state_dict(state[0])
+            self.optimizer.load_state_dict(state[1])
+        result = {
+            'fold': self.fold,
+            'n_train': len(df_train),
+            'n_validation': len(df_validation),
+            'train_loss': train_loss,
+            'validation_loss_before': loss_before,
+            'validation_loss_after': loss_after,
+            'accepted': bool(accepted),
+        }
+        if labels.min() != labels.max():
+            for key, value in compute_metrics(EvalPrediction(after.numpy(), labels.numpy())).items():
+                result[f'validation_{key}'] = float(value)
+        return result
+
+    def publish(self, metrics: Dict = None, keep: int = 5) -> str:
+        '''
+        Save the current head as a new version and install it where the
+        model server loads it.
+
+        :return: the version directory.
+        '''
+        version_dir = f'{self.versions_dir}/{datetime.now(pytz.utc).strftime("%Y%m%dT%H%M%S.%f")}'
+        self.model.save_pretrained(version_dir)
+        # the encoder did not change, so neither did the card embeddings
+        card_ids = list(self.cache.index) + list(self.cache.extra)
+        embeddings, _ = self.cache.lookup(card_ids)
+        save_card_embeddings(version_dir, card_ids, embeddings)
+        with open(f'{version_dir}/online_metrics.json', 'w') as f:
+            json.dump(metrics or {}, f)
+
+        # weights first and embeddings last, each file renamed into place;
+        # copies keep their modification times, hence the same `model_version`
+        names = [x for x in WEIGHT_FILES if os.path.exists(f'{version_dir}/{x}')]
+        for name in names + ['config.json', 'card_embeddings.npy', 'card_embeddings.json']:
+            shutil.copy2(f'{version_dir}/{name}', f'{self.model_dir}/{name}.tmp')
+            os.replace(f'{self.model_dir}/{name}.tmp', f'{self.model_dir}/{name}')
+        for name in WEIGHT_FILES:
+            if name not in names and os.path.exists(f'{self.model_dir}/{name}'):
+                os.remove(f'{self.model_dir}/{name}')
+        self.cache = CardEmbeddingCache(self.model_dir, self.model.config.dim)
+
+        # older versions beyond `keep` are dropped, the newest ones stay for rollback
+        versions = sorted(x for x in os.listdir(self.versions_dir) if os.path.isdir(f'{self.versions_dir}/{x}'))
+        for name in versions[:-keep]:
+            shutil.rmtree(f'{self.versions_dir}/{name}', ignore_errors=True)
+        logger.info(f'published {self.fold} {model_version(self.model_dir)} from {version_dir}')
+        return version_dir
+
+
+def notify_server() -> None:
+    '''Ask the model server to load the new checkpoints now instead of at its next poll.'''
+    if settings.MODEL_API_URL is None:
+        return
+    try:
+        requests.post(f'{settings.MODEL_API_URL}/api/karl/reload', timeout=10).raise_for_status()
+    except requests.RequestException:
+        logger.exception('failed to notify the model server, it will pick up the checkpoints when it polls')
+
+
+class Cursor:
+    '''
+    Records a learner has consumed, kept in `{versions_dir}/cursor.json`: the
+    date of the newest one and the ids of those within `lookback` of it, as
+    records committed late can still land in that window.
+    '''
+
+    def __init__(self, versions_dir: str, lookback: timedelta = timedelta(hours=1)):
+        self.path = f'{versions_dir}/cursor.json'
+        self.lookback = lookback
+        self.date, self.recent = None, {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.date = pd.Timestamp(state['date'])
+            self.recent = {record_id: pd.Timestamp(date) for record_id, date in state['recent']}
+
+    @property
+    def date_start(self) -> datetime:
+        return None if self.date is None else (self.date - self.lookback).to_pydatetime()
+
+    def new_records(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df[~df.record_id.isin(list(self.recent))].reset_index(drop=True)
+
+    def advance(self, df: pd.DataFrame) -> None:
+        if len(df) == 0:
+            return
+        dates = pd.to_datetime(df.utc_datetime, utc=True)
+        self.date = dates.max() if self.date is None else max(self.date, dates.max())
+        self.recent.update(zip(df.record_id.tolist(), dates))
+        self.recent = {x: date for x, date in self.recent.items() if date >= self.date - self.lookback}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump({
+                'date': self.date.isoformat(),
+                'recent': [[x, date.isoformat()] for x, date in self.recent.items()],
+            }, f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+def run(
+    folds: List[str] = ('new_card', 'old_card'),
+    output_dir: str = f'{settings.CODE_DIR}/output',
+    interval: float = 600,
+    min_records: int = 1000,
+    once: bool = False,
+    **kwargs,
+) -> None:
+    '''
+    Every `interval` seconds, train each head once at least `min_records`
+    records of its kind are not trained on yet, and publish the updates that
+    pass the guard. With `once`, run a single round.
+
+    On its first run a learner starts from the records added after it, as
+    the served heads were trained on the ones already in the store.
+    '''
+    configure_threads()
+    learners = {fold: OnlineLearner(fold, output_dir, **kwargs) for fold in folds}
+    cursors = {fold: Cursor(learner.versions_dir) for fold, learner in learners.items()}
+    for cursor in cursors.values():
+        if cursor.date is None:
+            cursor.advance(get_retention_features_df(columns=['record_id', 'utc_datetime']))
+    while True:
+        t0 = time.monotonic()
+        # add the records that arrived since the last round to the store
+        get_retention_features_df(refresh=True, columns=['record_id'], date_start=datetime.now(pytz.utc))
+
+        published = False
+        for fold, learner in learners.items():
+            df = cursors[fold].new_records(
+                feature_store.load_features(columns=COLUMNS, date_start=cursors[fold].date_start))
+            df = df[df.is_new_fact == (fold == 'new_card')]
+            if len(df) < min_records:
+                continue
+            result = learner.step(df)
+            # held-out records stay new until a later round trains on them
+            cursors[fold].advance(learner.split(df)[0])
+            logger.info(f'online update {result}')
+            if result['accepted']:
+                learner.publish(result)
+                published = True
+        if published:
+            notify_server()
+        if once:
+            return
+        time.sleep(max(0, interval - (time.monotonic() - t0)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folds', nargs='+', choices=['new_card', 'old_card'], default=['new_card', 'old_card'])
+    parser.add_argument('--output_dir', default=f'{settings.CODE_DIR}/output')
+    parser.add_argument('--interval', type=float, default=600, help='seconds between rounds')
+    parser.add_argument('--min_records', type=int, default=1000)
+    parser.add_argument('--learning_rate', type=float, default=1e-4)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--num_epochs', type=int, default=1)
+    parser.add_argument('--validation_fraction', type=float, default=0.2)
+    parser.add_argument('--tolerance', type=float, default=0.0, help='log loss increase allowed by the guard')
+    parser.add_argument('--once', type=bool, default=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run(
+        folds=args.folds,
+        output_dir=args.output_dir,
+        interval=args.interval,
+        min_records=args.min_records,
+        once=args.once,
+        learning_rate=args.learning_rate,
+        batch_size=args.batch_size,
+        num_epochs=args.num_epochs,
+        validation_fraction=args.validation_fraction,
+        tolerance=args.tolerance,
+    )
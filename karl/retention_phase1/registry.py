@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, List
+
+from karl.retention_phase1.backend import model_version
+
+logger = logging.getLogger('retention')
+
+
+def checkpoint_version(model_dirs: List[str]) -> str:
+    '''Short id of a set of checkpoints; missing directories are skipped.'''
+    h = hashlib.sha1()
+    for model_dir in model_dirs:
+        if os.path.exists(model_dir):
+            h.update(f'{os.path.basename(model_dir)}:{model_version(model_dir)}'.encode())
+    return h.hexdigest()[:12]
+
+
+class ModelRegistry:
+    '''
+    Holds the model being served and swaps in new versions without a restart.
+
+    `load_fn` builds a ready-to-serve model (loaded and warmed) with a
+    `version` attribute. A reload runs `load_fn` in a background thread while
+    the current model keeps serving, then replaces the reference in one
+    assignment, so every request sees either the old or the new model, never
+    a mix. Requests that already hold the old model finish on it.
+
+    With `poll_interval` > 0 a watcher thread compares `version_fn()` to the
+    serving version and reloads once the on-disk version has been the same
+    for two polls in a row, so a checkpoint still being written is not
+    picked up. Like `MicroBatcher`, the watcher starts lazily in the process
+    that serves, so a registry created before forking is safe to use. A
+    supervisor that reloads for its workers sets `poll_interval` to 0 and
+    calls `poll` itself.
+    '''
+
+    def __init__(
+        self,
+        load_fn: Callable[[], Any],
+        version_fn: Callable[[], str],
+        poll_interval: float = 0,
+    ):
+        self.load_fn = load_fn
+        self.version_fn = version_fn
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._loading = False
+        self._pid = None
+        self._pending = None
+        self._failed = None
+        self.current = load_fn()
+
+    @property
+    def version(self) -> str:
+        return self.current.version
+
+    def get(self):
+        '''The model to serve this request with.'''
+        self._ensure_watcher()
+        return self.current
+
+    def _ensure_watcher(self):
+        if self.poll_interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._loading = False
+            threading.Thread(target=self._watch, daemon=True).start()
+
+    def reload(self, block: bool = False) -> bool:
+        '''
+        Load the checkpoints on disk and swap them in.
+
+        :return: False if a reload is already in progress.
+        '''
+        with self._lock:
+            if self._loading:
+                return False
+            self._loading = True
+        if block:
+            self._load()
+        else:
+            threading.Thread(target=self._load, daemon=True).start()
+        return True
+
+    def _load(self) -> bool:
+        try:
+            t0 = time.monotonic()
+            model = self.load_fn()
+            old_version = self.current.version
+            self.current = model
+            logger.info(f'model {old_version} -> {model.version}, loaded in {time.monotonic() - t0:.1f}s')
+            return True
+        except Exception:
+            logger.exception(f'failed to load new model version, keeping {self.current.version}')
+            return False
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def poll(self) -> bool:
+        '''
+        One watcher check: reload, blocking, if the on-disk version differs
+        from the serving one and was the same at the previous check.
+
+        :return: True if a new model was swapped in.
+        '''
+        try:
+            version = self.version_fn()
+        except Exception:
+            logger.exception('failed to read model version')
+            return False
+        loaded = False
+        if version != self.current.version and version == self._pending and version != self._failed:
+            with self._lock:
+                if self._loading:
+                    return False
+                self._loading = True
+            loaded = self._load()
+            if not loaded:
+                # do not retry a broken checkpoint until it changes again
+                self._failed = version
+        self._pending = version
+        return loaded
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.poll()
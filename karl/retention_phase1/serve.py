@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Prefork runner for the retention model server.
+
+The parent process loads, quantizes and freezes `RetentionModel` once, binds
+the listening socket and then forks `n_workers` uvicorn workers that accept
+on that socket. Model weights are moved to shared memory before forking and
+are never written afterwards, so every worker maps the same physical pages
+and memory does not grow with the number of workers.
+
+Each worker gets its own intra-op thread budget, `cpu_count // n_workers`
+unless `MODEL_NUM_THREADS` is set, so the workers together do not
+oversubscribe the cores.
+
+Workers never reload the model themselves: that would give each of them a
+private copy, loaded with the parent's single-thread setting. The parent
+polls for new checkpoints instead, every `MODEL_RELOAD_INTERVAL` seconds
+and with the two-poll check of `ModelRegistry`. After a reload it shares
+the new weights, starts a fresh set of workers and stops the old ones, which
+finish the requests they hold.
+
+    python -m karl.retention_phase1.serve --n_workers 4 --port 8001
+'''
+
+import os
+import gc
+import time
+import signal
+import socket
+import logging
+import argparse
+
+import torch
+import torch.nn as nn
+
+from karl.config import settings
+
+logger = logging.getLogger('retention')
+
+
+def share_weights(model: nn.Module) -> None:
+    '''Move parameters and buffers to shared memory so forked workers never copy them.'''
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        tensor.share_memory_()
+
+
+def worker_threads(n_workers: int) -> int:
+    '''Intra-op threads for each of `n_workers` workers.'''
+    if settings.MODEL_NUM_THREADS:
+        return settings.MODEL_NUM_THREADS
+    return max(1, (os.cpu_count() or 1) // n_workers)
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock: socket.socket, num_threads: int, log_level: str) -> None:
+    import uvicorn
+
+    torch.set_num_threads(num_threads)
+    config = uvicorn.Config(app, log_level=log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn_worker(app, sock: socket.socket, num_threads: int, log_level: str) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            run_worker(app, sock, num_threads, log_level)
+        except BaseException:
+            logger.exception('worker failed')
+            os._exit(1)
+        os._exit(0)
+    return pid
+
+
+def share_model(model) -> None:
+    '''Share the weights of a `RetentionModel` with the workers forked next.'''
+    for name in ['model', 'model_new_card', 'model_old_card']:
+        if hasattr(model, name):
+            share_weights(getattr(model, name))
+    # keep the garbage collector from touching (and so copying) the pages of
+    # everything loaded so far
+    gc.collect()
+    gc.freeze()
+
+
+def prefork(app, registry, sock: socket.socket, n_workers: int, num_threads: int, log_level: str) -> None:
+    '''
+    Run `n_workers` workers serving `app` on `sock` until SIGTERM or SIGINT,
+    restarting the ones that die and replacing all of them when `registry`
+    swaps in a new model.
+    '''
+    poll_interval = registry.poll_interval
+    # workers must not start their own watcher
+    registry.poll_interval = 0
+    share_model(registry.current)
+
+    # pid -> start time of the workers to keep running, and the pids of
+    # replaced workers still finishing their requests
+    workers, retired = {}, set()
+
+    def spawn_workers():
+        for _ in range(n_workers):
+            pid = spawn_worker(app, sock, num_threads, log_level)
+            workers[pid] = time.monotonic()
+
+    spawn_workers()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers) + list(retired):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    next_poll = time.monotonic() + poll_interval
+    while len(workers) + len(retired) > 0:
+        if poll_interval > 0 and not stopping and time.monotonic() >= next_poll:
+            next_poll = time.monotonic() + poll_interval
+            gc.unfreeze()
+            if registry.poll():
+                old_workers = list(workers)
+                share_model(registry.current)
+                # the new workers accept on the socket before the old ones stop
+                spawn_workers()
+                for pid in old_workers:
+                    del workers[pid]
+                    retired.add(pid)
+                    os.kill(pid, signal.SIGTERM)
+            else:
+                gc.freeze()
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.1)
+            continue
+        if pid in retired:
+            retired.remove(pid)
+            continue
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logger.warning(f'worker {pid} exited with status {status}, restarting')
+        if time.monotonic() - started < 1:
+            # a worker that dies on startup would otherwise spin
+            time.sleep(1)
+        pid = spawn_worker(app, sock, num_threads, log_level)
+        workers[pid] = time.monotonic()
+
+
+def serve(
+    n_workers: int = 2,
+    host: str = '0.0.0.0',
+    port: int = 8001,
+    log_level: str = 'info',
+):
+    # load with a single thread: an intra-op pool started in the parent does
+    # not survive fork. Workers set their own budget and never reload, so
+    # this only applies to the parent.
+    torch.set_num_threads(1)
+    num_threads = worker_threads(n_workers)
+    settings.MODEL_NUM_THREADS = 1
+
+    # building the model server's module loads and freezes the models
+    from karl.retention_phase1 import web
+
+    sock = bind_socket(host, port)
+    logger.info(f'serving on {host}:{port} with {n_workers} workers x {num_threads} threads')
+    prefork(web.app, web.registry, sock, n_workers, num_threads, log_level)
+    sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_workers', type=int, default=2)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--log_level', default='info')
+    args = parser.parse_args()
+    serve(args.n_workers, args.host, args.port, args.log_level)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Token ids of every card, computed once per (card, tokenizer, max_length).
+
+Study records repeat the same cards many times, so datasets and the model
+server look up token ids by card_id instead of tokenizing card text per
+record. The cache lives in
+
+    {DATA_DIR}/token_cache/{tokenizer}_{max_length}/
+
+as flat arrays like the cached `RetentionDataset` folds: `input_ids.npy`
+(int32 token ids of all cards back to back), `offsets.npy` and
+`card_ids.json`, written last. Arrays are memory-mapped.
+
+    python -m karl.retention_phase1.token_cache --n_workers 8
+'''
+
+import os
+import json
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+from collections import OrderedDict
+
+from karl.config import settings
+
+logger = logging.getLogger('retention')
+
+_worker_tokenizer = None
+_worker_max_length = None
+
+
+def _init_worker(tokenizer, max_length):
+    global _worker_tokenizer, _worker_max_length
+    # each worker is one process already; nested tokenizer threads would oversubscribe
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_tokenizer = tokenizer
+    _worker_max_length = max_length
+
+
+def _flatten(input_ids: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+    tokens = np.fromiter((t for x in input_ids for t in x), dtype=np.int32, count=lengths.sum())
+    return tokens, lengths
+
+
+def _tokenize_chunk(card_texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encodings = _worker_tokenizer(card_texts, truncation=True, max_length=_worker_max_length)
+    return _flatten(encodings['input_ids'])
+
+
+def tokenize_cards(
+    tokenizer,
+    card_texts: List[str],
+    max_length: int,
+    n_workers: int = None,
+    chunk_size: int = 10000,
+) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Batched fast tokenization of `card_texts`, in chunks spread over
+    `n_workers` processes (inline if there is only one chunk).
+
+    :return: flat int32 token ids and the int64 offsets of each text.
+    '''
+    chunks = [card_texts[i: i + chunk_size] for i in range(0, len(card_texts), chunk_size)]
+    if len(chunks) <= 1 or n_workers == 1:
+        _init_worker(tokenizer, max_length)
+        results = [_tokenize_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context(settings.MP_CONTEXT),
+            initializer=_init_worker,
+            initargs=(tokenizer, max_length),
+        ) as executor:
+            results = list(executor.map(_tokenize_chunk, chunks))
+
+    tokens = np.concatenate([x for x, _ in results]) if results else np.zeros(0, dtype=np.int32)
+    lengths = np.concatenate([x for _, x in results]) if results else np.zeros(0, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return tokens, offsets
+
+
+def gather(tokens: np.ndarray, offsets: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''Flat token ids and offsets of sequences `rows` of (`tokens`, `offsets`), in one indexed copy.'''
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return np.asarray(tokens[index], dtype=np.int32), new_offsets
+
+
+class TokenCache:
+    '''
+    card_id -> token ids for one tokenizer and `max_length`.
+
+    `build` tokenizes the cards not yet on disk and rewrites the cache;
+    `lookup` returns token ids of any cards, tokenizing the ones not on disk,
+    which is what the model server needs for cards created after the cache
+    was built. Those are kept in memory, the `max_extra` most recently used
+    ones.
+    '''
+
+    def __init__(self, tokenizer, max_length: int = None, cache_dir: str = None, max_extra: int = None):
+        self.tokenizer = tokenizer
+        self.max_length = max_length or tokenizer.model_max_length
+        if cache_dir is None:
+            name = os.path.basename(str(tokenizer.name_or_path).rstrip('/')) or type(tokenizer).__name__
+            cache_dir = f'{settings.DATA_DIR}/token_cache/{name}_{self.max_length}'
+        self.cache_dir = cache_dir
+        self.max_extra = settings.MODEL_EMBEDDING_CACHE_SIZE if max_extra is None else max_extra
+        self.extra = OrderedDict()
+        self._load()
+
+    def _load(self):
+        self.tokens = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.index = {}
+        if os.path.exists(f'{self.cache_dir}/card_ids.json'):
+            with open(f'{self.cache_dir}/card_ids.json') as f:
+                card_ids = json.load(f)
+            self.tokens = np.load(f'{self.cache_dir}/input_ids.npy', mmap_mode='r')
+            self.offsets = np.load(f'{self.cache_dir}/offsets.npy', mmap_mode='r')
+            self.index = {card_id: i for i, card_id in enumerate(card_ids)}
+
+    def __len__(self):
+        return len(self.index) + len(self.extra)
+
+    def __contains__(self, card_id):
+        return card_id in self.index or card_id in self.extra
+
+    def build(self, card_ids: List[str], card_texts: List[str], n_workers: int = None) -> None:
+        '''Add the given cards to the cache on disk, tokenizing each new card once.'''
+        new_cards = {}
+        for card_id, card_text in zip(card_ids, card_texts):
+            if card_id not in self.index and card_id not in new_cards:
+                new_cards[card_id] = card_text
+        if len(new_cards) == 0:
+            return
+
+        logger.info(f'tokenizing {len(new_cards)} cards into {self.cache_dir}')
+        tokens, offsets = tokenize_cards(self.tokenizer, list(new_cards.values()), self.max_length, n_workers)
+        all_card_ids = list(self.index.keys()) + list(new_cards.keys())
+        tokens = np.concatenate([self.tokens, tokens])
+        offsets = np.concatenate([self.offsets, offsets[1:] + self.offsets[-1]])
+
+        # write next to the old files and rename over them, so processes that
+        # still map the old files keep reading them
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name, array in [('input_ids', tokens), ('offsets', offsets)]:
+            np.save(f'{self.cache_dir}/{name}.tmp.npy', array)
+            os.replace(f'{self.cache_dir}/{name}.tmp.npy', f'{self.cache_dir}/{name}.npy')
+        with open(f'{self.cache_dir}/card_ids.tmp.json', 'w') as f:
+            json.dump(all_card_ids, f)
+        os.replace(f'{self.cache_dir}/card_ids.tmp.json', f'{self.cache_dir}/card_ids.json')
+        self._load()
+
+    def gather(self, card_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        '''Flat token ids and offsets of `card_ids`, which must all be on disk.'''
+        rows = np.fromiter((self.index[card_id] for card_id in card_ids), dtype=np.int64, count=len(card_ids))
+        return gather(self.tokens, self.offsets, rows)
+
+    def lookup(self, card_ids: List[str], card_texts: List[str]) -> List[np.ndarray]:
+        '''Token ids of each card, tokenizing the cards not cached yet.'''
+        found, missing = {}, {}
+        for card_id, card_text in zip(card_ids, card_texts):
+            if card_id in self.index or card_id in found:
+                continue
+            if card_id in self.extra:
+                found[card_id] = self.extra[card_id]
+                self.extra.move_to_end(card_id)
+            else:
+                missing[card_id] = card_text
+        if len(missing) > 0:
+            encodings = self.tokenizer(list(missing.values()), truncation=True, max_length=self.max_length)
+            for card_id, input_ids in zip(missing.keys(), encodings['input_ids']):
+                found[card_id] = self.extra[card_id] = np.asarray(input_ids, dtype=np.int32)
+                self.extra.move_to_end(card_id)
+            while len(self.extra) > self.max_extra:
+                self.extra.popitem(last=False)
+
+        output = []
+        for card_id in card_ids:
+            row = self.index.get(card_id)
+            if row is None:
+                output.append(found[card_id])
+            else:
+                output.append(self.tokens[self.offsets[row]: self.offsets[row + 1]])
+        return output
+
+if __name__ == '__main__':
+    from transformers import DistilBertTokenizerFast
+    from karl.db.session import SessionLocal
+    from karl.models import Card
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    cards = session.query(Card.id, Card.text).all()
+    session.close()
+    cache = TokenCache(DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased'))
+    cache.build([card_id for card_id, _ in cards], [text for _, text in cards], args.n_workers)
+    print(f'{len(cache)} cards in {cache.cache_dir}')
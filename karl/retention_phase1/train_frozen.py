@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Fast training mode for CPU boxes: the DistilBERT encoder stays frozen, and
+only the classifier head of `DistilBertRetentionModel` is trained.
+
+A frozen encoder maps a card to the same embedding in every epoch, so each
+unique card of the folds is encoded once, and training runs the head alone
+on (card embedding, retention features) batches. The encoder starts from
+`--init_dir`, the pretrained DistilBERT by default or the encoder of an
+earlier fully fine-tuned checkpoint.
+
+Checkpoints are regular `DistilBertRetentionModel`s, saved together with
+the card embeddings computed here as their `CardEmbeddingCache`, at the
+precision the model server prepares the checkpoint with, so the server does
+not encode those cards again. They go to `output/retention_frozen`, not to
+the directories being served; move them there (or `cp -p`, the cache is
+tied to the file times) to deploy them.
+
+    python -m karl.retention_phase1.train_frozen --folds new_card old_card
+'''
+
+import argparse
+import numpy as np
+from typing import List, Tuple
+
+import torch
+from transformers import DistilBertTokenizerFast, EvalPrediction
+
+from karl.config import settings
+from karl.retention_phase1.data import RetentionDataset, feature_fields
+from karl.retention_phase1.model_distilbert import DistilBertRetentionModel
+from karl.retention_phase1.backend import get_device, prepare_for_inference, encoder_precision
+from karl.retention_phase1.embedding_cache import encode_token_ids, save_card_embeddings
+from karl.retention_phase1.common import compute_metrics, set_seed
+
+
+def card_input_ids(datasets: List[RetentionDataset]) -> Tuple[List[str], List[np.ndarray], List[np.ndarray]]:
+    '''
+    Unique cards of `datasets`.
+
+    :return: card ids, their token ids, and for each dataset the card row of
+        each of its examples.
+    '''
+    rows_by_card_id, input_ids, rows = {}, [], []
+    for dataset in datasets:
+        # first example of each card of the fold
+        _, first = np.unique(dataset.card_index, return_index=True)
+        fold_rows = np.zeros(len(dataset.card_ids), dtype=np.int64)
+        for i, (card_id, j) in enumerate(zip(dataset.card_ids, first)):
+            if card_id not in rows_by_card_id:
+                rows_by_card_id[card_id] = len(rows_by_card_id)
+                input_ids.append(dataset.input_ids[dataset.offsets[j]: dataset.offsets[j + 1]])
+            fold_rows[i] = rows_by_card_id[card_id]
+        rows.append(fold_rows[dataset.card_index])
+    return list(rows_by_card_id), input_ids, rows
+
+
+def card_embeddings(
+    model: DistilBertRetentionModel,
+    datasets: List[RetentionDataset],
+    batch_size: int = 64,
+    device: torch.device = None,
+) -> Tuple[np.ndarray, List[str], List[np.ndarray]]:
+    '''
+    Encode every card of `datasets` once.
+
+    :return: (n_cards, dim) embeddings, their card ids, and for each dataset
+        the embedding row of each of its examples.
+    '''
+    card_ids, input_ids, rows = card_input_ids(datasets)
+    print(f'encoding {len(input_ids)} cards')
+    embeddings = encode_token_ids(model, input_ids, datasets[0].pad_token_id, batch_size, device)
+    return embeddings, card_ids, rows
+
+
+def train_head(
+    model: DistilBertRetentionModel,
+    embeddings: torch.Tensor,
+    rows: np.ndarray,
+    dataset: RetentionDataset,
+    num_train_epochs: int = 5,
+    batch_size: int = 256,
+    learning_rate: float = 1e-3,
+    weight_decay: float = 1e-2,
+) -> DistilBertRetentionModel:
+    '''Train `model.classifier` on precomputed `embeddings`; `rows` is the embedding row of each example.'''
+    model.distilbert.requires_grad_(False)
+    optimizer = torch.optim.AdamW(model.classifier.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    rows = torch.from_numpy(rows)
+    labels = torch.from_numpy(np.asarray(dataset.labels, dtype=np.float32))
+    retention_features = None
+    if model.retention_feature_size > 0:
+        retention_features = torch.from_numpy(np.asarray(dataset.retention_features, dtype=np.float32))
+
+    model.classifier.train()
+    for epoch in range(num_train_epochs):
+        order = torch.randperm(len(labels))
+        total_loss = 0
+        for i in range(0, len(order), batch_size):
+            batch = order[i: i + batch_size]
+            x = model.forward_head(
+                embeddings[rows[batch]],
+                None if retention_features is None else retention_features[batch],
+            )
+            loss = model.loss_fn(x, labels[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(batch)
+        print(f'epoch {epoch} loss', '%.4f' % (total_loss / len(order)))
+    model.eval()
+    return model
+
+
+@torch.inference_mode()
+def evaluate_head(
+    model: DistilBertRetentionModel,
+    embeddings: torch.Tensor,
+    rows: np.ndarray,
+    dataset: RetentionDataset,
+    batch_size: int = 1024,
+) -> dict:
+    predictions = []
+    for i in range(0, len(rows), batch_size):
+        retention_features = None
+        if model.retention_feature_size > 0:
+            retention_features = torch.from_numpy(
+                np.asarray(dataset.retention_features[i: i + batch_size], dtype=np.float32))
+        x = model.forward_head(embeddings[torch.from_numpy(rows[i: i + batch_size])], retention_features)
+        predictions.append(x.numpy())
+    return compute_metrics(EvalPrediction(
+        predictions=np.concatenate(predictions),
+        label_ids=np.asarray(dataset.labels),
+    ))
+
+
+def train(
+    folds: List[str] = ('new_card', 'old_card'),
+    init_dir: str = 'distilbert-base-uncased',
+    output_dir: str = f'{settings.CODE_DIR}/output/retention_frozen',
+    num_train_epochs: int = 5,
+    batch_size: int = 256,
+    learning_rate: float = 1e-3,
+    seed: int = 1,
+) -> None:
+    set_seed(seed)
+    device = get_device()
+    tokenizer = DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased')
+    datasets = {}
+    for fold in folds:
+        datasets[f'train_{fold}'] = RetentionDataset(settings.DATA_DIR, f'train_{fold}', tokenizer)
+        datasets[f'test_{fold}'] = RetentionDataset(settings.DATA_DIR, f'test_{fold}', tokenizer)
+
+    # all heads share the frozen encoder, so cards are encoded once for every fold
+    encoder = DistilBertRetentionModel.from_pretrained(
+        init_dir, retention_feature_size=0, ignore_mismatched_sizes=True).to(device)
+    encoder.eval()
+    card_ids, input_ids, rows = card_input_ids(list(datasets.values()))
+    print(f'encoding {len(input_ids)} cards')
+    embeddings = encode_token_ids(encoder, input_ids, tokenizer.pad_token_id, device=device)
+    rows = dict(zip(datasets.keys(), rows))
+    embeddings_tensor = torch.from_numpy(embeddings)
+    # embeddings by encoder precision; every fold has the same encoder
+    served_embeddings = {'fp32': embeddings}
+
+    for fold in folds:
+        retention_feature_size = 0 if fold == 'new_card' else len(feature_fields)
+        # a head of `init_dir` with another feature size is reinitialized
+        model = DistilBertRetentionModel.from_pretrained(
+            init_dir, retention_feature_size=retention_feature_size, ignore_mismatched_sizes=True)
+        model = train_head(
+            model,
+            embeddings_tensor,
+            rows[f'train_{fold}'],
+            datasets[f'train_{fold}'],
+            num_train_epochs=num_train_epochs,
+            batch_size=batch_size,
+            learning_rate=learning_rate,
+        )
+        result = evaluate_head(model, embeddings_tensor, rows[f'test_{fold}'], datasets[f'test_{fold}'])
+        print(f'***** Eval frozen distilbert {fold} {seed} *****')
+        for key, value in result.items():
+            print(f'  {key} = {value}')
+
+        model_dir = f'{output_dir}/retention_hf_distilbert_{fold}'
+        model.save_pretrained(model_dir)
+        # the server encodes misses with the checkpoint prepared for inference,
+        # and only uses a cache of the same precision
+        served = prepare_for_inference(DistilBertRetentionModel.from_pretrained(model_dir), device)
+        precision = encoder_precision(served)
+        if precision not in served_embeddings:
+            served_embeddings[precision] = encode_token_ids(served, input_ids, tokenizer.pad_token_id, device=device)
+        save_card_embeddings(model_dir, card_ids, served_embeddings[precision], precision)
+        print(f'saved {model_dir} with {precision} card embeddings')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folds', nargs='+', choices=['new_card', 'old_card'], default=['new_card', 'old_card'])
+    parser.add_argument('--init_dir', default='distilbert-base-uncased')
+    parser.add_argument('--output_dir', default=f'{settings.CODE_DIR}/output/retention_frozen')
+    parser.add_argument('--num_train_epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--learning_rate', type=float, default=1e-3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    train(
+        folds=args.folds,
+        init_dir=args.init_dir,
+        output_dir=args.output_dir,
+        num_train_epochs=args.num_train_epochs,
+        batch_size=args.batch_size,
+        learning_rate=args.learning_rate,
+        seed=args.seed,
+    )
@@ -1,82 +1,205 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
 import pytz
 import torch
 import logging
-import numpy as np
 from datetime import datetime
-from typing import List
-from fastapi import FastAPI
+from typing import List, Tuple
+from fastapi import FastAPI, Response
+from pydantic import BaseModel
 
 from transformers import DistilBertTokenizerFast
 
-from karl.retention_phase1 import DistilBertRetentionModel
-from karl.retention_phase1.data import RetentionFeaturesSchema, RetentionInput, retention_data_collator, feature_fields
+from karl.retention_phase1 import DistilBertRetentionModel, DistilBertSharedEncoderRetentionModel
+from karl.retention_phase1.data import RetentionFeaturesSchema, feature_matrix
+from karl.retention_phase1.batching import MicroBatcher
+from karl.retention_phase1.backend import get_device, configure_threads, prepare_for_inference, synthetic_batch, served_scores, encoder_precision
+from karl.retention_phase1.embedding_cache import CardEmbeddingCache, encode_token_ids
+from karl.retention_phase1.token_cache import TokenCache
+from karl.retention_phase1.model_features import FeatureRetentionModel
+from karl.retention_phase1.registry import ModelRegistry, checkpoint_version
 from karl.config import settings
 
 
+class PredictWindowSchema(BaseModel):
+    feature_vectors: List[RetentionFeaturesSchema]
+    target_window_lowest: float
+    target_window_highest: float
+
+
+def model_dirs() -> Tuple[str, str, str, str]:
+    '''Checkpoints `RetentionModel` can load: feature model, shared, new card, old card.'''
+    output_dir = f'{settings.CODE_DIR}/output'
+    return (
+        f'{output_dir}/retention_features_old_card',
+        f'{output_dir}/retention_hf_distilbert_shared',
+        f'{output_dir}/retention_hf_distilbert_new_card',
+        f'{output_dir}/retention_hf_distilbert_old_card',
+    )
+
+
+def current_version() -> str:
+    '''Version of the checkpoints on disk, as `RetentionModel.version` would report it.'''
+    return checkpoint_version(list(model_dirs()))
+
+
 class RetentionModel:
 
-    def __init__(self):
-        model_new_card = DistilBertRetentionModel.from_pretrained(f'{settings.CODE_DIR}/output/retention_hf_distilbert_new_card')
-        model_old_card = DistilBertRetentionModel.from_pretrained(f'{settings.CODE_DIR}/output/retention_hf_distilbert_old_card')
-        self.model_new_card = model_new_card.to('cuda')
-        self.model_old_card = model_old_card.to('cuda')
-        self.model_new_card.eval()
-        self.model_old_card.eval()
+    def __init__(self, device: str = None):
+        configure_threads()
+        self.device = get_device(device)
+        version = current_version()
         self.tokenizer = DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased')
+        self.token_cache = TokenCache(self.tokenizer)
         self.mean = torch.load(f'{settings.DATA_DIR}/cached_mean')
         self.std = torch.load(f'{settings.DATA_DIR}/cached_std')
+        self.feature_mean = torch.tensor(self.mean, dtype=torch.float, device=self.device)
+        self.feature_std = torch.tensor(self.std, dtype=torch.float, device=self.device)
+        feature_model_dir, model_shared_dir, model_new_card_dir, model_old_card_dir = model_dirs()
 
-    def predict(self, feature_vectors: List[RetentionFeaturesSchema]):
-        t0 = datetime.now(pytz.utc)
+        # cheap first tier of `screen`, optional
+        self.feature_model = None
+        if os.path.exists(feature_model_dir):
+            self.feature_model = FeatureRetentionModel.from_pretrained(feature_model_dir)
+            self.feature_model.eval()
+
+        self.shared_encoder = os.path.exists(model_shared_dir)
+        if self.shared_encoder:
+            # new and old cards share one encoder pass and one embedding cache
+            model = DistilBertSharedEncoderRetentionModel.from_pretrained(model_shared_dir)
+            self.model = prepare_for_inference(model, self.device)
+            self.cache = CardEmbeddingCache(model_shared_dir, model.config.dim, encoder_precision(self.model))
+        else:
+            model_new_card = DistilBertRetentionModel.from_pretrained(model_new_card_dir)
+            model_old_card = DistilBertRetentionModel.from_pretrained(model_old_card_dir)
+            self.model_new_card = prepare_for_inference(model_new_card, self.device)
+            self.model_old_card = prepare_for_inference(model_old_card, self.device)
+            # misses are encoded by the prepared models, so only caches built at their precision are used
+            self.cache_new_card = CardEmbeddingCache(
+                model_new_card_dir, model_new_card.config.dim, encoder_precision(self.model_new_card))
+            self.cache_old_card = CardEmbeddingCache(
+                model_old_card_dir, model_old_card.config.dim, encoder_precision(self.model_old_card))
+
+        # the version of the files the weights were read from; a checkpoint
+        # written meanwhile may be half loaded, and is picked up once complete
+        self.version = current_version()
+        if self.version != version:
+            raise RuntimeError(f'checkpoints changed from {version} to {self.version} while loading')
+
+    def models(self) -> List[torch.nn.Module]:
+        if self.shared_encoder:
+            return [self.model]
+        return [self.model_new_card, self.model_old_card]
+
+    @torch.inference_mode()
+    def warm(self, batch_sizes: Tuple[int, ...] = (1, 16), seq_len: int = 32) -> 'RetentionModel':
+        '''Run each model on synthetic batches so the first real request does not pay for lazy initialization.'''
+        for model in self.models():
+            for batch_size in batch_sizes:
+                model(**synthetic_batch(batch_size, seq_len, model.config.retention_feature_size, model.config.vocab_size))
+        return self
+
+    def embed_cards(
+        self,
+        model,
+        cache: CardEmbeddingCache,
+        feature_vectors: List[RetentionFeaturesSchema],
+    ) -> torch.Tensor:
+        '''Card embeddings from the cache, running the encoder only for unseen cards.'''
+        card_texts = {x.card_id: x.card_text for x in feature_vectors}
+        embeddings = cache.lookup_or_encode(
+            [x.card_id for x in feature_vectors],
+            lambda card_ids: encode_token_ids(
+                model,
+                self.token_cache.lookup(card_ids, [card_texts[card_id] for card_id in card_ids]),
+                self.tokenizer.pad_token_id,
+                batch_size=settings.MODEL_MAX_BATCH_SIZE,
+                device=self.device,
+            ),
+        )
+        return torch.from_numpy(embeddings).to(self.device)
+
+    def normalized_features(self, feature_vectors: List[RetentionFeaturesSchema]) -> torch.Tensor:
+        '''Normalized `feature_fields` of the whole batch as one float32 tensor.'''
+        retention_features = torch.from_numpy(feature_matrix(feature_vectors)).to(self.device)
+        return retention_features.sub_(self.feature_mean).div_(self.feature_std)
+
+    @torch.inference_mode()
+    def screen(
+        self,
+        feature_vectors: List[RetentionFeaturesSchema],
+        target_window_lowest: float,
+        target_window_highest: float,
+    ) -> Tuple[List[float], List[int]]:
+        '''
+        Score old cards with the feature-only model and pick the candidates
+        that still need the full model: new cards, and old cards scored close
+        enough to the target window.
+
+        :return: served feature-model score for each old card (None for new
+            cards), and indices of the candidates to score with `predict`.
+        '''
+        scores = [None for _ in feature_vectors]
+        if self.feature_model is None:
+            return scores, list(range(len(feature_vectors)))
 
-        card_encodings = self.tokenizer([x.card_text for x in feature_vectors], truncation=True, padding=True)
-        new_indices, old_indices = [], []
-        new_examples, old_examples = [], []
-        for i, x in enumerate(feature_vectors):
-            if x.is_new_fact:
-                example = {k: v[i] for k, v in card_encodings.items()}
-                new_examples.append(RetentionInput(**example))
-                new_indices.append(i)
-            else:
-                retention_features = [x.__dict__[field] for field in feature_fields]
-                retention_features = np.array(retention_features)
-                retention_features = (retention_features - self.mean) / self.std
-                example = {k: v[i] for k, v in card_encodings.items()}
-                example['retention_features'] = retention_features
-                old_examples.append(RetentionInput(**example))
-                old_indices.append(i)
+        old_indices = [i for i, x in enumerate(feature_vectors) if not x.is_new_fact]
+        near = [i for i, x in enumerate(feature_vectors) if x.is_new_fact]
+        if len(old_indices) > 0:
+            retention_features = self.normalized_features([feature_vectors[i] for i in old_indices])
+            ys = served_scores(self.feature_model(retention_features)[0])
+            is_near = self.feature_model.near_window(ys, target_window_lowest, target_window_highest)
+            for i, y, keep in zip(old_indices, ys.tolist(), is_near.tolist()):
+                scores[i] = y
+                if keep:
+                    near.append(i)
+        print('============ screen', len(near), 'of', len(feature_vectors), 'need the full model')
+        return scores, sorted(near)
 
+    @torch.inference_mode()
+    def predict_shared(self, feature_vectors: List[RetentionFeaturesSchema]):
+        t0 = datetime.now(pytz.utc)
+        card_embedding = self.embed_cards(self.model, self.cache, feature_vectors)
+        retention_features = self.normalized_features(feature_vectors)
+        is_new_card = torch.tensor([x.is_new_fact for x in feature_vectors], dtype=torch.bool, device=self.device)
+        ys = served_scores(self.model.forward_head(card_embedding, retention_features, is_new_card))
         t1 = datetime.now(pytz.utc)
-        print('============ gather inputs', (t1 - t0).total_seconds())
+        print('============ predict shared', (t1 - t0).total_seconds())
+        return ys.cpu().numpy().tolist()
+
+    @torch.inference_mode()
+    def predict(self, feature_vectors: List[RetentionFeaturesSchema]):
+        if self.shared_encoder:
+            return self.predict_shared(feature_vectors)
+
+        t0 = datetime.now(pytz.utc)
 
-        batch_size = 32
+        new_indices = [i for i, x in enumerate(feature_vectors) if x.is_new_fact]
+        old_indices = [i for i, x in enumerate(feature_vectors) if not x.is_new_fact]
         output = [None for _ in feature_vectors]
-        if len(new_examples) > 0:
-            for i in range(0, len(new_examples), batch_size):
-                xs = retention_data_collator(new_examples[i: i + batch_size])
-                xs = {k: v.to('cuda') for k, v in xs.items()}
-                ys = torch.sigmoid(self.model_new_card.forward(**xs)[0])
-                ys = ys.detach().cpu().numpy().tolist()
-                for i, y in zip(new_indices[i: i + batch_size], ys):
-                    output[i] = y
 
-        t2 = datetime.now(pytz.utc)
-        print('============ predict new', (t2 - t1).total_seconds())
+        if len(new_indices) > 0:
+            xs = [feature_vectors[i] for i in new_indices]
+            card_embedding = self.embed_cards(self.model_new_card, self.cache_new_card, xs)
+            ys = served_scores(self.model_new_card.forward_head(card_embedding))
+            for i, y in zip(new_indices, ys.cpu().numpy().tolist()):
+                output[i] = y
+
+        t1 = datetime.now(pytz.utc)
+        print('============ predict new', (t1 - t0).total_seconds())
 
-        if len(old_examples) > 0:
-            for i in range(0, len(old_examples), batch_size):
-                xs = retention_data_collator(old_examples[i: i + batch_size])
-                xs = {k: v.to('cuda') for k, v in xs.items()}
-                ys = torch.sigmoid(self.model_old_card.forward(**xs)[0])
-                ys = ys.detach().cpu().numpy().tolist()
-                for i, y in zip(old_indices[i: i + batch_size], ys):
-                    output[i] = y
+        if len(old_indices) > 0:
+            xs = [feature_vectors[i] for i in old_indices]
+            card_embedding = self.embed_cards(self.model_old_card, self.cache_old_card, xs)
+            retention_features = self.normalized_features(xs)
+            ys = served_scores(self.model_old_card.forward_head(card_embedding, retention_features))
+            for i, y in zip(old_indices, ys.cpu().numpy().tolist()):
+                output[i] = y
 
-        t3 = datetime.now(pytz.utc)
-        print('============ predict old', (t3 - t2).total_seconds())
+        t2 = datetime.now(pytz.utc)
+        print('============ predict old', (t2 - t1).total_seconds())
 
         return output
 
@@ -105,13 +228,73 @@ logger.addHandler(fh)
 logger.addHandler(ch)
 
 app = FastAPI()
-retention_model = RetentionModel()
+# the serving model; new checkpoints are loaded, warmed and swapped in
+# without a restart
+registry = ModelRegistry(
+    lambda: RetentionModel().warm(),
+    current_version,
+    poll_interval=settings.MODEL_RELOAD_INTERVAL,
+)
+
+
+def predict_versioned(
+    feature_vectors: List[RetentionFeaturesSchema],
+    model: RetentionModel = None,
+) -> List[Tuple[str, float]]:
+    model = model or registry.get()
+    return [(model.version, y) for y in model.predict(feature_vectors)]
+
+
+# concurrent requests are merged so that they share forward passes
+batcher = MicroBatcher(
+    predict_versioned,
+    max_batch_size=settings.MODEL_MAX_BATCH_SIZE,
+    max_wait_ms=settings.MODEL_BATCH_WAIT_MS,
+)
+
+
+def unpack(outputs: List[Tuple[str, float]], response: Response) -> List[float]:
+    '''Scores, with the version of the model that computed them in the `X-Model-Version` header.'''
+    version = outputs[0][0] if len(outputs) > 0 else registry.version
+    response.headers['X-Model-Version'] = version
+    return [y for _, y in outputs]
 
 
 @app.get('/api/karl/predict_one')
-def predict_one(feature_vector: RetentionFeaturesSchema):
-    return retention_model.predict_one(feature_vector)
+def predict_one(feature_vector: RetentionFeaturesSchema, response: Response):
+    return unpack(batcher.predict([feature_vector]), response)
 
 @app.get('/api/karl/predict')
-def predict(feature_vectors: List[RetentionFeaturesSchema]):
-    return retention_model.predict(feature_vectors)
+def predict(feature_vectors: List[RetentionFeaturesSchema], response: Response):
+    return unpack(batcher.predict(feature_vectors), response)
+
+@app.get('/api/karl/predict_window')
+def predict_window(request: PredictWindowSchema, response: Response):
+    '''
+    Like `predict`, but cards the feature-only model places far outside the
+    target window keep its score and skip the full model.
+    '''
+    model = registry.get()
+    scores, near = model.screen(
+        request.feature_vectors,
+        request.target_window_lowest,
+        request.target_window_highest,
+    )
+    xs = [request.feature_vectors[i] for i in near]
+    outputs = batcher.predict(xs)
+    if any(version != model.version for version, _ in outputs):
+        # a new version was swapped in after the screen, score with the screening one
+        outputs = predict_versioned(xs, model)
+    response.headers['X-Model-Version'] = model.version
+    for i, (_, y) in zip(near, outputs):
+        scores[i] = y
+    return scores
+
+@app.get('/api/karl/model_version')
+def get_model_version():
+    return {'version': registry.version}
+
+@app.post('/api/karl/reload')
+def reload():
+    '''Load the checkpoints on disk in the background; keeps serving the current version meanwhile.'''
+    return {'version': registry.version, 'reloading': registry.reload()}
@@ -3,7 +3,6 @@
 
 import os
 import json
-import pytz
 import dataclasses
 import multiprocessing
 import pandas as pd
@@ -22,6 +21,7 @@ from karl.db.session import SessionLocal, engine
 from karl.config import settings
 from karl.models import User, Card, UserCardSnapshotV2, UserSnapshotV2, CardSnapshotV2
 from karl.schemas import VUserCard, VUser, VCard
+from karl.feature_engine import vectors_frame, compute_features
 
 
 class RetentionFeaturesSchema(BaseModel):
@@ -82,6 +82,9 @@ class RetentionFeaturesSchema(BaseModel):
 # state -> Review if there exists a Retention Feature
 # state -> Our FSRS: New or Review
 
+# `feature_engine` version this schema corresponds to
+FEATURE_VERSION = 'v2'
+
 feature_fields = [
     field_name for field_name, field_info in RetentionFeaturesSchema.__fields__.items()
     if field_info.type_ in [int, float, bool]
@@ -98,60 +101,8 @@ def vectors_to_features(
     card_answer: str,
     elapsed_milliseconds: int = 0,
 ) -> RetentionFeaturesSchema:
-    if v_usercard.leitner_scheduled_date is not None:
-        delta_to_leitner_scheduled_date = (v_usercard.leitner_scheduled_date - date).total_seconds() // 3600
-    else:
-        delta_to_leitner_scheduled_date = 0
-
-    if v_usercard.sm2_scheduled_date is not None:
-        delta_to_sm2_scheduled_date = (v_usercard.sm2_scheduled_date - date).total_seconds() // 3600
-    else:
-        delta_to_sm2_scheduled_date = 0
-
-    return RetentionFeaturesSchema(
-        user_id=v_usercard.user_id,
-        card_id=v_usercard.card_id,
-        card_text=card_text,
-        answer=card_answer,
-        is_new_fact=(v_usercard.correct_on_first_try is None),
-        count_positive_user=v_user.count_positive,
-        count_negative_user=v_user.count_negative,
-        count_user=v_user.count,
-        count_positive_session_user=v_user.count_positive_session,
-        count_negative_session_user=v_user.count_negative_session,
-        count_session_user=v_user.count_session,
-        count_positive_card=v_card.count_positive,
-        count_negative_card=v_card.count_negative,
-        count_positive_session_card=v_usercard.count_positive_session,
-        count_negative_session_card=v_usercard.count_negative_session,
-        count_session_card=v_usercard.count_session,
-        count_positive_usercard=v_usercard.count_positive,
-        count_negative_usercard=v_usercard.count_negative,
-        count_usercard=v_usercard.count,
-        acc_user=0 if v_user.count == 0 else v_user.count_positive / v_user.count,
-        acc_card=0 if v_card.count == 0 else v_card.count_positive / v_card.count,
-        acc_usercard=0 if v_usercard.count == 0 else v_usercard.count_positive / v_usercard.count,
-        acc_session_user=0 if v_user.count_session == 0 else v_user.count_positive_session / v_user.count_session,
-        acc_session_card=0 if v_usercard.count_session == 0 else v_usercard.count_positive_session / v_usercard.count_session,
-        delta=v_usercard.delta // 3600,
-        delta_previous=v_usercard.previous_delta // 3600,
-        usercard_previous_study_response=v_usercard.previous_study_response or False,
-        usercard_delta_session=v_usercard.delta_session,
-        usercard_delta_previous_session=v_usercard.previous_delta_session,
-        usercard_previous_study_response_session=v_usercard.previous_study_response_session,
-        leitner_box=v_usercard.leitner_box or 0,
-        sm2_efactor=v_usercard.sm2_efactor or 0,
-        sm2_interval=v_usercard.sm2_interval or 0,
-        sm2_repetition=v_usercard.sm2_repetition or 0,
-        delta_to_leitner_scheduled_date=delta_to_leitner_scheduled_date,
-        delta_to_sm2_scheduled_date=delta_to_sm2_scheduled_date,
-        repetition_model=json.loads(v_user.parameters)['repetition_model'],
-        correct_on_first_try=v_usercard.correct_on_first_try or False,
-        correct_on_first_try_session=v_usercard.correct_on_first_try or False,  # TODO
-        elapsed_milliseconds=elapsed_milliseconds,
-        utc_datetime=date.astimezone(pytz.utc),
-        utc_date=date.astimezone(pytz.utc).date(),
-    )
+    rows = vectors_frame([v_user], [v_card], [v_usercard], [date], [card_text], [elapsed_milliseconds], [card_answer])
+    return RetentionFeaturesSchema(**compute_features(rows, FEATURE_VERSION).iloc[0].to_dict())
 
 
 def _get_user_features(
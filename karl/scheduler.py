@@ -17,14 +17,15 @@ from karl.fsrs import FSRS
 from karl.schemas import ScheduleResponseSchema,\
     ScheduleRequestSchema, UpdateRequestSchema, KarlFactSchema
 from karl.schemas import ParametersSchema
-from karl.schemas import VUser, VCard, VUserCard
 from karl.schemas import RepetitionModel
 from karl.models import User, Card, Parameters, UserStatsV2,\
     UserCardFeatureVector, UserFeatureVector, CardFeatureVector,\
     UserCardSnapshotV2, UserSnapshotV2, CardSnapshotV2,\
     StudyRecord, TestRecord, ScheduleRequest
 
-from karl.retention_phase1 import vectors_to_features, fsrs_vectors_to_features
+from karl.retention_phase1 import fsrs_vectors_to_features
+from karl.retention_phase1.data import vectors_to_feature_records
+from karl.feature_engine import UserVector, CardVector, UserCardVector
 from karl.db.session import SessionLocal, engine
 from karl.config import settings
 
@@ -161,13 +162,13 @@ class KARLScheduler:
         '''helper for multiprocessing'''
         session = SessionLocal(expire_on_commit=False)
         usercard_vector = self.get_usercard_vector(user_id, card_id, session)
-        v_usercard = VUserCard(**usercard_vector.__dict__)
+        v_usercard = UserCardVector.of(usercard_vector)
         if test_mode is None:
-            v_card = VCard(**self.get_card_vector(card_id, session).__dict__)
+            v_card = CardVector.of(self.get_card_vector(card_id, session))
         else:
             # in test mode, use no card global feature
             # pretend no one else had seen this card
-            v_card = VCard(**usercard_vector.__dict__)
+            v_card = CardVector.of(usercard_vector)
         session.close()
 
         previous_delta = None
@@ -197,7 +198,7 @@ class KARLScheduler:
         v_card.previous_study_date = date
         v_card.previous_study_response = forced_result
 
-        return vectors_to_features(v_usercard, v_user, v_card, future, card_text)
+        return v_card, v_usercard
 
     def karl_score_recall_batch_future(
         self,
@@ -215,7 +216,7 @@ class KARLScheduler:
 
         # gather card features
         feature_vectors = []
-        v_user = VUser(**self.get_user_vector(user.id, session).__dict__)
+        v_user = UserVector.of(self.get_user_vector(user.id, session))
         previous_delta = None
         if v_user.previous_study_date is not None:
             previous_delta = (date - v_user.previous_study_date).total_seconds()
@@ -227,8 +228,8 @@ class KARLScheduler:
         v_user.previous_study_response = forced_result
 
         if not settings.USE_MULTIPROCESSING:
-            feature_vectors = [
-                self.collect_features_for_future(user.id, card.id, card.text, v_user, date, future, forced_result, request.test_mode).__dict__
+            vectors = [
+                self.collect_features_for_future(user.id, card.id, card.text, v_user, date, future, forced_result, request.test_mode)
                 for card in cards
             ]
         else:
@@ -238,19 +239,24 @@ class KARLScheduler:
                 mp_context=multiprocessing.get_context(settings.MP_CONTEXT),
                 initializer=engine.dispose,
             )
-        futures = [
-            executor.submit(self.collect_features_for_future, user.id, card.id, card.text, v_user, date,
-                            future, forced_result, request.test_mode)
-            for card in cards
-        ]
-        feature_vectors = [x.result().__dict__ for x in futures]
+            futures = [
+                executor.submit(self.collect_features_for_future, user.id, card.id, card.text, v_user, date,
+                                future, forced_result, request.test_mode)
+                for card in cards
+            ]
+            vectors = [x.result() for x in futures]
+
+        # features of all cards in one batch, as of `future`
+        feature_vectors = vectors_to_feature_records(
+            v_user,
+            [v_card for v_card, _ in vectors],
+            [v_usercard for _, v_usercard in vectors],
+            future,
+            [card.text for card in cards],
+        )
 
         t1 = datetime.now(pytz.utc)
 
-        for x in feature_vectors:
-            x['utc_date'] = str(x['utc_date'])
-            x['utc_datetime'] = str(x['utc_datetime'])
-
         scores = json.loads(
             requests.get(
                 f'{settings.MODEL_API_URL}/api/karl/predict',
@@ -314,7 +320,7 @@ class KARLScheduler:
         if request.repetition_model == RepetitionModel.fsrs:
             scores, profile, order = self.fsrs_score_recall_batch(user, cards, date, session, request)
         elif request.repetition_model in {RepetitionModel.karlAblation, RepetitionModel.karl}:
-            scores, profile, order = self.karl_score_recall_batch(user, cards, date, session)
+            scores, profile, order = self.karl_score_recall_batch(user, cards, date, session, request, screen=True)
         else:
             raise HTTPException(status_code=557, detail="Scheduler not implemented")
         
@@ -364,15 +370,15 @@ class KARLScheduler:
         '''helper for multiprocessing'''
         session = SessionLocal(expire_on_commit=False)
         usercard_vector = self.get_usercard_vector(user_id, card_id, session)
-        v_usercard = VUserCard(**usercard_vector.__dict__)
+        v_usercard = UserCardVector.of(usercard_vector)
         if test_mode is None:
-            v_card = VCard(**self.get_card_vector(card_id, session).__dict__)
+            v_card = CardVector.of(self.get_card_vector(card_id, session))
         else:
             # in test mode, use no card global feature
             # pretend no one else had seen this card
-            v_card = VCard(**usercard_vector.__dict__)
+            v_card = CardVector.of(usercard_vector)
         session.close()
-        return vectors_to_features(v_usercard, v_user, v_card, date, card_text)
+        return v_card, v_usercard
     
     def fsrs_score_recall_batch(
         self,
@@ -387,7 +393,7 @@ class KARLScheduler:
 
         # gather card features
         feature_vectors = []
-        v_user = VUser(**self.get_user_vector(user.id, session).__dict__)
+        v_user = UserVector.of(self.get_user_vector(user.id, session))
 
         if not settings.USE_MULTIPROCESSING:
             feature_vectors = [
@@ -440,17 +446,26 @@ class KARLScheduler:
         cards: List[Card],
         date: datetime,
         session: Session,
-        request: ScheduleRequestSchema
+        request: ScheduleRequestSchema,
+        screen: bool = False,
     ) -> List[float]:
+        '''
+        Predicted recall of `cards`, and the cards inside the target window
+        ordered by distance to the target. With `screen`, cards the
+        feature-only model places far outside the window keep its score and
+        skip the full model; only callers that use nothing but the window
+        order should set it, the scores of those cards are not comparable
+        with full-model scores.
+        '''
         t0 = datetime.now(pytz.utc)
 
         # gather card features
         feature_vectors = []
-        v_user = VUser(**self.get_user_vector(user.id, session).__dict__)
+        v_user = UserVector.of(self.get_user_vector(user.id, session))
 
         if not settings.USE_MULTIPROCESSING:
-            feature_vectors = [
-                self.collect_features(user.id, card.id, card.text, v_user, date, request.test_mode).__dict__
+            vectors = [
+                self.collect_features(user.id, card.id, card.text, v_user, date, request.test_mode)
                 for card in cards
             ]
         else:
@@ -460,28 +475,46 @@ class KARLScheduler:
                 mp_context=multiprocessing.get_context(settings.MP_CONTEXT),
                 initializer=engine.dispose,
             )
-        futures = [
-            executor.submit(self.collect_features, user.id, card.id, card.text, v_user, date, request.test_mode)
-            for card in cards
-        ]
-        feature_vectors = [x.result().__dict__ for x in futures]
+            futures = [
+                executor.submit(self.collect_features, user.id, card.id, card.text, v_user, date, request.test_mode)
+                for card in cards
+            ]
+            vectors = [x.result() for x in futures]
+
+        # features of all cards in one batch, as of `date`
+        feature_vectors = vectors_to_feature_records(
+            v_user,
+            [v_card for v_card, _ in vectors],
+            [v_usercard for _, v_usercard in vectors],
+            date,
+            [card.text for card in cards],
+        )
 
         t1 = datetime.now(pytz.utc)
 
-        for x in feature_vectors:
-            x['utc_date'] = str(x['utc_date'])
-            x['utc_datetime'] = str(x['utc_datetime'])
-
         if request.repetition_model == RepetitionModel.karl or request.repetition_model == RepetitionModel.karlAblation:
             
             time_start = datetime.now()
-            data_dump = json.dumps(feature_vectors)
+            if screen:
+                # cards far from the target window are only scored by the
+                # feature-only model; they end up outside the window either way
+                endpoint = 'predict_window'
+                data_dump = json.dumps({
+                    'feature_vectors': feature_vectors,
+                    'target_window_lowest': request.recall_target.target_window_lowest,
+                    'target_window_highest': request.recall_target.target_window_highest,
+                })
+            else:
+                endpoint = 'predict'
+                data_dump = json.dumps(feature_vectors)
             print('\n\nTIME DUMPING:', datetime.now() - time_start, '\n\n')
             time_start = datetime.now()
-            req = requests.get(
-                    f'{settings.MODEL_API_URL}/api/karl/predict',
+            resp = requests.get(
+                    f'{settings.MODEL_API_URL}/api/karl/{endpoint}',
                     data=data_dump
-                ).text
+                )
+            req = resp.text
+            model_version = resp.headers.get('X-Model-Version')
             print('\n\nREQUEST:', datetime.now() - time_start, '\n\n')
             time_start = datetime.now()
             scores = json.loads(req)
@@ -506,6 +539,7 @@ class KARLScheduler:
         profile = {
             'schedule gather features': (t1 - t0).total_seconds(),
             'schedule model prediction': (t2 - t1).total_seconds(),
+            'model version': model_version,
         }
         return scores, profile, order
 
@@ -7,7 +7,7 @@ from tqdm import tqdm
 from copy import deepcopy
 from typing import Optional
 from datetime import datetime, timedelta
-from karl.retention_hf.data import get_retention_features_df, RetentionFeaturesSchema
+from karl.retention_phase1.data import get_retention_features_df, RetentionFeaturesSchema
 from karl.figures import save_chart_and_pdf
 
 alt.data_transformers.disable_max_rows()
@@ -0,0 +1,48 @@
+import torch
+import torch.nn as nn
+
+from karl.config import settings
+from karl.retention_phase1.backend import quantize, check_parity, encoder_precision, prepare_for_inference, synthetic_batch
+from karl.retention_phase1.model_distilbert import DistilBertRetentionModelConfig, DistilBertRetentionModel
+
+
+class Constant(nn.Module):
+
+    def __init__(self, ys):
+        super().__init__()
+        self.ys = torch.tensor(ys)
+
+    def forward(self, **kwargs):
+        return (self.ys,)
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = DistilBertRetentionModelConfig(
+        n_layers=1, dim=16, hidden_dim=32, n_heads=2, vocab_size=100, retention_feature_size=3)
+    return DistilBertRetentionModel(config).eval()
+
+
+def test_check_parity_is_max_abs_diff():
+    batches = [{}, {}]
+    assert check_parity(Constant([0.1, 0.5]), Constant([0.2, 0.2]), batches) == torch.tensor(0.3).item()
+
+
+def test_quantize_returns_int8_copy():
+    model = make_model()
+    quantized = quantize(model)
+    assert encoder_precision(model) == 'fp32'
+    assert encoder_precision(quantized) == 'int8'
+    batch = synthetic_batch(4, 8, 3, vocab_size=100)
+    assert check_parity(model, quantized, [batch]) < 0.05
+
+
+def test_prepare_for_inference_keeps_fp32_off_parity(monkeypatch):
+    monkeypatch.setattr(settings, 'MODEL_PARITY_TOLERANCE', -1.0)
+    model = prepare_for_inference(make_model(), torch.device('cpu'), quantization='int8')
+    assert encoder_precision(model) == 'fp32'
+    assert not any(p.requires_grad for p in model.parameters())
+
+    monkeypatch.setattr(settings, 'MODEL_PARITY_TOLERANCE', 1.0)
+    model = prepare_for_inference(make_model(), torch.device('cpu'), quantization='int8')
+    assert encoder_precision(model) == 'int8'
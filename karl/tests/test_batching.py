@@ -0,0 +1,52 @@
+import time
+import threading
+
+from karl.retention_phase1.batching import MicroBatcher, length_bucketed_batches, pad_to_longest
+
+
+def test_micro_batcher_merges_concurrent_requests():
+    calls = []
+
+    def predict_fn(items):
+        calls.append(len(items))
+        time.sleep(0.01)
+        return [x * 2 for x in items]
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=1000, max_wait_ms=50)
+    results = {}
+
+    def request(i):
+        results[i] = batcher.predict(list(range(i, i + 3)))
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for i in range(10):
+        assert results[i] == [x * 2 for x in range(i, i + 3)]
+    assert sum(calls) == 30
+    assert len(calls) < 10
+
+
+def test_length_bucketed_batches():
+    lengths = [5, 100, 7, 512, 6, 90, 8, 110]
+    batches = length_bucketed_batches(lengths, batch_size=3, max_tokens=400)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) <= 3
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 400
+    assert [lengths[i] for i in batches[0]] == [5, 6, 7]
+
+
+def test_pad_to_longest():
+    input_ids, attention_mask = pad_to_longest([[5, 6], [7], [8, 9, 10]], pad_token_id=1)
+    assert input_ids.tolist() == [[5, 6, 1], [7, 1, 1], [8, 9, 10]]
+    assert attention_mask.tolist() == [[1, 1, 0], [1, 0, 0], [1, 1, 1]]
+
+
+if __name__ == '__main__':
+    test_micro_batcher_merges_concurrent_requests()
+    test_length_bucketed_batches()
+    test_pad_to_longest()
@@ -0,0 +1,33 @@
+import numpy as np
+
+from karl.retention_phase1.distributed import shard_batches, shard_eval_batches
+
+
+def make_lengths(n=1000, seed=0):
+    return np.random.default_rng(seed).integers(1, 128, n)
+
+
+def test_shard_batches_are_disjoint_and_even():
+    lengths = make_lengths()
+    world_size = 3
+    shards = [shard_batches(lengths, 8, rank, world_size, seed=5) for rank in range(world_size)]
+    assert len({len(batches) for batches in shards}) == 1
+    examples = [i for batches in shards for batch in batches for i in batch]
+    assert len(examples) == len(set(examples))
+    # only the last few batches of the epoch are dropped
+    assert len(lengths) - len(examples) < 8 * world_size
+    # a new epoch reshuffles the batches
+    assert shard_batches(lengths, 8, 0, world_size, seed=6) != shards[0]
+
+
+def test_shard_eval_batches_cover_every_example_once():
+    lengths = make_lengths(1001)
+    world_size = 4
+    shards = [shard_eval_batches(lengths, 16, rank, world_size) for rank in range(world_size)]
+    examples = sorted(i for batches in shards for batch in batches for i in batch)
+    assert examples == list(range(len(lengths)))
+    # evaluation runs no collective per batch, shards only need to be balanced
+    sizes = [sum(len(batch) for batch in batches) for batches in shards]
+    assert max(sizes) - min(sizes) <= 1
+    for batches in shards:
+        assert all(len(batch) <= 16 for batch in batches)
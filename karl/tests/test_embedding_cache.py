@@ -0,0 +1,55 @@
+import json
+
+import numpy as np
+
+from karl.retention_phase1.embedding_cache import CardEmbeddingCache, save_card_embeddings
+
+
+def write_checkpoint(model_dir):
+    model_dir.mkdir()
+    (model_dir / 'config.json').write_text(json.dumps({'dim': 2}))
+
+
+def test_extra_keeps_most_recently_used(tmp_path):
+    write_checkpoint(tmp_path / 'model')
+    cache = CardEmbeddingCache(str(tmp_path / 'model'), 2, max_extra=2)
+    cache.add(['a', 'b'], np.array([[1, 1], [2, 2]], dtype=np.float32))
+    cache.lookup(['a'])
+    cache.add(['c'], np.array([[3, 3]], dtype=np.float32))
+    assert list(cache.extra) == ['a', 'c']
+    embeddings, missing = cache.lookup(['a', 'b', 'c'])
+    assert missing == [1]
+    assert embeddings[:, 0].tolist() == [1, 0, 3]
+
+
+def test_precomputed_embeddings_match_precision(tmp_path):
+    model_dir = tmp_path / 'model'
+    write_checkpoint(model_dir)
+    save_card_embeddings(str(model_dir), ['a'], np.ones((1, 2)), precision='int8')
+    assert len(CardEmbeddingCache(str(model_dir), 2, precision='int8')) == 1
+    # misses encoded at another precision would score differently from hits
+    assert len(CardEmbeddingCache(str(model_dir), 2, precision='fp32')) == 0
+
+
+def test_lookup_or_encode_more_misses_than_cap(tmp_path):
+    write_checkpoint(tmp_path / 'model')
+    cache = CardEmbeddingCache(str(tmp_path / 'model'), 2, max_extra=2)
+    calls = []
+
+    def encode(card_ids):
+        calls.append(card_ids)
+        return np.array([[ord(x), ord(x)] for x in card_ids], dtype=np.float32)
+
+    embeddings = cache.lookup_or_encode(['a', 'b', 'a', 'c'], encode)
+    # every card encoded once, none read back as zeros after eviction
+    assert calls == [['a', 'b', 'c']]
+    assert embeddings[:, 0].tolist() == [ord('a'), ord('b'), ord('a'), ord('c')]
+    assert list(cache.extra) == ['b', 'c']
+
+
+def test_lookup_or_encode_without_extra(tmp_path):
+    write_checkpoint(tmp_path / 'model')
+    cache = CardEmbeddingCache(str(tmp_path / 'model'), 2, max_extra=0)
+    embeddings = cache.lookup_or_encode(['a'], lambda card_ids: np.ones((len(card_ids), 2), dtype=np.float32))
+    assert embeddings.tolist() == [[1, 1]]
+    assert len(cache) == 0
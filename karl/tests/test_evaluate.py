@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+from transformers import EvalPrediction
+
+from karl.retention_phase1 import evaluate
+from karl.retention_phase1.common import compute_metrics
+from karl.retention_phase1.data import folds
+
+
+def make_df(n=40, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'record_id': [f'r{i}' for i in range(n)],
+        'user_id': [f'u{i % 2}' for i in range(n)],
+        'deck_id': [f'd{i % 3}' for i in range(n)],
+        'response': rng.random(n) > 0.4,
+        'prediction': rng.random(n).astype(np.float32),
+    })
+
+
+def test_breakdown_matches_compute_metrics():
+    df = make_df()
+    expected = compute_metrics(EvalPrediction(
+        predictions=df.prediction.to_numpy(), label_ids=df.response.to_numpy()))
+    result = evaluate.breakdown(df.assign(model='m'), ['model']).loc['m']
+    for key in ['acc', 'auc', 'ece']:
+        assert np.isclose(result[key], expected[key])
+
+
+def test_with_predictions_joins_on_record_id():
+    df = make_df(4).drop(columns=['prediction'])
+    predictions = pd.DataFrame({'record_id': ['r3', 'r0', 'r9'], 'prediction': [0.3, 0.0, 0.9]})
+    joined = evaluate.with_predictions(df, predictions)
+    assert joined.record_id.tolist() == ['r0', 'r3']
+    assert joined.prediction.tolist() == [0.0, 0.3]
+
+
+def test_evaluate_writes_reports(monkeypatch, tmp_path):
+    df = make_df()
+    df_by_fold = {fold: df.drop(columns=['prediction']) for fold in folds}
+    # every fold shuffled, so rows must be matched by record_id
+    predictions = {
+        ('m', fold): df[['record_id', 'prediction']].sample(frac=1, random_state=i)
+        for i, fold in enumerate(folds)
+    }
+    monkeypatch.setattr(evaluate, 'load_predictions', lambda model_names, output_dir, n_workers: predictions)
+    monkeypatch.setattr(evaluate, 'get_retention_features_df', lambda: df)
+    monkeypatch.setattr(evaluate, 'split_folds', lambda df: df_by_fold)
+    report = evaluate.evaluate(['m'], str(tmp_path))
+    expected = compute_metrics(EvalPrediction(
+        predictions=df.prediction.to_numpy(), label_ids=df.response.to_numpy()))
+    assert np.isclose(report['fold'].loc[('m', 'test_old_card'), 'auc'], expected['auc'])
+    assert len(report['user']) == 2 * 2
+    assert (tmp_path / 'retention_evaluation' / 'metrics_by_deck.csv').exists()
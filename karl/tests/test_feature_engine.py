@@ -0,0 +1,63 @@
+import pickle
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from karl.feature_engine import vectors_frame, compute_features, feature_records, UserCardVector
+from karl.schemas import VUserCard
+from karl.retention_phase1.data import feature_fields
+
+
+def make_vectors(n=3):
+    date = datetime(2021, 3, 1, 12, tzinfo=pytz.utc)
+    v_user = {
+        'count_positive': 5, 'count_negative': 3, 'count': 8,
+        'count_positive_session': 1, 'count_negative_session': 1, 'count_session': 2,
+        'parameters': {'repetition_model': 'karl'},
+    }
+    v_cards = [{'count_positive': i, 'count_negative': 1, 'count': i + 1} for i in range(n)]
+    v_usercards = [
+        {
+            'user_id': 'u', 'card_id': f'c{i}',
+            'count_positive': i, 'count_negative': 0, 'count': i,
+            'count_positive_session': 0, 'count_negative_session': 0, 'count_session': 0,
+            'previous_delta': 3600 * i, 'previous_study_date': date - timedelta(hours=i + 1),
+            'previous_study_response': True, 'previous_delta_session': None,
+            'previous_study_date_session': None, 'previous_study_response_session': None,
+            'correct_on_first_try': True, 'correct_on_first_try_session': None,
+            'leitner_box': 1, 'leitner_scheduled_date': None,
+            'sm2_efactor': 2.5, 'sm2_interval': 1, 'sm2_repetition': 0, 'sm2_scheduled_date': None,
+        }
+        for i in range(n)
+    ]
+    return v_user, v_cards, v_usercards, date
+
+
+def test_features_measured_from_date():
+    v_user, v_cards, v_usercards, date = make_vectors()
+    rows = vectors_frame(v_user, v_cards, v_usercards, date, ['text'] * 3)
+    features = compute_features(rows)
+    assert [c for c in features.columns if c in feature_fields] == feature_fields
+    assert features.usercard_delta.tolist() == [1, 2, 3]
+
+    later = compute_features(vectors_frame(v_user, v_cards, v_usercards, date + timedelta(hours=1), ['text'] * 3))
+    assert later.usercard_delta.tolist() == [2, 3, 4]
+
+    records = feature_records(features)
+    assert len(records) == 3 and isinstance(records[0]['utc_datetime'], str)
+
+
+def test_unknown_version():
+    v_user, v_cards, v_usercards, date = make_vectors()
+    with pytest.raises(ValueError):
+        compute_features(vectors_frame(v_user, v_cards, v_usercards, date, ['text'] * 3), version='v0')
+
+
+def test_struct_vectors_match_schemas():
+    v_user, v_cards, v_usercards, date = make_vectors()
+    structs = [UserCardVector.of(VUserCard(**x)) for x in v_usercards]
+    assert pickle.loads(pickle.dumps(structs[0])).previous_study_date == v_usercards[0]['previous_study_date']
+    expected = compute_features(vectors_frame(v_user, v_cards, v_usercards, date, ['text'] * 3))
+    features = compute_features(vectors_frame(v_user, v_cards, structs, date, ['text'] * 3))
+    assert features.equals(expected)
@@ -0,0 +1,60 @@
+from datetime import date
+
+import pandas as pd
+
+from karl.retention_phase1 import feature_store
+
+
+def make_features():
+    utc_datetime = pd.to_datetime([
+        '2021-01-30 10:00', '2021-02-01 09:00', '2021-01-31 08:00', '2021-02-02 12:00', '2021-01-30 09:00',
+    ], utc=True)
+    return pd.DataFrame({
+        'record_id': ['r0', 'r1', 'r2', 'r3', 'r4'],
+        'user_id': ['1', '1', '2', '2', '3'],
+        'card_id': ['a', 'b', 'a', 'c', 'b'],
+        'leitner_box': [1, 2, 1, 3, 0],
+        'utc_datetime': utc_datetime,
+        'utc_date': [x.date() for x in utc_datetime],
+        'response': [True, False, True, True, False],
+    })
+
+
+def test_round_trip(tmp_path):
+    df = make_features()
+    feature_store.write_features(df, str(tmp_path))
+    loaded = feature_store.load_features(store_dir=str(tmp_path))
+    expected = df.sort_values(['user_id', 'utc_datetime'], ignore_index=True)
+    pd.testing.assert_frame_equal(loaded[df.columns.tolist()], expected, check_dtype=False)
+    assert isinstance(loaded.utc_date[0], date)
+    # partitioned by month and user bucket
+    months = sorted(x.name for x in tmp_path.iterdir())
+    assert months == ['month=2021-01', 'month=2021-02']
+
+
+def test_load_projects_columns_and_filters(tmp_path):
+    feature_store.write_features(make_features(), str(tmp_path))
+    loaded = feature_store.load_features(
+        columns=['record_id', 'leitner_box'],
+        user_ids=['2', '3'],
+        date_start=pd.Timestamp('2021-01-30 09:30'),
+        date_end=pd.Timestamp('2021-02-02'),
+        store_dir=str(tmp_path),
+    )
+    assert loaded.columns.tolist() == ['record_id', 'leitner_box']
+    assert loaded.record_id.tolist() == ['r2']
+    assert feature_store.load_features(columns=['record_id'], store_dir=str(tmp_path / 'missing')).empty
+
+
+def test_rewrite_partitions(tmp_path):
+    df = make_features()
+    feature_store.write_features(df, str(tmp_path))
+    partitions = feature_store.partitions_of(df[df.user_id == '1'])
+    # user 1 loses r1, the February partition becomes empty
+    updated = df[df.record_id != 'r1'].assign(leitner_box=9)
+    feature_store.write_features(updated, str(tmp_path), partitions)
+    loaded = feature_store.load_features(store_dir=str(tmp_path))
+    assert loaded.record_id.tolist() == ['r0', 'r2', 'r3', 'r4']
+    # rows outside the rewritten partitions are untouched
+    assert loaded.set_index('record_id').leitner_box.to_dict() == {'r0': 9, 'r2': 1, 'r3': 3, 'r4': 0}
+    assert len(feature_store.load_partitions(partitions, str(tmp_path))) == 1
@@ -0,0 +1,79 @@
+import random
+import numpy as np
+from datetime import datetime, timedelta
+
+from karl.fsrs import FSRS, BatchFSRS, get_kernel
+from karl.fsrs_models import FSRSCard, State, Rating
+
+
+def test_batch_fsrs_matches_fsrs():
+    random.seed(1)
+    f = FSRS()
+    batch = BatchFSRS()
+    now = datetime(2023, 11, 1)
+
+    states, stabilities, difficulties, elapsed, ratings, expected = [], [], [], [], [], []
+    for _ in range(2000):
+        state = random.choice(list(State))
+        stability = random.uniform(0.1, 300)
+        difficulty = random.uniform(1, 10)
+        elapsed_days = random.randint(0, 400)
+        rating = random.choice(list(Rating))
+        card = FSRSCard(now, stability, difficulty, 0, 1, 0, state, now - timedelta(days=elapsed_days))
+        info = f.repeat(card, now)[rating].card
+        states.append(state)
+        stabilities.append(stability)
+        difficulties.append(difficulty)
+        elapsed.append(elapsed_days)
+        ratings.append(rating)
+        expected.append((info.state, info.stability, info.difficulty, info.scheduled_days))
+
+    new_state, new_stability, new_difficulty, interval = batch.repeat(
+        np.array(states), np.array(stabilities), np.array(difficulties), np.array(elapsed), np.array(ratings))
+
+    for i, (state, stability, difficulty, scheduled_days) in enumerate(expected):
+        assert new_state[i] == state
+        assert np.isclose(new_stability[i], stability)
+        assert np.isclose(new_difficulty[i], difficulty)
+        assert interval[i] == scheduled_days
+
+
+def test_kernel_matches_batch_fsrs():
+    rng = np.random.default_rng(1)
+    n = 10000
+    state = rng.integers(0, 4, n)
+    stability = rng.uniform(0.1, 1000, n)
+    difficulty = rng.uniform(1, 10, n)
+    elapsed_days = rng.integers(0, 1000, n)
+    rating = rng.integers(1, 5, n)
+
+    expected = BatchFSRS().repeat(state, stability, difficulty, elapsed_days, rating)
+    actual = get_kernel().repeat(state, stability, difficulty, elapsed_days, rating)
+    for x, y in zip(expected, actual):
+        assert np.allclose(x, y, rtol=1e-9)
+
+
+def test_kernel_replaces_negative_stability_per_rating():
+    rng = np.random.default_rng(2)
+    n = 1000
+    last_d = rng.uniform(1, 10, n)
+    last_s = np.where(rng.random(n) < 0.5, -1.0, rng.uniform(0.1, 1000, n))
+    retrievability = rng.uniform(0.05, 1, n)
+
+    expected = BatchFSRS().next_review_stabilities(last_d, last_s, retrievability)
+    actual = get_kernel().next_review_stabilities(last_d, last_s, retrievability)
+    for x, y in zip(expected, actual):
+        assert np.allclose(x, y, rtol=1e-9)
+
+    f = FSRS()
+    for i in np.flatnonzero(last_s < 0)[:50]:
+        d, s, r = last_d[i], last_s[i], retrievability[i]
+        assert np.isclose(actual[0][i], f.next_forget_stability(f.next_difficulty(d, Rating.Again), s, r))
+        for k, rating in enumerate([Rating.Hard, Rating.Good, Rating.Easy], 1):
+            assert np.isclose(actual[k][i], f.next_recall_stability(f.next_difficulty(d, rating), s, r, rating))
+
+
+if __name__ == '__main__':
+    test_batch_fsrs_matches_fsrs()
+    test_kernel_matches_batch_fsrs()
+    test_kernel_replaces_negative_stability_per_rating()
@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from karl.retention_phase1 import model_features
+from karl.retention_phase1.backend import served_scores
+from karl.retention_phase1.model_distilbert import DistilBertRetentionModel
+from karl.retention_phase1.model_features import FeatureRetentionModel, calibrate
+
+
+class FullModel(nn.Module):
+    '''Stands in for DistilBERT: the first retention feature is its prediction.'''
+
+    def forward(self, retention_features, **kwargs):
+        return (retention_features[:, 0],)
+
+
+def make_feature_model(ys):
+    # zero weights, so the feature model predicts sigmoid(bias) for every card
+    model = FeatureRetentionModel(retention_feature_size=2, margin=0)
+    with torch.no_grad():
+        model.linear.weight.zero_()
+        model.linear.bias.fill_(torch.logit(torch.tensor(ys)))
+    return model
+
+
+def use_test_fold(monkeypatch, ys_full):
+    items = [{'retention_features': torch.tensor([y, 0.0]), 'labels': torch.tensor(1.0)} for y in ys_full]
+    monkeypatch.setattr(model_features.DistilBertTokenizerFast, 'from_pretrained', lambda name: None)
+    monkeypatch.setattr(model_features, 'RetentionDataset', lambda data_dir, fold, tokenizer: items)
+    monkeypatch.setattr(model_features, 'retention_data_collator', lambda inputs: {
+        key: torch.stack([x[key] for x in inputs]) for key in inputs[0]
+    })
+    monkeypatch.setattr(DistilBertRetentionModel, 'from_pretrained', lambda model_dir: FullModel())
+
+
+def test_near_window_uses_margin():
+    model = FeatureRetentionModel(retention_feature_size=2, margin=0.05)
+    scores = torch.tensor([0.5, 0.55, 0.64, 0.7, 0.76])
+    assert model.near_window(scores, 0.65, 0.7).tolist() == [False, False, True, True, False]
+
+
+def test_calibrate_margin_is_gap_between_served_scores(monkeypatch):
+    ys_full = np.linspace(0.1, 0.9, 101)
+    use_test_fold(monkeypatch, ys_full.tolist())
+    model = make_feature_model(0.5)
+    margin = calibrate(model, 'model_dir', quantile=1.0, batch_size=16)
+    gaps = served_scores(torch.tensor(ys_full)) - served_scores(torch.tensor(0.5))
+    assert np.isclose(margin, gaps.abs().max().item(), atol=1e-6)
+    assert model.margin == margin
+    # a gap on the probability scale would overshoot the served window
+    assert margin < 0.4
+
+
+def test_calibrated_margin_keeps_cards_full_model_puts_in_window(monkeypatch):
+    ys_full = np.linspace(0.1, 0.9, 101)
+    use_test_fold(monkeypatch, ys_full.tolist())
+    model = make_feature_model(0.5)
+    calibrate(model, 'model_dir', quantile=1.0)
+    served_full = served_scores(torch.tensor(ys_full, dtype=torch.float))
+    served_cheap = served_scores(model(torch.zeros(len(ys_full), 2))[0])
+    lowest, highest = served_full[60].item(), served_full[80].item()
+    in_window = (served_full >= lowest) & (served_full <= highest)
+    assert model.near_window(served_cheap, lowest, highest)[in_window].all()
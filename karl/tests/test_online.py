@@ -0,0 +1,95 @@
+import os
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import torch
+
+from karl.retention_phase1.backend import model_version
+from karl.retention_phase1.embedding_cache import CardEmbeddingCache, save_card_embeddings
+from karl.retention_phase1.model_distilbert import DistilBertRetentionModelConfig, DistilBertRetentionModel
+from karl.retention_phase1.online import OnlineLearner, Cursor
+
+
+def make_learner(output_dir, **kwargs):
+    torch.manual_seed(0)
+    model_dir = f'{output_dir}/retention_hf_distilbert_new_card'
+    config = DistilBertRetentionModelConfig(n_layers=1, dim=8, hidden_dim=16, n_heads=2, vocab_size=30)
+    DistilBertRetentionModel(config).save_pretrained(model_dir)
+    # every card precomputed, so nothing is tokenized
+    rng = np.random.default_rng(0)
+    save_card_embeddings(model_dir, [f'c{i}' for i in range(4)], rng.normal(size=(4, 8)).astype(np.float32))
+    return OnlineLearner('new_card', str(output_dir), batch_size=8, **kwargs)
+
+
+def make_records(n=40, start=0):
+    date = pd.Timestamp('2021-03-01', tz='utc')
+    return pd.DataFrame({
+        'record_id': [f'r{i}' for i in range(start, start + n)],
+        'card_id': [f'c{i % 4}' for i in range(start, start + n)],
+        'card_text': 'text',
+        'response': [i % 4 != 0 for i in range(start, start + n)],
+        'utc_datetime': [date + timedelta(minutes=i) for i in range(start, start + n)],
+    })
+
+
+def head_weights(learner):
+    return [x.clone() for x in learner.model.classifier.parameters()]
+
+
+def test_cursor_keeps_recent_ids(tmp_path):
+    cursor = Cursor(str(tmp_path), lookback=timedelta(minutes=10))
+    assert cursor.date is None and cursor.date_start is None
+    df = make_records(30)
+    cursor.advance(df)
+    cursor = Cursor(str(tmp_path), lookback=timedelta(minutes=10))
+    assert cursor.date == df.utc_datetime.max()
+    assert sorted(cursor.recent) == sorted(df.record_id[-11:])
+    assert cursor.new_records(make_records(10, start=25)).record_id.tolist() == [f'r{i}' for i in range(30, 35)]
+
+
+def test_step_rolls_back_rejected_update(tmp_path):
+    learner = make_learner(tmp_path, learning_rate=1e-1, tolerance=-np.inf)
+    before = head_weights(learner)
+    result = learner.step(make_records())
+    assert not result['accepted']
+    assert (result['n_train'], result['n_validation']) == (32, 8)
+    assert all(torch.equal(x, y) for x, y in zip(before, head_weights(learner)))
+
+    learner.tolerance = np.inf
+    assert learner.step(make_records())['accepted']
+    assert not all(torch.equal(x, y) for x, y in zip(before, head_weights(learner)))
+
+
+def test_held_out_records_stay_new(tmp_path):
+    learner = make_learner(tmp_path)
+    cursor = Cursor(learner.versions_dir)
+    df = make_records()
+    df_train, df_validation = learner.split(df)
+    cursor.advance(df_train)
+    assert Cursor(learner.versions_dir).new_records(df).record_id.tolist() == df_validation.record_id.tolist()
+
+
+def test_publish_installs_head_and_embeddings(tmp_path):
+    learner = make_learner(tmp_path, learning_rate=1e-1, tolerance=np.inf)
+    version = model_version(learner.model_dir)
+    learner.step(make_records())
+    for _ in range(3):
+        version_dir = learner.publish({'accepted': True}, keep=2)
+    assert os.path.exists(f'{version_dir}/online_metrics.json')
+    assert len(os.listdir(learner.versions_dir)) == 2
+    assert model_version(learner.model_dir) == model_version(version_dir) != version
+    served = DistilBertRetentionModel.from_pretrained(learner.model_dir)
+    assert all(torch.equal(x, y) for x, y in zip(served.classifier.parameters(), head_weights(learner)))
+    # the cache stays valid for the installed weights
+    assert len(CardEmbeddingCache(learner.model_dir, 8)) == 4
+
+
+def test_embed_more_new_cards_than_cache(tmp_path):
+    learner = make_learner(tmp_path)
+    learner.cache.max_extra = 1
+    learner.encode = lambda card_ids, card_texts: np.stack([np.full(8, float(x[1:])) for x in card_ids])
+    embeddings = learner.embed(['n1', 'c0', 'n2', 'n3', 'n1'], ['text'] * 5)
+    assert embeddings[:, 0].tolist()[2:] == [2, 3, 1]
+    # only the most recent miss is kept
+    assert list(learner.cache.extra) == ['n3']
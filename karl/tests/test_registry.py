@@ -0,0 +1,73 @@
+import time
+import itertools
+from types import SimpleNamespace
+
+from karl.retention_phase1.registry import ModelRegistry
+
+
+class Disk:
+    '''Checkpoint version on disk; `writing` changes it on every read, like a checkpoint being written.'''
+
+    def __init__(self, version):
+        self.version = version
+        self.writing = None
+        self.broken = False
+        self.loads = []
+
+    def read(self):
+        if self.writing is not None:
+            return f'{self.version}-{next(self.writing)}'
+        return self.version
+
+    def load(self):
+        if self.broken:
+            self.loads.append(None)
+            raise RuntimeError('broken checkpoint')
+        model = SimpleNamespace(version=self.read())
+        self.loads.append(model.version)
+        return model
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def test_reload_blocks_and_swaps():
+    disk = Disk('v1')
+    registry = ModelRegistry(disk.load, disk.read)
+    disk.version = 'v2'
+    assert registry.reload(block=True)
+    assert registry.get().version == 'v2'
+
+
+def test_watcher_waits_for_two_equal_polls():
+    disk = Disk('v1')
+    registry = ModelRegistry(disk.load, disk.read, poll_interval=0.01)
+    disk.writing = itertools.count()
+    registry.get()
+    # the version changes on every poll while writing, never loaded
+    time.sleep(0.1)
+    assert disk.loads == ['v1']
+    disk.writing, disk.version = None, 'v2'
+    assert wait_for(lambda: registry.version == 'v2')
+    time.sleep(0.05)
+    assert disk.loads == ['v1', 'v2']
+
+
+def test_watcher_keeps_model_on_failed_load():
+    disk = Disk('v1')
+    registry = ModelRegistry(disk.load, disk.read, poll_interval=0.01)
+    model = registry.get()
+    disk.version, disk.broken = 'v2', True
+    assert wait_for(lambda: len(disk.loads) == 2)
+    # the broken version is not retried until it changes again
+    time.sleep(0.1)
+    assert disk.loads == ['v1', None]
+    assert registry.get() is model
+    disk.version, disk.broken = 'v3', False
+    assert wait_for(lambda: registry.version == 'v3')
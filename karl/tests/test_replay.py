@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from karl.replay import replay_user, estimate, POLICIES
+
+
+def make_log(n_requests=6):
+    date = datetime(2021, 3, 1, 12, tzinfo=pytz.utc)
+    card_ids = ['c0', 'c1', 'c2']
+    requests, records = [], []
+    for i in range(n_requests):
+        request_date = date + timedelta(days=i)
+        requests.append(SimpleNamespace(
+            id=f'r{i}', card_ids=card_ids, date=request_date, repetition_model='leitner',
+            recall_target=0.85, recall_target_lowest=0, recall_target_highest=1,
+        ))
+        records.append(SimpleNamespace(
+            debug_id=f'r{i}', card_id=card_ids[i % 3], label=i % 2 == 0,
+            date=request_date + timedelta(seconds=10),
+        ))
+    return requests, records, {card_id: 'text' for card_id in card_ids}
+
+
+def count_scorer(features: pd.DataFrame) -> np.ndarray:
+    # more studies, better recall
+    return 0.5 + 0.1 * features.usercard_n_study_positive.to_numpy()
+
+
+def test_replay_user_sees_only_earlier_records():
+    requests, records, card_texts = make_log()
+    decisions = replay_user('u', requests, records, card_texts, count_scorer)
+    assert decisions.request_id.tolist() == [x.id for x in requests]
+    assert decisions.reward.tolist() == [1.0, 0.0, 1.0, 0.0, 1.0, 0.0]
+    # nothing studied before the first request, c0 recalled once before the fourth
+    assert decisions.logged_recall.tolist()[:4] == [0.5, 0.5, 0.5, 0.6]
+    # all cards new at first, every policy picks the first candidate
+    assert all(decisions[f'{policy}_match'][0] for policy in POLICIES)
+    # c0 recalled on day 0 is due for leitner on day 0.5, for sm-2 on day 1
+    assert decisions.logged_rank.tolist() == [0, 1, 2, 0, 0, 0]
+    assert decisions.leitner_match.tolist() == [True, False, False, True, True, True]
+    assert decisions['sm-2_match'][1] and decisions['sm-2_recall'][1] == 0.5
+
+
+def test_replay_user_skips_requests_without_outcome():
+    requests, records, card_texts = make_log()
+    records = records[:-1]
+    records[0] = SimpleNamespace(**{**records[0].__dict__, 'card_id': 'c9'})
+    decisions = replay_user('u', requests, records, card_texts, count_scorer)
+    assert decisions.request_id.tolist() == ['r1', 'r2', 'r3', 'r4']
+
+
+def test_estimate():
+    requests, records, card_texts = make_log()
+    decisions = replay_user('u', requests, records, card_texts, count_scorer)
+    estimates = estimate(decisions)
+    assert estimates.index.tolist() == POLICIES
+    assert estimates.coverage.tolist() == [1.0] * len(POLICIES)
+    leitner = decisions[decisions.leitner_match]
+    assert estimates.loc['leitner', 'replay'] == leitner.reward.mean()
+    # leitner showed its top card in 4 of 6 decisions: weight 1.5 on those
+    assert np.isclose(estimates.loc['leitner', 'match_rate'], 4 / 6)
+    assert np.isclose(estimates.loc['leitner', 'ips'], (1 + 0 + 1 + 0) * 1.5 / 6)
+
+
+def test_replay_user_fsrs_ranks_new_cards_last():
+    requests, records, card_texts = make_log(2)
+    for request in requests:
+        request.repetition_model = 'fsrs'
+    # c1, never studied, is shown an hour after c0 is recalled and due the same day
+    requests[1].card_ids = ['c1', 'c0']
+    requests[1].date = records[1].date = requests[0].date + timedelta(hours=1)
+    decisions = replay_user('u', requests, records, card_texts, count_scorer)
+    assert decisions.logged_rank.tolist() == [0, 1]
+    assert decisions.fsrs_match.tolist() == [True, False]
+    assert decisions.fsrs_recall[1] == 0.6
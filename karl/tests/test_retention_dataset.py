@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from karl.config import settings
+from karl.retention_phase1 import data
+from karl.retention_phase1.data import RetentionDataset, feature_fields, folds, split_folds
+
+
+class Tokenizer:
+    '''One token per character, after a [CLS]-like 1.'''
+
+    model_max_length = 6
+    name_or_path = 'chars'
+    pad_token_id = 0
+
+    def __call__(self, texts, truncation=True, max_length=None):
+        return {'input_ids': [[1] + [ord(c) for c in text][:max_length - 1] for text in texts]}
+
+
+def make_features(n=60, seed=0):
+    rng = np.random.default_rng(seed)
+    card_ids = rng.integers(0, 8, n)
+    df = pd.DataFrame(rng.normal(size=(n, len(feature_fields))), columns=feature_fields)
+    return df.assign(
+        record_id=[f'r{i}' for i in range(n)],
+        user_id=rng.integers(0, 3, n).astype(str),
+        card_id=[f'c{i}' for i in card_ids],
+        # cards of different lengths, some truncated
+        card_text=['x' * (1 + i) for i in card_ids],
+        is_new_fact=rng.random(n) < 0.4,
+        response=rng.random(n) < 0.7,
+        utc_datetime=pd.date_range('2021-03-01', periods=n, freq='60min', tz='utc'),
+    )
+
+
+def test_memmapped_folds_match_in_memory_build(monkeypatch, tmp_path):
+    df = make_features()
+    builds = []
+    monkeypatch.setattr(settings, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(data, 'get_retention_features_df', lambda overwrite=False: builds.append(1) or df)
+    tokenizer = Tokenizer()
+
+    # in memory: every example tokenized on its own, old-card features
+    # normalized with the train fold statistics
+    expected = split_folds(df)
+    train_old_card = expected['train_old_card'][feature_fields].to_numpy()
+    mean, std = train_old_card.mean(axis=0), train_old_card.std(axis=0)
+
+    RetentionDataset(str(tmp_path), 'train_new_card', tokenizer)
+    for fold in folds:
+        # reopened from the cached arrays, without building again
+        dataset = RetentionDataset(str(tmp_path), fold, tokenizer)
+        assert isinstance(dataset.input_ids, np.memmap) and isinstance(dataset.labels, np.memmap)
+        x = expected[fold]
+        input_ids = tokenizer(x.card_text.tolist(), max_length=tokenizer.model_max_length)['input_ids']
+        assert len(dataset) == len(x)
+        assert dataset.lengths.tolist() == [len(ids) for ids in input_ids]
+        assert dataset.record_ids == x.record_id.tolist()
+        assert [dataset.card_ids[i] for i in dataset.card_index] == x.card_id.tolist()
+        for i in range(len(dataset)):
+            item = dataset[i]
+            assert item.input_ids.tolist() == input_ids[i]
+            assert item.label == int(x.response.iloc[i])
+            if fold.endswith('old_card'):
+                features = (x[feature_fields].to_numpy()[i] - mean) / std
+                assert np.allclose(item.retention_features, features, atol=1e-5)
+            else:
+                assert item.retention_features is None
+    assert len(builds) == 1
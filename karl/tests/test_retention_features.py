@@ -0,0 +1,102 @@
+import json
+from datetime import timedelta
+from functools import partial
+from types import SimpleNamespace
+
+import pandas as pd
+
+from karl.config import settings
+from karl.retention_phase1 import data, feature_store
+
+
+def make_features(n):
+    return pd.DataFrame({
+        'record_id': [f'r{i}' for i in range(n)],
+        'user_id': 'u',
+        'elapsed_milliseconds': 60000,
+        'utc_datetime': pd.date_range('2021-03-01', periods=n, freq='D', tz='utc'),
+    })
+
+
+def use_store(monkeypatch, tmp_path, df=None):
+    '''An in-memory feature store holding `df`, and a data dir without a watermark.'''
+    store = {'df': df}
+    monkeypatch.setattr(settings, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(data, 'feature_store', SimpleNamespace(
+        exists=lambda: store['df'] is not None,
+        write_features=lambda df, **kwargs: store.update(df=df),
+        load_features=lambda **kwargs: store['df'],
+    ))
+    monkeypatch.setattr(data, '_read_retention_features', lambda since=None, chunk_size=None: make_features(3))
+    return store
+
+
+def test_refresh_without_watermark_rebuilds(monkeypatch, tmp_path):
+    use_store(monkeypatch, tmp_path, make_features(1))
+    df = data.get_retention_features_df(refresh=True)
+    assert df.record_id.tolist() == ['r0', 'r1', 'r2']
+    assert df.n_minutes_spent.tolist() == [1, 2, 3]
+    with open(tmp_path / 'retention_features_watermark.json') as f:
+        assert pd.Timestamp(json.load(f)['date']) == df.utc_datetime.max()
+
+
+def test_refresh_of_legacy_file_rebuilds(monkeypatch, tmp_path):
+    store = use_store(monkeypatch, tmp_path)
+    make_features(1).to_hdf(tmp_path / 'retention_features.h5', key='df')
+    assert len(data.get_retention_features_df()) == 1
+    store['df'] = None
+    assert len(data.get_retention_features_df(refresh=True)) == 3
+
+
+def test_refresh_appends_new_records(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'DATA_DIR', str(tmp_path))
+    store_dir = str(tmp_path / 'store')
+    writes, reads = [], []
+
+    def write_features(df, partitions=None):
+        writes.append((set(df.record_id), partitions))
+        feature_store.write_features(df, store_dir, partitions)
+
+    monkeypatch.setattr(data, 'feature_store', SimpleNamespace(
+        exists=partial(feature_store.exists, store_dir),
+        write_features=write_features,
+        load_features=partial(feature_store.load_features, store_dir=store_dir),
+        load_partitions=partial(feature_store.load_partitions, store_dir=store_dir),
+        partitions_of=feature_store.partitions_of,
+    ))
+    db = make_features(3).assign(user_id=['1', '2', '1'])
+
+    def read(since=None, chunk_size=None):
+        reads.append(since)
+        return db if since is None else db[db.utc_datetime > since]
+
+    monkeypatch.setattr(data, '_read_retention_features', read)
+    data.get_retention_features_df(refresh=True)
+    watermark = pd.Timestamp('2021-03-03', tz='utc')
+
+    # a record of a new user, a later one of user 1, and one of user 2
+    # committed late, within the lookback of the watermark
+    db = pd.concat([db, pd.DataFrame({
+        'record_id': ['r3', 'r4', 'r5'],
+        'user_id': ['1', '3', '2'],
+        'elapsed_milliseconds': 60000,
+        'utc_datetime': [watermark + timedelta(days=1), watermark + timedelta(days=2), watermark - timedelta(minutes=30)],
+    })], ignore_index=True)
+    df = data.get_retention_features_df(refresh=True)
+
+    assert reads == [None, watermark - timedelta(hours=1)]
+    # only the new records were added, by rewriting the partitions they fall in
+    new_rows, partitions = writes[-1]
+    assert partitions is not None and {'r3', 'r4', 'r5'} <= new_rows
+    assert sorted(df.record_id) == ['r0', 'r1', 'r2', 'r3', 'r4', 'r5']
+    # running totals continue each user's history
+    assert df.set_index('record_id').n_minutes_spent.to_dict() == {
+        'r0': 1, 'r2': 2, 'r3': 3, 'r1': 1, 'r5': 2, 'r4': 1}
+    with open(tmp_path / 'retention_features_watermark.json') as f:
+        assert pd.Timestamp(json.load(f)['date']) == watermark + timedelta(days=2)
+
+    # nothing new: nothing written, the watermark stays
+    data.get_retention_features_df(refresh=True)
+    assert len(writes) == 2
+    with open(tmp_path / 'retention_features_watermark.json') as f:
+        assert pd.Timestamp(json.load(f)['date']) == watermark + timedelta(days=2)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from karl.retention_phase1.data import split_folds, time_series_folds
+
+
+def make_df(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'user_id': rng.integers(0, 20, n).astype(str),
+        'is_new_fact': rng.random(n) < 0.4,
+        'order': np.arange(n),
+    })
+
+
+def test_split_folds_matches_per_user_split():
+    df = make_df()
+    folds = split_folds(df)
+    for card, is_new_fact in [('new_card', True), ('old_card', False)]:
+        expected_train, expected_test = [], []
+        for _, x in df[df.is_new_fact == is_new_fact].groupby('user_id'):
+            expected_train.append(x.iloc[:int(x.user_id.size * 0.75)])
+            expected_test.append(x.iloc[int(x.user_id.size * 0.75):])
+        assert folds[f'train_{card}'].order.tolist() == pd.concat(expected_train).order.tolist()
+        assert folds[f'test_{card}'].order.tolist() == pd.concat(expected_test).order.tolist()
+
+
+def test_time_series_folds_test_after_train():
+    df = make_df()
+    splits = time_series_folds(df, n_splits=3)
+    assert len(splits) == 3
+    for k, folds in enumerate(splits):
+        for card in ['new_card', 'old_card']:
+            last_train = folds[f'train_{card}'].groupby('user_id').order.max()
+            first_test = folds[f'test_{card}'].groupby('user_id').order.min()
+            assert (last_train.reindex(first_test.index) < first_test).all()
+        if k > 0:
+            assert len(folds['train_old_card']) > len(splits[k - 1]['train_old_card'])
@@ -0,0 +1,119 @@
+import re
+import json
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import JSONB
+
+from karl.models import Card, StudyRecord, UserSnapshotV2, CardSnapshotV2, UserCardSnapshotV2
+from karl.schemas import ParametersSchema
+from karl.retention_phase1.data import _retention_features_query
+
+
+@compiles(JSONB, 'sqlite')
+def _jsonb_as_text(element, compiler, **kwargs):
+    return 'TEXT'
+
+
+DATE = datetime(2021, 3, 1)
+PARAMETERS = json.dumps(ParametersSchema().__dict__)
+
+# (record id, schedule request, user, card, label, minutes after DATE)
+RECORDS = [
+    # r01 and r02 tie on date, so they rank by id
+    ('r01', 'q1', '1', 'a', True, 0),
+    ('r02', 'q1', '1', 'b', False, 0),
+    ('r03', 'q1', '1', 'a', True, 1),
+    # a user with a single record and snapshot
+    ('r04', 'q2', '2', 'a', True, 2),
+    # two records, one snapshot: ranks do not line up
+    ('r05', 'q3', '3', 'a', True, 3),
+    ('r06', 'q3', '3', 'a', False, 4),
+    # unlabeled records keep their snapshots' ranks
+    ('r07', 'q4', '1', 'b', None, 5),
+    ('r08', 'q4', '1', 'b', True, 6),
+    # not a numeric user id
+    ('r09', 'q5', 'guest', 'a', True, 7),
+]
+MISSING_SNAPSHOTS = {'r06'}
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+
+    @event.listens_for(engine, 'connect')
+    def regexp(connection, _):
+        connection.create_function('REGEXP', 2, lambda pattern, x: re.search(pattern, x) is not None)
+
+    for model in [Card, StudyRecord, UserSnapshotV2, CardSnapshotV2, UserCardSnapshotV2]:
+        model.__table__.create(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([Card(id=x, text=f'card {x}', answer='', deck_id='d', deck_name='deck') for x in ['a', 'b']])
+    # snapshots are saved in record order; `count` tells which record each belongs to
+    for i, (record_id, request_id, user_id, card_id, label, minutes) in enumerate(RECORDS):
+        date = DATE + timedelta(minutes=minutes)
+        session.add(StudyRecord(
+            id=record_id, debug_id=request_id, user_id=user_id, card_id=card_id, label=label, date=date,
+            elapsed_milliseconds_text=1000, elapsed_milliseconds_answer=1000,
+        ))
+        if record_id in MISSING_SNAPSHOTS:
+            continue
+        session.add(UserSnapshotV2(user_id=user_id, schedule_request_id=request_id, date=date, count=i, parameters=PARAMETERS))
+        session.add(CardSnapshotV2(card_id=card_id, schedule_request_id=request_id, date=date, count=i))
+        session.add(UserCardSnapshotV2(user_id=user_id, card_id=card_id, schedule_request_id=request_id, date=date, count=i))
+        session.flush()
+    session.commit()
+    yield session
+    session.close()
+
+
+def pair_row_by_row(session, since=None):
+    '''Reference pairing, one record at a time: the k-th record of a request
+    (of a card within a request) takes its k-th snapshot, if the counts agree.'''
+    records = session.query(StudyRecord).order_by(StudyRecord.date, StudyRecord.id).all()
+    pairs = []
+    for record in records:
+        if not record.user_id.isdigit():
+            continue
+        same_request = [x for x in records if x.debug_id == record.debug_id]
+        same_card = [x for x in same_request if x.card_id == record.card_id]
+        user_snapshots = session.query(UserSnapshotV2).filter_by(
+            schedule_request_id=record.debug_id).order_by(UserSnapshotV2.id).all()
+        snapshots = [
+            session.query(model).filter_by(schedule_request_id=record.debug_id, card_id=record.card_id).order_by(model.id).all()
+            for model in [CardSnapshotV2, UserCardSnapshotV2]
+        ]
+        if len(user_snapshots) != len(same_request) or any(len(x) != len(same_card) for x in snapshots):
+            continue
+        if record.label is None or (since is not None and record.date <= since):
+            continue
+        user_snapshot = user_snapshots[same_request.index(record)]
+        card_snapshot, usercard_snapshot = [x[same_card.index(record)] for x in snapshots]
+        pairs.append((record.id, user_snapshot.count, card_snapshot.count, usercard_snapshot.count))
+    return sorted(pairs)
+
+
+def pair_set_based(session, since=None):
+    result = session.execute(_retention_features_query(session, since).statement)
+    df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    return sorted(df[['record_id', 'user_count', 'card_count', 'usercard_count']].itertuples(index=False, name=None))
+
+
+def test_pairs_like_row_by_row(session):
+    pairs = pair_set_based(session)
+    assert pairs == pair_row_by_row(session)
+    # every record paired with its own snapshots, unpaired ones dropped
+    assert [x[0] for x in pairs] == ['r01', 'r02', 'r03', 'r04', 'r08']
+    assert all(x[1] == x[2] == x[3] == int(x[0][1:]) - 1 for x in pairs)
+
+
+def test_pairs_since_rank_whole_requests(session):
+    since = DATE + timedelta(minutes=0, seconds=30)
+    pairs = pair_set_based(session, since)
+    assert pairs == pair_row_by_row(session, since)
+    assert [x[0] for x in pairs] == ['r03', 'r04', 'r08']
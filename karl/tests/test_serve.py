@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import signal
+from types import SimpleNamespace
+
+import torch.nn as nn
+
+from karl.config import settings
+from karl.retention_phase1 import serve
+from karl.retention_phase1.registry import ModelRegistry
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_worker_threads_split_cores(monkeypatch):
+    monkeypatch.setattr(settings, 'MODEL_NUM_THREADS', 0)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    assert serve.worker_threads(4) == 2
+    # more workers than cores still leaves each worker a thread
+    assert serve.worker_threads(16) == 1
+    monkeypatch.setattr(settings, 'MODEL_NUM_THREADS', 3)
+    assert serve.worker_threads(4) == 3
+
+
+def test_share_weights_moves_parameters_and_buffers():
+    model = nn.BatchNorm1d(4)
+    serve.share_weights(model)
+    assert all(x.is_shared() for x in model.parameters())
+    assert all(x.is_shared() for x in model.buffers())
+
+
+def test_bind_socket_is_inherited_by_workers():
+    sock = serve.bind_socket('127.0.0.1', 0)
+    try:
+        assert sock.get_inheritable()
+        assert sock.getsockname()[1] > 0
+    finally:
+        sock.close()
+
+
+def test_spawn_worker_exits_nonzero_on_failure(monkeypatch):
+    def run_worker(app, sock, num_threads, log_level):
+        raise RuntimeError('no app')
+
+    monkeypatch.setattr(serve, 'run_worker', run_worker)
+    pid = serve.spawn_worker(None, None, 1, 'info')
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 1
+
+
+def test_prefork_reloads_in_parent_and_replaces_workers(monkeypatch, tmp_path):
+    version_path = tmp_path / 'version'
+    version_path.write_text('v1')
+    reports = tmp_path / 'workers'
+    reports.mkdir()
+
+    def load():
+        return SimpleNamespace(version=version_path.read_text(), model=nn.Linear(2, 2))
+
+    registry = ModelRegistry(load, version_path.read_text, poll_interval=0.05)
+
+    def run_worker(app, sock, num_threads, log_level):
+        # what a request handled by this worker would see
+        model = registry.get()
+        (reports / str(os.getpid())).write_text(json.dumps({
+            'version': model.version,
+            'num_threads': num_threads,
+            'watching': registry._pid is not None,
+            'shared': model.model.weight.is_shared(),
+        }))
+        time.sleep(60)
+
+    def read_reports():
+        return {int(x.name): json.loads(x.read_text()) for x in reports.iterdir()}
+
+    monkeypatch.setattr(serve, 'run_worker', run_worker)
+    supervisor = os.fork()
+    if supervisor == 0:
+        try:
+            serve.prefork(None, registry, None, 2, 3, 'info')
+        finally:
+            os._exit(0)
+
+    try:
+        assert wait_for(lambda: len(read_reports()) == 2)
+        old_workers = list(read_reports())
+        version_path.write_text('v2')
+        assert wait_for(lambda: len(read_reports()) == 4)
+        new_workers = {pid: x for pid, x in read_reports().items() if pid not in old_workers}
+        assert [x['version'] for x in new_workers.values()] == ['v2', 'v2']
+        # the reload kept the worker thread budget and the shared weights, and
+        # workers do not load models of their own
+        assert all(x['num_threads'] == 3 and x['shared'] and not x['watching'] for x in new_workers.values())
+        assert wait_for(lambda: not any(is_running(pid) for pid in old_workers))
+        assert all(is_running(pid) for pid in new_workers)
+    finally:
+        os.kill(supervisor, signal.SIGTERM)
+        _, status = os.waitpid(supervisor, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert not any(is_running(pid) for pid in new_workers)
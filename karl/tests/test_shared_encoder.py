@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from karl.retention_phase1.model_distilbert import (
+    DistilBertRetentionModelConfig,
+    DistilBertRetentionModel,
+    DistilBertSharedEncoderRetentionModel,
+)
+
+
+def make_model(retention_feature_size, seed):
+    torch.manual_seed(seed)
+    config = DistilBertRetentionModelConfig(
+        n_layers=1, dim=8, hidden_dim=16, n_heads=2, vocab_size=50, retention_feature_size=retention_feature_size)
+    return DistilBertRetentionModel(config)
+
+
+def test_from_pair_keeps_both_heads_on_a_shared_encoder():
+    model_new_card, model_old_card = make_model(0, seed=0), make_model(3, seed=1)
+    model_new_card.distilbert.load_state_dict(model_old_card.distilbert.state_dict())
+    model = DistilBertSharedEncoderRetentionModel.from_pair(model_new_card, model_old_card, tolerance=1e-6)
+    input_ids = torch.randint(5, 50, (4, 6))
+    retention_features = torch.randn(4, 3)
+    is_new_card = torch.tensor([True, False, True, False])
+    with torch.inference_mode():
+        y = model(input_ids=input_ids, retention_features=retention_features, is_new_card=is_new_card)[0]
+        y_new = model_new_card(input_ids=input_ids)[0]
+        y_old = model_old_card(input_ids=input_ids, retention_features=retention_features)[0]
+    assert torch.allclose(y, torch.where(is_new_card, y_new, y_old))
+
+
+def test_from_pair_refuses_heads_trained_on_another_encoder():
+    model_new_card, model_old_card = make_model(0, seed=0), make_model(3, seed=1)
+    with pytest.raises(ValueError, match='new_card head'):
+        DistilBertSharedEncoderRetentionModel.from_pair(model_new_card, model_old_card, tolerance=1e-6)
@@ -0,0 +1,52 @@
+import numpy as np
+
+from karl.retention_phase1.token_cache import TokenCache
+
+
+class Tokenizer:
+    '''One token per character, counting calls.'''
+
+    model_max_length = 8
+    name_or_path = 'chars'
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts, truncation=True, max_length=None):
+        self.texts.extend(texts)
+        return {'input_ids': [[ord(c) for c in text[:max_length]] for text in texts]}
+
+
+def as_lists(input_ids):
+    return [np.asarray(x).tolist() for x in input_ids]
+
+
+def test_lookup_hits_disk_and_memory(tmp_path):
+    tokenizer = Tokenizer()
+    cache = TokenCache(tokenizer, cache_dir=str(tmp_path), max_extra=2)
+    cache.build(['a', 'b'], ['ab', 'b'])
+    assert as_lists(cache.lookup(['b', 'c', 'a'], ['b', 'c', 'ab'])) == [[98], [99], [97, 98]]
+    # only the card missing from disk is tokenized, once
+    assert cache.lookup(['c'], ['c'])[0].tolist() == [99]
+    assert tokenizer.texts == ['ab', 'b', 'c']
+    # a reopened cache reads the cards built on disk
+    assert 'a' in TokenCache(tokenizer, cache_dir=str(tmp_path)) and len(cache) == 3
+
+
+def test_lookup_evicts_least_recently_used(tmp_path):
+    tokenizer = Tokenizer()
+    cache = TokenCache(tokenizer, cache_dir=str(tmp_path), max_extra=2)
+    cache.lookup(['a', 'b'], ['a', 'b'])
+    cache.lookup(['a'], ['a'])
+    cache.lookup(['c'], ['c'])
+    assert list(cache.extra) == ['a', 'c']
+    cache.lookup(['b'], ['b'])
+    assert tokenizer.texts == ['a', 'b', 'c', 'b']
+
+
+def test_lookup_more_misses_than_cap(tmp_path):
+    cache = TokenCache(Tokenizer(), cache_dir=str(tmp_path), max_extra=1)
+    input_ids = cache.lookup(['a', 'b', 'c', 'a'], ['a', 'b', 'c', 'a'])
+    assert as_lists(input_ids) == [[97], [98], [99], [97]]
+    assert list(cache.extra) == ['c']
+    assert len(TokenCache(Tokenizer(), cache_dir=str(tmp_path), max_extra=0).lookup(['a'], ['a'])) == 1
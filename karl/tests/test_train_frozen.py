@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+
+from karl.config import settings
+from karl.retention_phase1 import train_frozen
+from karl.retention_phase1.backend import quantize
+from karl.retention_phase1.data import feature_fields
+from karl.retention_phase1.embedding_cache import CardEmbeddingCache
+from karl.retention_phase1.model_distilbert import DistilBertRetentionModelConfig, DistilBertRetentionModel
+from karl.retention_phase1.train_frozen import card_embeddings
+
+
+def make_dataset(examples):
+    '''A fold of (card id, token ids) examples laid out like `RetentionDataset`.'''
+    card_index, card_ids = pd.factorize(pd.Series([card_id for card_id, _ in examples], dtype=object))
+    input_ids = [np.asarray(tokens, dtype=np.int64) for _, tokens in examples]
+    return SimpleNamespace(
+        card_index=card_index,
+        card_ids=list(card_ids),
+        input_ids=np.concatenate(input_ids),
+        offsets=np.cumsum([0] + [len(x) for x in input_ids]),
+        pad_token_id=0,
+        labels=np.arange(len(examples)) % 2,
+        retention_features=np.zeros((len(examples), len(feature_fields)), dtype=np.float32),
+    )
+
+
+def make_model(**kwargs):
+    torch.manual_seed(0)
+    return DistilBertRetentionModel(DistilBertRetentionModelConfig(
+        n_layers=1, dim=16, hidden_dim=32, n_heads=2, vocab_size=100, **kwargs)).eval()
+
+
+def test_card_embeddings_rows_follow_card_ids():
+    model = make_model()
+    cards = {'a': [5, 6, 7], 'b': [8, 9], 'c': [10, 11, 12, 13]}
+    train = make_dataset([('b', cards['b']), ('a', cards['a']), ('b', cards['b']), ('c', cards['c'])])
+    test = make_dataset([('c', cards['c']), ('a', cards['a']), ('c', cards['c'])])
+
+    embeddings, card_ids, rows = card_embeddings(model, [train, test], batch_size=2)
+    # each card encoded once, shared across folds
+    assert sorted(card_ids) == ['a', 'b', 'c']
+    assert embeddings.shape == (3, 16)
+    assert [card_ids[i] for i in rows[0]] == ['b', 'a', 'b', 'c']
+    assert [card_ids[i] for i in rows[1]] == ['c', 'a', 'c']
+    with torch.inference_mode():
+        for card_id, row in zip(card_ids, embeddings):
+            expected = model.encode(input_ids=torch.tensor([cards[card_id]]), attention_mask=torch.ones(1, len(cards[card_id])))
+            assert np.allclose(row, expected[0].numpy(), atol=1e-5)
+
+
+def test_train_saves_embeddings_at_served_precision(monkeypatch, tmp_path):
+    cards = {f'c{i}': [5 + i, 6 + i, 7] for i in range(4)}
+    examples = [(card_id, cards[card_id]) for card_id in ['c0', 'c1', 'c2', 'c3'] * 3]
+    monkeypatch.setattr(train_frozen.DistilBertTokenizerFast, 'from_pretrained', lambda name: SimpleNamespace(pad_token_id=0))
+    monkeypatch.setattr(train_frozen, 'RetentionDataset', lambda data_dir, fold, tokenizer: make_dataset(examples))
+    monkeypatch.setattr(settings, 'MODEL_QUANTIZE', 'int8')
+    monkeypatch.setattr(settings, 'MODEL_PARITY_TOLERANCE', 1.0)
+    make_model().save_pretrained(str(tmp_path / 'init'))
+
+    train_frozen.train(folds=['new_card'], init_dir=str(tmp_path / 'init'), output_dir=str(tmp_path / 'frozen'), num_train_epochs=1)
+    model_dir = str(tmp_path / 'frozen' / 'retention_hf_distilbert_new_card')
+    # the server prepares the checkpoint as int8 and only uses an int8 cache
+    cache = CardEmbeddingCache(model_dir, 16, precision='int8')
+    assert len(cache) == 4
+    assert len(CardEmbeddingCache(model_dir, 16, precision='fp32')) == 0
+    model = quantize(DistilBertRetentionModel.from_pretrained(model_dir).eval())
+    embeddings, _ = cache.lookup(['c2'])
+    with torch.inference_mode():
+        expected = model.encode(input_ids=torch.tensor([cards['c2']]), attention_mask=torch.ones(1, 3))
+    # activations are quantized per batch, so only close to a batch of one
+    assert np.allclose(embeddings[0], expected[0].numpy(), atol=1e-3)
+
+
+def test_train_does_not_default_to_served_checkpoints():
+    assert train_frozen.train.__defaults__[2] == f'{settings.CODE_DIR}/output/retention_frozen'
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Review workload simulator for capacity planning.
+
+Drives the batched FSRS kernel over a synthetic population of users and cards
+for a number of simulated days and reports, per day, how many reviews happen,
+how large the candidate set sent with each schedule request is, and the
+resulting schedule / update request volume.
+
+Users are independent, so the population is simulated in chunks of users,
+optionally in parallel. Within a chunk, card state lives in flat numpy arrays
+of shape (users * slots), where slot `j` of a user is the `j`-th new card they
+are shown; only due cards are touched on a given day.
+'''
+
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from karl.fsrs import get_kernel
+from karl.fsrs_models import State, Rating
+from karl.config import settings
+
+
+def fsrs_recall(state, elapsed_days, stability, new_card_recall=0.6, learning_recall=0.9, **kwargs):
+    '''Users forget exactly as FSRS predicts.'''
+    p = np.full(state.shape, learning_recall)
+    p[state == State.New] = new_card_recall
+    is_review = state == State.Review
+    p[is_review] = (1 + elapsed_days[is_review] / (9 * stability[is_review])) ** -1
+    return p
+
+
+def constant_recall(state, elapsed_days, stability, new_card_recall=0.6, recall=0.85, **kwargs):
+    '''Recall does not depend on the schedule.'''
+    p = np.full(state.shape, recall)
+    p[state == State.New] = new_card_recall
+    return p
+
+
+recall_models = {
+    'fsrs': fsrs_recall,
+    'constant': constant_recall,
+}
+
+
+def _simulate_chunk(
+    n_users: int,
+    n_cards: int,
+    n_days: int,
+    new_cards_per_day: int,
+    recall_model: str,
+    recall_kwargs: dict,
+    active_prob: float,
+    max_learning_steps: int,
+    seed,
+):
+    '''helper for multiprocessing'''
+    rng = np.random.default_rng(seed)
+    kernel = get_kernel()
+    get_recall = recall_models[recall_model]
+
+    n_slots = min(n_cards, new_cards_per_day * n_days)
+    # a new card is due on the day it is introduced
+    due = np.tile(np.arange(n_slots, dtype=np.int32) // new_cards_per_day, n_users)
+    last_review = np.zeros(n_users * n_slots, dtype=np.int32)
+    state = np.zeros(n_users * n_slots, dtype=np.int8)
+    stability = np.zeros(n_users * n_slots, dtype=np.float32)
+    difficulty = np.zeros(n_users * n_slots, dtype=np.float32)
+    due_by_user = due.reshape(n_users, n_slots)
+
+    n_reviews = np.zeros(n_days, dtype=np.int64)
+    n_new_cards = np.zeros(n_days, dtype=np.int64)
+    n_active_users = np.zeros(n_days, dtype=np.int64)
+    candidate_hist = np.zeros((n_days, n_slots + 1), dtype=np.int64)
+
+    for day in range(n_days):
+        active = rng.random(n_users) < active_prob
+        n_active_users[day] = active.sum()
+
+        # only slots introduced so far can be due
+        n_introduced = min(n_slots, (day + 1) * new_cards_per_day)
+        rows, cols = np.nonzero(due_by_user[:, :n_introduced] <= day)
+        keep = active[rows]
+        rows, cols = rows[keep], cols[keep]
+        candidate_size = np.bincount(rows, minlength=n_users)[active]
+        candidate_hist[day] += np.bincount(candidate_size, minlength=n_slots + 1)
+
+        index = rows.astype(np.int64) * n_slots + cols
+        for step in range(max_learning_steps):
+            if index.size == 0:
+                break
+            s = state[index]
+            elapsed_days = day - last_review[index]
+            p = get_recall(s, elapsed_days, stability[index], **recall_kwargs)
+            rating = np.where(rng.random(index.size) < p, Rating.Good, Rating.Again)
+            s_next, stability_next, difficulty_next, interval = kernel.repeat(
+                s, stability[index], difficulty[index], elapsed_days, rating)
+
+            state[index] = s_next
+            stability[index] = stability_next
+            difficulty[index] = difficulty_next
+            last_review[index] = day
+            due[index] = day + interval
+
+            n_reviews[day] += index.size
+            if step == 0:
+                n_new_cards[day] = (s == State.New).sum()
+            # cards in (re)learning come back later the same day; whatever is
+            # left after `max_learning_steps` is picked up tomorrow
+            index = index[interval == 0]
+
+    return n_reviews, n_new_cards, n_active_users, candidate_hist
+
+
+def _percentile_from_histogram(hist: np.ndarray, q: float) -> np.ndarray:
+    cdf = np.cumsum(hist, axis=1)
+    total = cdf[:, -1:]
+    return np.array([
+        np.searchsorted(c, q * t[0]) if t[0] > 0 else 0
+        for c, t in zip(cdf, total)
+    ])
+
+
+def simulate(
+    n_users: int = 100000,
+    n_cards: int = 10000,
+    n_days: int = 180,
+    new_cards_per_day: int = 10,
+    recall_model: str = 'fsrs',
+    recall_kwargs: dict = None,
+    active_prob: float = 0.7,
+    max_learning_steps: int = 10,
+    peak_factor: float = 3.0,
+    chunk_size: int = 5000,
+    n_workers: int = None,
+    seed: int = 1,
+) -> pd.DataFrame:
+    '''
+    Simulate `n_users` studying a deck of `n_cards` for `n_days`.
+
+    Each schedule request is followed by one update request, so both volumes
+    equal the number of reviews. Peak QPS assumes the busiest second sees
+    `peak_factor` times the daily mean.
+
+    :return: one row per simulated day.
+    '''
+    recall_kwargs = recall_kwargs or {}
+    chunks = [min(chunk_size, n_users - i) for i in range(0, n_users, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [
+        (n, n_cards, n_days, new_cards_per_day, recall_model, recall_kwargs,
+         active_prob, max_learning_steps, s)
+        for n, s in zip(chunks, seeds)
+    ]
+
+    if n_workers == 1 or len(chunks) == 1:
+        results = [_simulate_chunk(*a) for a in args]
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context(settings.MP_CONTEXT),
+        )
+        futures = [executor.submit(_simulate_chunk, *a) for a in args]
+        results = [x.result() for x in futures]
+        executor.shutdown()
+
+    n_reviews = sum(r[0] for r in results)
+    n_new_cards = sum(r[1] for r in results)
+    n_active_users = sum(r[2] for r in results)
+    candidate_hist = sum(r[3] for r in results)
+
+    df = pd.DataFrame({
+        'day': np.arange(n_days),
+        'n_active_users': n_active_users,
+        'n_reviews': n_reviews,
+        'n_new_cards': n_new_cards,
+        'candidate_p50': _percentile_from_histogram(candidate_hist, 0.50),
+        'candidate_p99': _percentile_from_histogram(candidate_hist, 0.99),
+        'schedule_requests': n_reviews,
+        'update_requests': n_reviews,
+    })
+    df['mean_qps'] = (df.schedule_requests + df.update_requests) / 86400
+    df['peak_qps'] = df.mean_qps * peak_factor
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_users', type=int, default=100000)
+    parser.add_argument('--n_cards', type=int, default=10000)
+    parser.add_argument('--n_days', type=int, default=180)
+    parser.add_argument('--new_cards_per_day', type=int, default=10)
+    parser.add_argument('--recall_model', choices=list(recall_models.keys()), default='fsrs')
+    parser.add_argument('--active_prob', type=float, default=0.7)
+    parser.add_argument('--peak_factor', type=float, default=3.0)
+    parser.add_argument('--chunk_size', type=int, default=5000)
+    parser.add_argument('--n_workers', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    df = simulate(
+        n_users=args.n_users,
+        n_cards=args.n_cards,
+        n_days=args.n_days,
+        new_cards_per_day=args.new_cards_per_day,
+        recall_model=args.recall_model,
+        active_prob=args.active_prob,
+        peak_factor=args.peak_factor,
+        chunk_size=args.chunk_size,
+        n_workers=args.n_workers,
+        seed=args.seed,
+    )
+    print(df.to_string(index=False))
+    print()
+    print('max reviews per day', df.n_reviews.max())
+    print('max candidate p99', df.candidate_p99.max())
+    print('max peak qps', '%.2f' % df.peak_qps.max())
+    if args.output is not None:
+        df.to_csv(args.output, index=False)